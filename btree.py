@@ -6,12 +6,24 @@ __version__ = '1.0.0'
 __all__ = [
     'BTREE_MIN_DEGREE_MIN',
     'BTREE_MIN_DEGREE_DEFAULT',
+    'BTREE_FILE_MIN_DEGREE_DEFAULT',
 
     'btree_item',  # only contains one member: bt_key
     'btree_kv',  # based on btree_item, has an additional member value
+    'btree_pair',  # (bt_key, value) read out of a bare key/value btree
+    'btree_encode_key',  # order-preserving bytes of a key, btree(key=)
     # 'btree_items',  # key_range(), key_range_start(), key_range_end()
     # 'btree_node',  # internal use only
     'btree',  # main class
+    'btree_view',  # read-only btree shared with btree.snapshot()
+    'btree_cursor',  # position in a btree kept as a path, btree.cursor()
+    'btree_multimap',  # btree of one bucket of values for each key
+    'concurrent_btree',  # thread-safe btree with readers-writer lock
+    'btree_file',  # btree saved in a page file
+    'btree_snapshot',  # read-only btree memory-mapped from a file
+    'btree_logged',  # btree with write-ahead log and checkpoint
+    'async_btree',  # asyncio facade of the btrees above
+    'sharded_btree',  # btree range-partitioned across worker processes
 ]
 
 __author__ = 'Forrest Zhang <forrest@263.net>'
@@ -67,14 +79,39 @@ Deletion from a B-tree is analogous to insertion but a little more complicated.
 
 '''
 
+import asyncio
+import heapq
+import mmap
+import multiprocessing
+import os
+import pickle
+import struct
+import sys
+import threading
+import time
+import weakref
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate, compress, groupby, islice, repeat
+from operator import add, attrgetter, gt
+from os.path import commonprefix
+
 BTREE_MIN_DEGREE_MIN = 2
 BTREE_MIN_DEGREE_DEFAULT = 1023
+# smaller nodes for btree_file, a node is loaded as a whole on the way
+BTREE_FILE_MIN_DEGREE_DEFAULT = 64
+
+_bt_key = attrgetter('bt_key')
 
 
 class btree_item:
     '''
     be a base class of real class which contains bt_key and any other data
     '''
+    __slots__ = ('bt_key',)
 
     def __init__(self, bt_key):
         self.bt_key = bt_key
@@ -87,6 +124,7 @@ class btree_kv(btree_item):
     '''
     simply class based on btree_item contains bt_key and value
     '''
+    __slots__ = ('value',)
 
     def __init__(self, key, value):
         super().__init__(key)
@@ -96,80 +134,498 @@ class btree_kv(btree_item):
         return f'{self.bt_key}: {self.value}'
 
 
-class btree_items(list):
+class btree_pair(namedtuple('btree_pair', ('bt_key', 'value'))):
+    '''
+    (bt_key, value) read out of a bare key/value btree, see btree_pairs
+    '''
+    __slots__ = ()
+
+    def __repr__(self):
+        return f'{self.bt_key}: {self.value}'
+
+
+class btree_bucket(btree_item):
+    '''
+    all values of a bt_key in btree_multimap, in a deque in FIFO order
+    '''
+    __slots__ = ('values',)
+
+    def __init__(self, bt_key, values=()):
+        super().__init__(bt_key)
+        self.values = deque(values)
+
+    def __repr__(self):
+        return f'{self.bt_key}: {list(self.values)}'
+
 
+class btree_keys:
     '''
-    Searching key range bases on faster binary search
+    binary search in C by bisect on self.keys, a plain list of bt_key
+    which must be kept in sync with the items
     '''
+    __slots__ = ()
+
+    sort_key = None  # keys are sort_key(bt_key) if it's set, see btree(key=)
+    item_key = _bt_key  # key of an item kept in self.keys
+
+    def key_at(self, index: int):
+        return self.keys[index]
 
     def key_range_start(self, key, right=None):
         # if right edge (end) is unknown, search whole list
         if right is None:
-            right = len(self)
+            right = len(self.keys)
+        return bisect_left(self.keys, key, 0, right)
 
-        if not (self and right and key > self[0].bt_key):
-            return 0
+    def key_range_end(self, key):
+        # FIFO: new item with the same key is inserted at the right side
+        return bisect_right(self.keys, key)
+
+    def key_range(self, key):
+        end = bisect_right(self.keys, key)
+        return bisect_left(self.keys, key, 0, end), end
+
+
+class btree_items(btree_keys, list):
+
+    '''
+    Searching key range bases on faster binary search,
+    the list operations used by btree_node keep keys in sync with items
+    '''
+    __slots__ = ('keys',)
 
-        if key > self[right - 1].bt_key:
-            return right
-        right -= 1
+    kv_class = btree_kv  # made by btree.insert_kv()
 
-        ''' [left] < key <= [right] '''
-        left = 0
-        while left + 1 < right:
-            mid = (left + right) >> 1
-            if key > self[mid].bt_key:
-                left = mid
+    def __init__(self, items=(), keys: list=None):
+        list.__init__(self, items)
+        if keys is None:
+            if isinstance(items, self.__class__):
+                keys = items.keys[:]  # a slice of a node, see __getitem__
             else:
-                right = mid
-        return left + 1
+                keys = list(map(self.item_key, self))
+        self.keys = keys
 
-    def key_range_end(self, key):
-        if not self or key < self[0].bt_key:
-            return 0
+    def __reduce__(self):
+        # keys are made again, pickle calls extend() before keys are set
+        return self.__class__, (list(self),)
 
-        left, right = 0, len(self) - 1
-        if key < self[right].bt_key:
-            ''' [left] <= key < [right] '''
-            while left + 1 < right:
-                mid = (left + right) >> 1
-                if key < self[mid].bt_key:
-                    right = mid
-                else:
-                    left = mid
-            return right
+    def __getitem__(self, index):
+        # a slice keeps the keys, they are not made again by a new node
+        if isinstance(index, slice):
+            return self.__class__(list.__getitem__(self, index),
+                                  self.keys[index])
+        return list.__getitem__(self, index)
+
+    def __setitem__(self, index, item):
+        list.__setitem__(self, index, item)
+        if isinstance(index, slice):
+            self.keys = list(map(self.item_key, self))
+        else:
+            self.keys[index] = self.item_key(item)
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        del self.keys[index]
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def extend(self, items):
+        items = list(items)
+        list.extend(self, items)
+        self.keys += map(self.item_key, items)
+
+    def insert(self, index: int, item, key=None):
+        # key: the key of the item if it's known
+        list.insert(self, index, item)
+        self.keys.insert(index, self.item_key(item) if key is None else key)
+
+    def append(self, item):
+        list.append(self, item)
+        self.keys.append(self.item_key(item))
+
+    def pop(self, index: int=-1):
+        del self.keys[index]
+        return list.pop(self, index)
+
+    def clear(self):
+        list.clear(self)
+        self.keys.clear()
+
+    def copy(self) -> 'btree_items':
+        items = self.__class__()
+        list.extend(items, self)
+        items.keys = self.keys[:]
+        return items
+
+    def compress(self, selectors) -> 'btree_items':
+        # the items where selectors are true, like itertools.compress()
+        return self.__class__(compress(self, selectors),
+                              list(compress(self.keys, selectors)))
+
+
+class btree_pairs(btree_keys):
+    '''
+    items of a node in bare key/value mode, btree(bare=True).
+    keys and values are kept in two parallel lists instead of
+    one btree_kv object per item, the item is read out as btree_pair.
+    it supports the list operations which btree_node uses on btree_items
+    '''
+    __slots__ = ('keys', 'values')
+
+    kv_class = btree_pair
+
+    def __init__(self, items=()):
+        if isinstance(items, btree_pairs):
+            self.keys, self.values = items.keys, items.values
+        else:
+            items = list(items)
+            self.keys = [item.bt_key for item in items]
+            self.values = [item.value for item in items]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return map(btree_pair, self.keys, self.values)
+
+    def __reversed__(self):
+        return map(btree_pair, reversed(self.keys), reversed(self.values))
+
+    def __repr__(self):
+        return f'{list(self)}'
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            pairs = btree_pairs()
+            pairs.keys, pairs.values = self.keys[index], self.values[index]
+            return pairs
+        return btree_pair(self.keys[index], self.values[index])
+
+    def __setitem__(self, index: int, item):
+        self.keys[index], self.values[index] = item.bt_key, item.value
+
+    def __delitem__(self, index):
+        del self.keys[index]
+        del self.values[index]
+
+    def __iadd__(self, items):
+        items = btree_pairs(items)
+        self.keys += items.keys
+        self.values += items.values
+        return self
+
+    def insert(self, index: int, item, _key=None):
+        self.keys.insert(index, item.bt_key)
+        self.values.insert(index, item.value)
+
+    def append(self, item):
+        self.keys.append(item.bt_key)
+        self.values.append(item.value)
+
+    def pop(self, index: int=-1) -> btree_pair:
+        return btree_pair(self.keys.pop(index), self.values.pop(index))
+
+    def copy(self) -> 'btree_pairs':
+        return self[:]
+
+    def compress(self, selectors) -> 'btree_pairs':
+        pairs = btree_pairs()
+        pairs.keys = list(compress(self.keys, selectors))
+        pairs.values = list(compress(self.values, selectors))
+        return pairs
+
+
+class btree_prefix_pairs(btree_keys):
+    '''
+    items of a node in prefix-compressed mode, btree(prefix=True).
+    like btree_pairs, but str keys are kept as suffixes after a prefix
+    common to all keys of the node, a key out of it shortens the prefix.
+    bisect runs on the suffixes in C, a probe key out of the prefix
+    is at either end of the node
+    '''
+    __slots__ = ('prefix', 'suffixes', 'values')
+
+    kv_class = btree_pair
+
+    def __init__(self, items=()):
+        if isinstance(items, btree_prefix_pairs):
+            self.prefix, self.suffixes, self.values = \
+                items.prefix, items.suffixes, items.values
         else:
-            ''' key = [right] '''
-            return right + 1
+            items = list(items)
+            for item in items:
+                self._check(item.bt_key)
+            self._assign('', [item.bt_key for item in items],
+                         [item.value for item in items])
+
+    def _assign(self, prefix: str, suffixes: [str], values: list):
+        # suffixes are sorted, the common prefix of the first and the last
+        # one is common to all of them
+        if suffixes:
+            n = len(commonprefix((suffixes[0], suffixes[-1])))
+            if n:
+                prefix += suffixes[0][:n]
+                suffixes = [suffix[n:] for suffix in suffixes]
+        self.prefix, self.suffixes, self.values = prefix, suffixes, values
+
+    @staticmethod
+    def _check(bt_key):
+        if not isinstance(bt_key, str):
+            raise TypeError(f'btree(prefix=True) with {type(bt_key).__name__}'
+                            f' key {bt_key!r}')
+
+    def _suffix(self, bt_key: str) -> str:
+        # the suffix of a new key, the prefix is shortened if it's out of it
+        self._check(bt_key)
+        prefix = self.prefix
+        if not self.suffixes:
+            self.prefix = bt_key
+            return ''
+        if not bt_key.startswith(prefix):
+            n = len(commonprefix((prefix, bt_key)))
+            head, self.prefix = prefix[n:], prefix[:n]
+            self.suffixes = [head + suffix for suffix in self.suffixes]
+        return bt_key[len(self.prefix):]
+
+    def _bisect(self, bisect, key, lo: int=0, hi: int=None) -> int:
+        self._check(key)
+        if hi is None:
+            hi = len(self.suffixes)
+        prefix = self.prefix
+        if key.startswith(prefix):
+            return bisect(self.suffixes, key[len(prefix):], lo, hi)
+        return lo if key < prefix else hi
+
+    @property
+    def keys(self) -> [str]:
+        # full keys, made for check() and the other slow paths
+        return list(map(self.prefix.__add__, self.suffixes))
+
+    def key_at(self, index: int) -> str:
+        return self.prefix + self.suffixes[index]
+
+    def key_range_start(self, key, right=None):
+        return self._bisect(bisect_left, key, 0, right)
+
+    def key_range_end(self, key):
+        return self._bisect(bisect_right, key)
 
     def key_range(self, key):
-        end = self.key_range_end(key)
-        return self.key_range_start(key, end), end
+        end = self._bisect(bisect_right, key)
+        return self._bisect(bisect_left, key, 0, end), end
+
+    def __len__(self):
+        return len(self.suffixes)
+
+    def __iter__(self):
+        return map(btree_pair, map(self.prefix.__add__, self.suffixes),
+                   self.values)
+
+    def __reversed__(self):
+        return map(btree_pair,
+                   map(self.prefix.__add__, reversed(self.suffixes)),
+                   reversed(self.values))
+
+    def __repr__(self):
+        return f'{list(self)}'
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            pairs = btree_prefix_pairs()
+            pairs._assign(self.prefix, self.suffixes[index],
+                          self.values[index])
+            return pairs
+        return btree_pair(self.prefix + self.suffixes[index],
+                          self.values[index])
+
+    def __setitem__(self, index: int, item):
+        suffix = self._suffix(item.bt_key)
+        self.suffixes[index], self.values[index] = suffix, item.value
+
+    def __delitem__(self, index):
+        del self.suffixes[index]
+        del self.values[index]
+
+    def __iadd__(self, items):
+        items = btree_prefix_pairs(items)
+        if items.suffixes:
+            if self.suffixes:
+                self._assign('', self.keys + items.keys,
+                             self.values + items.values)
+            else:
+                self.prefix, self.suffixes, self.values = \
+                    items.prefix, items.suffixes[:], items.values[:]
+        return self
+
+    def insert(self, index: int, item, _key=None):
+        suffix = self._suffix(item.bt_key)
+        self.suffixes.insert(index, suffix)
+        self.values.insert(index, item.value)
+
+    def append(self, item):
+        suffix = self._suffix(item.bt_key)
+        self.suffixes.append(suffix)
+        self.values.append(item.value)
+
+    def pop(self, index: int=-1) -> btree_pair:
+        return btree_pair(self.prefix + self.suffixes.pop(index),
+                          self.values.pop(index))
+
+    def copy(self) -> 'btree_prefix_pairs':
+        pairs = btree_prefix_pairs()
+        pairs.prefix, pairs.suffixes, pairs.values = \
+            self.prefix, self.suffixes[:], self.values[:]
+        return pairs
+
+    def compress(self, selectors) -> 'btree_prefix_pairs':
+        pairs = btree_prefix_pairs()
+        pairs._assign(self.prefix, list(compress(self.suffixes, selectors)),
+                      list(compress(self.values, selectors)))
+        return pairs
+
+
+class btree_buckets(btree_items):
+    '''
+    items of a node of btree_multimap, one btree_bucket for each bt_key,
+    see btree_bucket_node
+    '''
+    __slots__ = ()
+
+    kv_class = btree_pair  # values are read out as btree_pair
+
+
+# btree_items of each sort_key, dropped with the last btree using it
+_keyed_classes = weakref.WeakValueDictionary()
+
+
+def _keyed_items(sort_key) -> type:
+    '''
+    btree_items keeping sort_key(bt_key) of the items as keys, one class
+    for each sort_key, so btrees with the same key can be joined
+    '''
+    items_class = _keyed_classes.get(sort_key)
+    if items_class is None:
+        items_class = _keyed_classes[sort_key] = type(
+            'btree_keyed_items', (btree_items,), {
+                '__slots__': (),
+                'sort_key': staticmethod(sort_key),
+                'item_key': staticmethod(
+                    lambda item: sort_key(item.bt_key))})
+    return items_class
+
+
+def btree_encode_key(bt_key) -> bytes:
+    '''
+    encode bt_key into bytes in the same order, for btree(key=btree_encode_key),
+    so that the nodes compare bytes in C instead of tuples or rich objects.
+    None, bool, int, float, str, bytes and tuples of them are supported,
+    the keys at the same position must be of one type, but int and bool
+    '''
+    if bt_key is None:
+        return b'\x01'
+    if isinstance(bt_key, int):
+        if bt_key >= 0:
+            size = (bt_key.bit_length() + 7) // 8
+            return b'\x03' + bytes((size,)) + bt_key.to_bytes(size, 'big')
+        # longer is less, and the value is offset to be positive
+        size = ((-bt_key - 1).bit_length() + 7) // 8 or 1
+        return b'\x02' + bytes((255 - size,)) \
+            + (bt_key + (1 << (size * 8))).to_bytes(size, 'big')
+    if isinstance(bt_key, float):
+        bits = struct.unpack('>Q', struct.pack('>d', bt_key))[0]
+        bits ^= 0xffffffffffffffff if bits >> 63 else 1 << 63
+        return b'\x04' + bits.to_bytes(8, 'big')
+    if isinstance(bt_key, (bytes, bytearray, str)):
+        # terminated by 0, which is escaped as 0, 255 in it
+        if isinstance(bt_key, str):
+            tag, bt_key = b'\x06', bt_key.encode()
+        else:
+            tag = b'\x05'
+        return tag + bytes(bt_key).replace(b'\x00', b'\x00\xff') + b'\x00'
+    if isinstance(bt_key, tuple):
+        return b'\x07' + b''.join(map(btree_encode_key, bt_key)) + b'\x00'
+    raise TypeError(f'btree_encode_key() of {type(bt_key).__name__}')
+
+
+class btree_conf:
+    '''
+    settings shared by a btree and all of its nodes,
+    so that a node doesn't have to keep its own copy
+    '''
+    __slots__ = ('min_degree', 'max_degree', 'items_class', 'sort_key',
+                 'pager', 'frozen', 'version')
+
+    def __init__(self, min_degree: int, items_class: type=btree_items,
+                 pager: 'btree_pager'=None):
+        self.min_degree = min_degree
+        self.max_degree = 2 * min_degree - 1
+        self.items_class = items_class
+        self.sort_key = items_class.sort_key
+        self.pager = pager  # nodes are saved in pages of btree_file
+        self.frozen = False  # its nodes are shared by btree.snapshot()
+        self.version = 0  # number of write operations, see btree_cursor
+
+    def new_node(self, items=None, children=None) -> 'btree_node':
+        if self.pager is not None:
+            return btree_page_node(self, items, children)
+        if self.items_class is btree_buckets:
+            return btree_bucket_node(self, items, children)
+        return btree_node(self, items, children)
 
 
 class btree_node:
+    __slots__ = ('conf', 'items', 'children', 'n_item', '_offsets')
 
     def __init__(self,
-                 min_degree: int,
+                 conf: btree_conf,
                  items: [btree_item]=None,
                  children: ['btree_node']=None):
-        self.min_degree = min_degree
-        self.max_degree = 2 * min_degree - 1
-        self.items = btree_items(items or [])  # as keys
+        self.conf = conf
+        self.items = conf.items_class(items or [])  # as keys
         self.children: [btree_node] = children or []
 
         # number of items in the subtree
-        n_item = len(self.items)
+        n_item = self._weights(self.items)
         for child in self.children:
             n_item += child.n_item
         self.n_item = n_item
 
+        # prefix counts of children, see offsets()
+        self._offsets = None
+
+    def copy(self, conf: btree_conf) -> 'btree_node':
+        # a copy of the node which belongs to conf, the children are shared
+        node = conf.new_node()
+        node.items, node.children = self.items.copy(), self.children[:]
+        node.n_item = self.n_item
+        return node
+
+    def writable(self, index: int) -> 'btree_node':
+        '''
+        return children[index] to be changed, copy-on-write:
+        a child which belongs to another conf may be shared with a snapshot(),
+        so it's replaced with a copy first
+        '''
+        child = self.children[index]
+        if child.conf is not self.conf:
+            child = self.children[index] = child.copy(self.conf)
+        return child
+
     def get_n_item(self):
-        n_item = len(self.items)
+        n_item = self._weights(self.items)
         for child in self.children:
             n_item += child.get_n_item()
         return n_item
 
+    # number of values an item counts in n_item, see btree_bucket_node
+    def _weight(self, item) -> int:
+        return 1
+
+    def _weights(self, items) -> int:
+        return len(items)
+
     def get_n_node(self):
         n_node = len(self.children)
         for child in self.children:
@@ -179,63 +635,206 @@ class btree_node:
     def __len__(self):
         return self.n_item
 
+    def offsets(self) -> [int]:
+        '''
+        offsets[i] is the number of items in children[:i + 1] and items[:i + 1],
+        it's cached until the children are changed (set self._offsets None)
+        '''
+        if self._offsets is None:
+            self._offsets = list(accumulate(
+                child.n_item + 1 for child in self.children))
+        return self._offsets
+
     def getitem(self, pos):
-        for i, child in enumerate(self.children):
-            if pos < child.n_item:
-                return child.getitem(pos)
-            pos -= child.n_item + 1
-            if pos < 0:
-                return self.items[i]
+        node = self
+        while node.children:
+            offsets = node.offsets()
+            i = bisect_right(offsets, pos)
+            if i:
+                pos -= offsets[i - 1]
+            child = node.children[i]
+            if pos == child.n_item:
+                return node.items[i]
+            node = child
 
         # must be a leaf node if got here
-        return self.items[pos]
+        return node.items[pos]
+
+    def has_key(self, bt_key) -> bool:
+        node = self
+        while True:
+            start, end = node.items.key_range(bt_key)
+            if start < end:
+                return True
+            if not node.children:
+                return False
+            node = node.children[start]
+
+    def rank(self, bt_key, right: bool=False) -> int:
+        '''
+        return the number of items which item.bt_key < bt_key,
+        or item.bt_key <= bt_key if right is True
+        '''
+        pos, node = 0, self
+        while True:
+            if right:
+                index = node.items.key_range_end(bt_key)
+            else:
+                index = node.items.key_range_start(bt_key)
+            if not node.children:
+                return pos + index
+            if index:
+                pos += node.offsets()[index - 1]
+            node = node.children[index]
+
+    def locate(self, pos) -> [list]:
+        '''
+        like seek(), but return the path to the item at position pos,
+        it always goes down to a leaf node, therefore,
+        walk() forward from it starts with the item at pos,
+        walk() reversed from it starts with the item at pos - 1
+        '''
+        path, node = [], self
+        while node.children:
+            offsets = node.offsets()
+            i = bisect_right(offsets, pos)
+            if i:
+                pos -= offsets[i - 1]
+            path.append([node, i])
+            node = node.children[i]
+        path.append([node, pos])
+        return path
 
     def __getitem__(self, index) -> btree_item or [btree_item]:
         top = self.n_item
 
         if isinstance(index, int):
-            if index >= 0 and index < self.n_item:
+            if index < 0:
+                index += top
+            if index >= 0 and index < top:
                 return self.getitem(index)
         elif isinstance(index, slice):
-            start, stop, step = index.start, index.stop, index.step
-
-            # set default for start, stop and step
-            if stop is None:
-                start, stop, step = 0, top, 1
-            elif start is None:
-                start = 0
-            elif step is None:
-                step = 1
-
-            if start > 0 and start < top and (
-                (step > 0 and stop > start and stop <= top)
-                or (step < 0 and stop < start and stop > -2)):
-                items = []
-                for index in range(start, stop, step):
-                    items.append(self.getitem(index))
-                return items
+            start, stop, step = index.indices(top)
+            count = len(range(start, stop, step))
+            if not count:
+                return []
+
+            if step > 4 or step < -4:
+                # far away from each other, get them one by one
+                return [self.getitem(i) for i in range(start, stop, step)]
+
+            # go down to start once, then walk through items in order
+            if step > 0:
+                items = self.walk(self.locate(start))
+            else:
+                items = self.walk(self.locate(start + 1), True)
+                step = -step
+            return list(islice(items, 0, (count - 1) * step + 1, step))
 
         raise IndexError(f'{index} out of range [0, {top})')
 
     def __iter__(self):
-        if self.children:
-            yield from self.children[0].__iter__()
-        for i, item in enumerate(self.items, 1):
-            yield item
-            if self.children:
-                yield from self.children[i].__iter__()
+        return self.iterate()
+
+    def __reversed__(self):
+        return self.iterate(True)
+
+    def iterate(self, reverse: bool=False):
+        '''
+        in-order iteration with an explicit stack of (items, children)
+        iterators, instead of one generator per node on the path
+        '''
+        order = reversed if reverse else iter
+        node, stack = self, []
+        while True:
+            # go down to the first leaf node of the subtree
+            while node.children:
+                children = order(node.children)
+                stack.append((order(node.items), children))
+                node = next(children)
+            yield from order(node.items)
+
+            # go up to the next item, then go down its next child
+            while stack:
+                items, children = stack[-1]
+                for item in items:
+                    yield item
+                    node = next(children)
+                    break
+                else:
+                    stack.pop()
+                    continue
+                break
+            else:
+                return
+
+    def seek(self, bt_key, right: bool=False) -> [list]:
+        '''
+        return the path from this node to the first item
+        which bt_key <= item.bt_key, or bt_key < item.bt_key if right is True,
+        as a list of [node, index], index is the item at the right side.
+        bt_key None stands for the left edge, or the right edge if right is True
+        '''
+        path, node = [], self
+        while True:
+            if bt_key is None:
+                index = len(node.items) if right else 0
+            elif right:
+                index = node.items.key_range_end(bt_key)
+            else:
+                index = node.items.key_range_start(bt_key)
+            path.append([node, index])
+            if not node.children:
+                return path
+            node = node.children[index]
+
+    @staticmethod
+    def walk(path: [list], reverse: bool=False):
+        '''
+        in-order walk from a path returned by seek(), it's consumed as a stack
+        '''
+        if reverse:
+            while path:
+                top = path[-1]
+                node, index = top
+                if index:
+                    index -= 1
+                    top[1] = index
+                    yield node.items[index]
+                    # the rightmost path of the left child of this item
+                    while node.children:
+                        node = node.children[index]
+                        index = len(node.items)
+                        path.append([node, index])
+                else:
+                    path.pop()
+        else:
+            while path:
+                top = path[-1]
+                node, index = top
+                if index < len(node.items):
+                    top[1] = index + 1
+                    yield node.items[index]
+                    # the leftmost path of the right child of this item
+                    index += 1
+                    while node.children:
+                        node = node.children[index]
+                        index = 0
+                        path.append([node, index])
+                else:
+                    path.pop()
 
     def is_full(self):
-        return len(self.items) > self.max_degree
+        return len(self.items) > self.conf.max_degree
 
     def is_enough(self):
-        return len(self.items) >= self.min_degree
+        return len(self.items) >= self.conf.min_degree
 
     def is_poor(self):
-        return len(self.items) < self.min_degree - 1
+        return len(self.items) < self.conf.min_degree - 1
 
     def __repr__(self):
-        r = f'btree_node[{len(self.items)}]: {[d.bt_key for d in self.items]}'
+        r = f'btree_node[{len(self.items)}]: {self.items.keys}'
         if self.children:
             r += f' children# {[len(child.items) for child in self.children]}'
         return r
@@ -256,321 +855,3739 @@ class btree_node:
                 stats.error(f'items and child count error {self} @ {path}')
 
             height = self.children[0].check(stats, path + [0])
-            for i, item in enumerate(self.items, 1):
-                stats.check_order(item.bt_key)
+            for i, key in enumerate(self.items.keys, 1):
+                stats.check_order(key)
 
                 _h = self.children[i].check(stats, path + [i])
                 if _h != height:
                     stats.error(f'height different at {i}: {_h} vs. {height}')
             return height + 1
         else:
-            for item in self.items:
-                stats.check_order(item.bt_key)
+            for key in self.items.keys:
+                stats.check_order(key)
             return 0
 
     def traverse(self, path: [int], callback, cb_data=None):
-        if self.children:
-            for i, child in enumerate(self.children):
-                ret = child.traverse(path + [i], callback, cb_data)
+        '''
+        the list path is extended as a buffer of the path to each item,
+        it's reused for every item, copy it if callback needs it later
+        '''
+        node, stack = self, []
+        path.append(0)
+        while True:
+            # go down to the first leaf node of the subtree
+            while node.children:
+                path[-1] = 0
+                stack.append((node, enumerate(node.items)))
+                node = node.children[0]
+                path.append(0)
+
+            for i, item in enumerate(node.items):
+                path[-1] = i
+                # stop traverse() if callback return something
+                ret = callback(path, item, cb_data)
                 if ret:
                     return ret
 
-                if i < len(self.items):
-                    # stop traverse() if callback return something
-                    ret = callback(path + [i], self.items[i], cb_data)
+            # go up to the next item, then go down its next child
+            while stack:
+                path.pop()
+                parent, items = stack[-1]
+                for i, item in items:
+                    path[-1] = i
+                    ret = callback(path, item, cb_data)
                     if ret:
                         return ret
-        else:
-            for i, item in enumerate(self.items):
-                ret = callback(path + [i], item, cb_data)
-                if ret:
-                    return ret
+                    node = parent.children[i + 1]
+                    path[-1] = i + 1
+                    path.append(0)
+                    break
+                else:
+                    stack.pop()
+                    continue
+                break
+            else:
+                return
 
     def descendants(self, matches:[btree_item]):
-        if self.children:
-            for i, item in enumerate(self.items):
-                self.children[i].descendants(matches)
-                matches += [item]
-            self.children[-1].descendants(matches)
-        else:
-            matches += self.items
+        matches += self
 
     def search(self, matches:[btree_item], bt_key):
-        start, end = self.items.key_range(bt_key)
-        if self.children:
-            # previous child may has more item matched
-            self.children[start].search(matches, bt_key)
-            if start < end:
-                matches += [self.items[start]]
-                start += 1
-                while start < end:
-                    self.children[start].descendants(matches)
-                    matches += [self.items[start]]
-                    start += 1
-                # next child may has more item matched
-                self.children[end].search(matches, bt_key)
-        else:
-            matches += self.items[start:end]
-        return
+        # the first matched item may be in a child of the node
+        path = self.seek(bt_key)
+        if self.items.sort_key is not None:
+            # counted instead of making keys of the items again
+            n = self.rank(bt_key, True) - self.rank(bt_key)
+            matches += islice(self.walk(path), n)
+            return
+        for item in self.walk(path):
+            if bt_key < item.bt_key:
+                break
+            matches.append(item)
+
+    def search_many(self, bt_keys: list):
+        '''
+        generate (bt_key, [items]) for sorted bt_keys,
+        keys go down to the same child together, so each node is visited once
+        '''
+        if not self.children:
+            for bt_key in bt_keys:
+                start, end = self.items.key_range(bt_key)
+                yield bt_key, list(self.items[start:end])
+            return
+
+        group, index = [], 0
+        for bt_key in bt_keys:
+            start, end = self.items.key_range(bt_key)
+            if start == end:
+                # no item matched in this node, go down to children[start]
+                if group and start != index:
+                    yield from self.children[index].search_many(group)
+                    group = []
+                group.append(bt_key)
+                index = start
+            else:
+                if group:
+                    yield from self.children[index].search_many(group)
+                    group = []
+                matches = []
+                self.search(matches, bt_key)
+                yield bt_key, matches
+        if group:
+            yield from self.children[index].search_many(group)
+
+    def rank_many(self, bt_keys: list, base: int=0) -> [(int, int)]:
+        '''
+        (rank(bt_key), rank(bt_key, True)) + base for each of sorted bt_keys,
+        the keys which go down to the same child are cut out by bisect
+        together, so each node is visited once
+        '''
+        keys = self.items.keys
+        if not self.children:
+            return list(zip(map(base.__add__,
+                                map(bisect_left, repeat(keys), bt_keys)),
+                            map(base.__add__,
+                                map(bisect_right, repeat(keys), bt_keys))))
+
+        spans, offsets, lo = [], self.offsets(), 0
+        while lo < len(bt_keys):
+            bt_key = bt_keys[lo]
+            i = bisect_left(keys, bt_key)
+            if i < len(keys) and not bt_key < keys[i]:
+                # its items may be in the children on both sides
+                spans.append((base + self.rank(bt_key),
+                              base + self.rank(bt_key, True)))
+                lo += 1
+                continue
+            hi = bisect_left(bt_keys, keys[i], lo) if i < len(keys) \
+                else len(bt_keys)
+            spans += self.children[i].rank_many(
+                bt_keys[lo:hi], base + offsets[i - 1] if i else base)
+            lo = hi
+        return spans
 
     def split(self) -> (btree_item, 'btree_node'):
         # right node takes right half of items and children
-        n = self.min_degree
+        n = self.conf.min_degree
 
         # it's OK to "slice" or "del" on empty list
-        right = btree_node(n, self.items[n:], self.children[n:])
+        right = self.conf.new_node(self.items[n:], self.children[n:])
         del self.items[n:]  # remove right part items
         del self.children[n:]  # remove right part of children
+        self._offsets = None
 
-        self.n_item -= right.n_item + 1
-        return self.items.pop(n - 1), right
+        middle = self.items.pop(n - 1)
+        self.n_item -= right.n_item + self._weight(middle)
+        return middle, right
 
     def insert(self, bt_key, item: btree_item) -> bool:
         self.n_item += 1  # each node on the path increased 1 item
+        self._offsets = None
 
         # FIFO: insert into the right
         i = self.items.key_range_end(bt_key)
         if self.children:
-            if self.children[i].insert(bt_key, item):
+            child = self.writable(i)
+            if child.insert(bt_key, item):
                 # child is full, split it
-                midlle, right = self.children[i].split()
+                midlle, right = child.split()
                 self.items.insert(i, midlle)
                 self.children.insert(i + 1, right)
                 return self.is_full()
         else:
             # always insert new item into a leaf node
-            self.items.insert(i, item)
+            self.items.insert(i, item, bt_key)
             return self.is_full()
 
+    def split_many(self) -> [(btree_item, 'btree_node')]:
+        '''
+        split a node which is far more than full into nodes about 3/4 full,
+        self keeps the first part, return [(middle, right)] for its parent
+        '''
+        t = self.conf.min_degree
+        parts = _partition(len(self.items) + 1, t, t + (t >> 1))
+
+        items, children = self.items, self.children
+        splits, pos = [], parts[0]
+        for size in parts[1:]:
+            end = pos + size
+            right = self.conf.new_node(items[pos:end - 1], children[pos:end])
+            splits.append((items[pos - 1], right))
+            self.n_item -= right.n_item + self._weight(items[pos - 1])
+            pos = end
+        del items[parts[0] - 1:]
+        del children[parts[0]:]
+        self._offsets = None
+        return splits
+
+    def insert_many(self, items:[btree_item], keys: list=None):
+        '''
+        insert items sorted by bt_key, they go down to children in groups,
+        a child is split once after all of its items are inserted.
+        keys: the keys of the items for self.items, made if it's None
+        '''
+        self.n_item += self._weights(items)
+        self._offsets = None
+        if keys is None:
+            keys = list(map(self.items.item_key, items))
+
+        if not self.children:
+            if len(items) * 32 < len(self.items):
+                # a few items, insert them one by one
+                for item, bt_key in zip(items, keys):
+                    self.items.insert(self.items.key_range_end(bt_key), item,
+                                      bt_key)
+                return
+            # two sorted runs are merged by the stable sort in C,
+            # FIFO: existing items go first for the same bt_key
+            merged = list(self.items)
+            merged += items
+            if self.items.sort_key is None:
+                merged.sort(key=_bt_key)
+                self.items = self.conf.items_class(merged)
+                return
+            # by the keys of both, sort_key is not called again
+            keys = self.items.keys + keys
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            self.items = self.conf.items_class(
+                list(map(merged.__getitem__, order)),
+                list(map(keys.__getitem__, order)))
+            return
+
+        groups, start = [], 0
+        while start < len(items):
+            index = self.items.key_range_end(keys[start])
+            if index < len(self.items):
+                # the rest items go to the right side of the separator
+                end = bisect_left(keys, self.items.key_at(index), start)
+            else:
+                end = len(items)
+            groups.append((index, start, end))
+            start = end
+
+        # from right to left, the index of left children are not changed
+        for index, start, end in reversed(groups):
+            child = self.writable(index)
+            child.insert_many(items[start:end], keys[start:end])
+            if child.is_full():
+                for i, (middle, right) in enumerate(child.split_many(), index):
+                    self.items.insert(i, middle)
+                    self.children.insert(i + 1, right)
+
     def _merge(self, index:int):
         # append items[index] and right child's items/children to left child
-        left, right = self.children[index], self.children[index + 1]
+        left, right = self.writable(index), self.children[index + 1]
 
-        left.items.append(self.items.pop(index))  # move items[index] to left
+        middle = self.items.pop(index)
+        left.items.append(middle)  # move items[index] to left
         left.items += right.items  # and all items of right
         left.children += right.children  # and its children
         del self.children[index + 1]  # remove right child from self
+        self._offsets = left._offsets = None
+
+        # + right's items and 1 item of self
+        left.n_item += right.n_item + self._weight(middle)
+
+    def _get_child(self, index:int) -> 'btree_node':
+        '''
+        if child has not enough items (< minimum degree),
+        and delete() remove one more item from it,
+        then its items will be less than minimum degree.
+        therefore, borrow an item and child from left/right sibling,
+        or merge it with left/right sibling, make sure the items are enough.
+        '''
+        child = self.writable(index)
+        if child.is_enough():
+            return child
+
+        left_index = index - 1  # first child has no left sibling
+        if index > 0 and self.children[left_index].is_enough():
+            # borrow from left sibling
+            left = self.writable(left_index)
+            child.items.insert(0, self.items[left_index])
+            child.n_item += self._weight(self.items[left_index])
+            self.items[left_index] = left.items.pop(-1)
+            left.n_item -= self._weight(self.items[left_index])
+            if left.children:
+                subtree = left.children.pop(-1)
+                child.children.insert(0, subtree)
+                left.n_item -= subtree.n_item
+                child.n_item += subtree.n_item
+            left._offsets = child._offsets = None
+        elif index < len(self.items):  # last child has no right sibling
+            right = self.children[index + 1]
+            if right.is_enough():
+                # borrow from the right sibling
+                right = self.writable(index + 1)
+                child.items.append(self.items[index])
+                child.n_item += self._weight(self.items[index])
+                self.items[index] = right.items.pop(0)
+                right.n_item -= self._weight(self.items[index])
+                if right.children:
+                    subtree = right.children.pop(0)
+                    child.children.append(subtree)
+                    right.n_item -= subtree.n_item
+                    child.n_item += subtree.n_item
+                right._offsets = child._offsets = None
+            else:
+                # merge the right sibling into current child
+                self._merge(index)
+        else:
+            # if no right sibling, it must have a left sibling
+            # because minimum degree >= 2.
+            # merge current child into left sibling
+            self._merge(left_index)
+            return self.children[left_index]
+        return child
+
+    def delete(self, bt_key, item:btree_item=None) -> None or btree_item:
+        start, end = self.items.key_range(bt_key)
+        self._offsets = None  # children may be changed even nothing found
+
+        # leaf node
+        if not self.children:
+            if start < end:
+                if item is None:
+                    self.n_item -= self._weight(self.items[start])
+                    return self.items.pop(start)
+
+                while start < end:
+                    if self.items[start] == item:
+                        self.n_item -= self._weight(item)
+                        return self.items.pop(start)
+                    start += 1
+            return
+
+        index = start
+        while True:
+            # found it in left child?
+            child = self._get_child(index)
+            found = child.delete(bt_key, item)
+            if found:
+                # every node lost 1 item on the path
+                self.n_item -= self._weight(found)
+                return found
+
+            # borrowing or merging may move items, locate the child again
+            index = self.children.index(child)
+            if index >= self.items.key_range_end(bt_key):
+                return  # no more item with bt_key in this subtree
+
+            # found it in items?
+            it = self.items[index]
+            if not item or it == item:
+                self._delete_item(index)
+                return it
+
+            # try next child
+            index += 1
+
+    def _delete_item(self, index: int):
+        # delete items[index] of an internal node
+        it = self.items[index]
+        if self.children[index].is_enough():
+            # replace it with predecessor item
+            self.items[index] = self.writable(index).pop_edge(-1)
+        elif self.children[index + 1].is_enough():
+            # replace it with successor item
+            self.items[index] = self.writable(index + 1).pop_edge(0)
+        else:
+            # merge it, then delete it at the middle of the merged child
+            pos = self.children[index].n_item
+            self._merge(index)
+            self.children[index].delete_at(pos)
+        self._offsets = None
+        self.n_item -= self._weight(it)
+
+    def pop_edge(self, which: int) -> btree_item:
+        '''
+        delete the first (which = 0) or the last (which = -1) item
+        of the subtree, for the predecessor or successor of an item
+        '''
+        self._offsets = None
+        if self.children:
+            child = self._get_child(0 if which == 0 else len(self.items))
+            item = child.pop_edge(which)
+        else:
+            item = self.items.pop(which)
+        self.n_item -= self._weight(item)
+        return item
+
+    def delete_at(self, pos: int) -> btree_item:
+        '''
+        delete the item at position pos of the subtree, the child on the way
+        is made enough like delete(), the positions in this subtree are
+        not changed by it, so it goes down once
+        '''
+        while self.children:
+            offsets = self.offsets()
+            i = bisect_right(offsets, pos)
+            rel = pos - offsets[i - 1] if i else pos
+            child = self.children[i]
+            if rel >= child.n_item:
+                it = self.items[i]
+                self._delete_item(i)
+                return it
+            if child.is_enough():
+                it = self.writable(i).delete_at(rel)
+                self._offsets = None
+                self.n_item -= self._weight(it)
+                return it
+            self._get_child(i)
+            self._offsets = None  # the children are changed, go on at self
+
+        it = self.items.pop(self._leaf_index(pos))
+        self.n_item -= self._weight(it)
+        return it
+
+    def _leaf_index(self, pos: int) -> int:
+        # index of the item at position pos of a leaf node
+        return pos
+
+# slots of btree_node under the properties of btree_page_node
+_items_slot = btree_node.items
+_children_slot = btree_node.children
+_n_item_slot = btree_node.n_item
+
+
+class btree_page_node(btree_node):
+    '''
+    node of btree_file which is saved in a page, see btree_pager.
+    items and children are loaded from the page when they are asked for,
+    the node is dirty if it's changed or used by a write operation
+    '''
+    __slots__ = ('page_id', 'page_refs', '__weakref__')
+
+    def __init__(self,
+                 conf: btree_conf,
+                 items: [btree_item]=None,
+                 children: ['btree_node']=None):
+        self.page_id = None  # allocated by flush()
+        self.page_refs = ()  # page_id of children in the page
+        super().__init__(conf, items, children)
+
+    @classmethod
+    def stub(cls, conf: btree_conf, page_id: int,
+             n_item: int) -> 'btree_page_node':
+        # a node which is not loaded from its page yet
+        node = cls.__new__(cls)
+        node.conf, node.page_id, node.page_refs = conf, page_id, ()
+        _items_slot.__set__(node, None)
+        _children_slot.__set__(node, None)
+        _n_item_slot.__set__(node, n_item)
+        node._offsets = None
+        return node
+
+    def is_loaded(self) -> bool:
+        return _items_slot.__get__(self) is not None
+
+    def unload(self):
+        _items_slot.__set__(self, None)
+        _children_slot.__set__(self, None)
+        self._offsets = None
+
+    @property
+    def items(self):
+        self.conf.pager.touch(self)
+        return _items_slot.__get__(self)
+
+    @items.setter
+    def items(self, items):
+        _items_slot.__set__(self, items)
+        self.conf.pager.mark_dirty(self)
+
+    @property
+    def children(self):
+        self.conf.pager.touch(self)
+        return _children_slot.__get__(self)
+
+    @children.setter
+    def children(self, children):
+        _children_slot.__set__(self, children)
+        self.conf.pager.mark_dirty(self)
+
+    @property
+    def n_item(self):
+        return _n_item_slot.__get__(self)  # known by the parent
+
+    @n_item.setter
+    def n_item(self, n_item):
+        _n_item_slot.__set__(self, n_item)
+        self.conf.pager.mark_dirty(self)
+
+
+class btree_bucket_node(btree_node):
+    '''
+    node of btree_multimap, each item is a btree_bucket, and counts
+    the number of its values in n_item, so len(), index_of(), [] and
+    the other positions are of values. the offsets of a leaf node are
+    the prefix counts of its buckets
+    '''
+    __slots__ = ()
+
+    def _weight(self, item: btree_bucket) -> int:
+        return len(item.values)
+
+    def _leaf_index(self, pos: int) -> int:
+        return bisect_right(self.offsets(), pos)
+
+    def _weights(self, items: [btree_bucket]) -> int:
+        return sum(len(item.values) for item in items)
+
+    def offsets(self) -> [int]:
+        if self._offsets is None:
+            counts = [len(item.values) for item in self.items]
+            if self.children:
+                counts.append(0)  # no item after the last child
+                counts = map(add, counts,
+                             (child.n_item for child in self.children))
+            self._offsets = list(accumulate(counts))
+        return self._offsets
+
+    def getitem(self, pos) -> btree_pair:
+        # the value at pos as btree_pair
+        node = self
+        while True:
+            offsets = node.offsets()
+            i = bisect_right(offsets, pos)
+            if i:
+                pos -= offsets[i - 1]
+            if node.children:
+                child = node.children[i]
+                if pos < child.n_item:
+                    node = child
+                    continue
+                pos -= child.n_item
+            bucket = node.items[i]
+            return btree_pair(bucket.bt_key, bucket.values[pos])
+
+    def rank(self, bt_key, right: bool=False) -> int:
+        pos, node = 0, self
+        while True:
+            if right:
+                index = node.items.key_range_end(bt_key)
+            else:
+                index = node.items.key_range_start(bt_key)
+            if index:
+                pos += node.offsets()[index - 1]
+            if not node.children:
+                return pos
+            node = node.children[index]
+
+
+def _is_sorted(items:[btree_item], item_key=_bt_key) -> bool:
+    keys = list(map(item_key, items))
+    return not any(map(gt, keys, islice(keys, 1, None)))
+
+
+def _sorted_keys(bt_keys) -> list:
+    '''
+    sort bt_keys if they are not sorted, and skip the same keys
+    '''
+    bt_keys = list(bt_keys)
+    if any(map(gt, bt_keys, islice(bt_keys, 1, None))):
+        bt_keys.sort()
+    return [bt_key for i, bt_key in enumerate(bt_keys)
+            if not i or bt_keys[i - 1] < bt_key]
+
+
+def _partition(n_slot: int, t: int, per_node: int) -> [int]:
+    '''
+    split n_slot > 2t slots into parts of [t, 2t] slots, per_node if possible,
+    each part is a node plus a separator on its right side
+    '''
+    n_part = -(-n_slot // per_node)
+    if n_slot // n_part < t:
+        n_part = n_slot // t
+    size, extra = divmod(n_slot, n_part)
+    return [size + 1] * extra + [size] * (n_part - extra)
+
+
+def _join(conf: btree_conf, left: btree_node, h_left: int,
+          middle: btree_item, right: btree_node,
+          h_right: int) -> (btree_node, int):
+    '''
+    join two btrees with an item between them, return the root and height.
+    the shorter one is merged into the node at the same height on the edge
+    of the taller one, then the splits go up like insert(), O(t * height).
+    the nodes on the edge are copied if they don't belong to conf
+    '''
+    if h_left >= h_right:
+        if left.conf is not conf:
+            left = left.copy(conf)
+        path, index, n_added = [left], -1, right.n_item
+    else:
+        if right.conf is not conf:
+            right = right.copy(conf)
+        path, index, n_added = [right], 0, left.n_item
+    n_added += path[0]._weight(middle)
+    for _ in range(abs(h_left - h_right)):
+        path.append(path[-1].writable(index))
+    node = path.pop()
+    if index:
+        left = node
+    else:
+        right = node
+
+    # roots may be poor, so merge them, and split it if it's full,
+    # both halves have t - 1 items at least
+    items = list(left.items)
+    items.append(middle)
+    items += right.items
+    children = left.children + right.children
+    split = None
+    if len(items) > conf.max_degree:
+        n = (len(items) - 1) // 2
+        split = items[n], conf.new_node(items[n + 1:], children[n + 1:])
+        items, children = items[:n], children[:n + 1]
+    node.items = conf.items_class(items)
+    node.children = children
+    node.n_item = node._weights(node.items) \
+        + sum(child.n_item for child in children)
+    node._offsets = None
+
+    for parent in reversed(path):
+        parent.n_item += n_added
+        parent._offsets = None
+        if split:
+            i = len(parent.items) if index else 0
+            parent.items.insert(i, split[0])
+            parent.children.insert(i + 1, split[1])
+            split = parent.split() if parent.is_full() else None
+
+    root, height = path[0] if path else node, max(h_left, h_right)
+    if split:
+        root = conf.new_node([split[0]], [root, split[1]])
+        height += 1
+    return root, height
+
+
+def _split(conf: btree_conf, node: btree_node, height: int, bt_key,
+           right: bool=False) -> (btree_node, int, btree_node, int):
+    '''
+    split the subtree at bt_key into two btrees, return roots and heights,
+    the left one has the items with bt_key less than (or not greater if right)
+    the given one. the nodes out of the path are moved, O(t * height).
+    the nodes on the path are not changed, new ones belong to conf
+    '''
+    items, children = node.items, node.children
+    if right:
+        i = items.key_range_end(bt_key)
+    else:
+        i = items.key_range_start(bt_key)
+    if not children:
+        return conf.new_node(items[:i]), 0, conf.new_node(items[i:]), 0
+
+    def subtree(start, end):
+        # items[start:end] and the children around them
+        if start == end:
+            return children[start], height - 1
+        return (conf.new_node(items[start:end], children[start:end + 1]),
+                height)
+
+    lower, h_lower, upper, h_upper = _split(conf, children[i], height - 1,
+                                            bt_key, right)
+    if i > 0:
+        lower, h_lower = _join(conf, *subtree(0, i - 1), items[i - 1],
+                               lower, h_lower)
+    if i < len(items):
+        upper, h_upper = _join(conf, upper, h_upper, items[i],
+                               *subtree(i + 1, len(items)))
+    return lower, h_lower, upper, h_upper
+
+
+def _pop_first(conf: btree_conf, root: btree_node,
+               height: int) -> (btree_item, btree_node, int):
+    # delete the first item of a btree, return it, the root and height
+    if root.conf is not conf:
+        root = root.copy(conf)
+    item = root.pop_edge(0)
+    if not root.items and root.children:
+        root, height = root.children[0], height - 1
+    return item, root, height
+
+
+# a leaf with less spans than 1/8 of its items deletes them one by one,
+# else it keeps the rest by a bytearray mask, _NOT inverts the mask
+_LEAF_CUT_RATIO = 8
+_NOT = bytes.maketrans(b'\x00\x01', b'\x01\x00')
+
+
+def _remove_spans(conf: btree_conf, node: btree_node, height: int,
+                  spans: [(int, int)], j: int, base: int,
+                  removed: [btree_item]) -> (btree_node, int, int):
+    '''
+    delete the items at sorted, disjoint, non-empty spans [start, end) of
+    positions from spans[j] on, which are in the subtree at position base,
+    append them to removed in order. return the root and height of
+    the rest, its root may be poor, and the index of the first span which
+    is not done in the subtree.
+    each node on the way is visited once. if the children left are enough,
+    they replace the old ones in place, else the node is put together again
+    in one pass: a poor or shorter child is joined to its left neighbor by
+    _join(), and a separator which is deleted between two children is
+    replaced by the first item of the right one. the other children are
+    not changed
+    '''
+    if node.conf is not conf:
+        node = node.copy(conf)
+    items, n_removed, bound = node.items, len(removed), base + node.n_item
+    if not node.children:
+        # spans[j:k] start in the leaf, the first and the last one may be
+        # cut by its edges, the last one goes on if it's cut
+        k = bisect_left(spans, (bound,), j)
+        cuts = spans[j:k]
+        lo, hi = cuts[0]
+        if lo < base:
+            cuts[0] = base, hi
+        lo, hi = cuts[-1]
+        if hi > bound:
+            cuts[-1] = lo, bound
+            k -= 1
+        j = k
+        if len(cuts) * _LEAF_CUT_RATIO < len(items):
+            for lo, hi in cuts:
+                removed += items[lo - base:hi - base]
+            for lo, hi in reversed(cuts):
+                del items[lo - base:hi - base]
+        else:
+            kept = bytearray(b'\x01') * len(items)
+            for lo, hi in cuts:
+                kept[lo - base:hi - base] = bytes(hi - lo)
+            removed.extend(compress(items, kept.translate(_NOT)))
+            node.items = items.compress(kept)
+        node.n_item -= len(removed) - n_removed
+        return node, 0, j
+
+    # cut the spans by the children and separators
+    children, offsets, h_child = node.children, node.offsets(), height - 1
+    pieces, dropped, pos = {}, set(), base
+    while j < len(spans):
+        lo, hi = spans[j]
+        lo = max(lo, pos)
+        if lo >= bound:
+            break
+        i = bisect_right(offsets, lo - base)
+        start = base + offsets[i - 1] if i else base
+        end = base + offsets[i] - 1  # position of items[i]
+        if lo < end:
+            child = children[i]
+            if lo == start and hi >= end:
+                removed.extend(child)
+                pieces[i] = None, 0
+                if hi == end:
+                    j += 1
+            else:
+                piece, h_piece, j = _remove_spans(conf, child, h_child,
+                                                  spans, j, start, removed)
+                pieces[i] = piece, h_piece
+        if i < len(items) and j < len(spans) \
+                and spans[j][0] <= end < spans[j][1]:
+            removed.append(items[i])
+            dropped.add(i)
+            if spans[j][1] == end + 1:
+                j += 1
+        pos = end + 1
+
+    if not dropped and all(piece is not None and h_piece == h_child
+                           and not piece.is_poor()
+                           for piece, h_piece in pieces.values()):
+        for i, (piece, _h_piece) in pieces.items():
+            children[i] = piece
+        node.n_item -= len(removed) - n_removed
+        node._offsets = None
+        return node, height, j
+
+    seps, nodes = conf.items_class(), []  # of the node put together
+    head, h_head = conf.new_node(), 0  # the rest before nodes[0]
+    middle = None  # the item between the rest so far and the next child
+
+    def add(piece: btree_node, h_piece: int):
+        # put a non-empty piece (or an empty leaf) after middle
+        nonlocal seps, head, h_head
+        if nodes:
+            if h_piece == h_child and not piece.is_poor():
+                seps.append(middle)
+                nodes.append(piece)
+                return
+            root, h_root = _join(conf, nodes[-1], h_child, middle,
+                                 piece, h_piece)
+        else:
+            if middle is None:
+                root, h_root = piece, h_piece  # nothing before it
+            else:
+                root, h_root = _join(conf, head, h_head, middle,
+                                     piece, h_piece)
+            if h_root < h_child or h_root == h_child and root.is_poor():
+                head, h_head = root, h_root
+                return
+            head, h_head = conf.new_node(), 0
+            nodes.append(None)
+        if h_root == h_child:
+            nodes[-1] = root
+        else:  # split by _join()
+            nodes[-1:] = root.children
+            seps += root.items
+
+    def step(i: int, piece: btree_node, h_piece: int):
+        # children[i] is replaced by piece, then items[i]
+        nonlocal middle
+        if piece is not None and piece.n_item:
+            if middle is None and (nodes or head.n_item):
+                middle, piece, h_piece = _pop_first(conf, piece, h_piece)
+            if piece.n_item:
+                add(piece, h_piece)
+                middle = None
+        if i < len(items) and i not in dropped:
+            if middle is not None:
+                add(conf.new_node(), 0)  # two items without a child
+            middle = items[i]
+
+    i = 0
+    for k in sorted(pieces.keys() | dropped) + [len(children)]:
+        if i < k:
+            # children[i:k] and items[i:k] are not changed
+            step(i, children[i], h_child)
+            if i + 1 < k:
+                seps.append(middle)
+                seps += items[i + 1:k - 1]
+                nodes += children[i + 1:k]
+                middle = items[k - 1] if k <= len(items) else None
+        if k < len(children):
+            step(k, *pieces.get(k, (children[k], h_child)))
+        i = k + 1
+    if middle is not None:
+        add(conf.new_node(), 0)
+
+    if not nodes:
+        return head, h_head, j
+    if len(nodes) == 1:
+        return nodes[0], h_child, j
+    # pieces are joined in pairs, so there are not more nodes than children
+    return conf.new_node(seps, nodes), height, j
+
+
+def _range_slice(btr: 'btree', lo, hi, inclusive: (bool, bool),
+                 reverse: bool, after, skip: int, n: int) -> [btree_item]:
+    '''
+    the next n items of btr.range() by position, after skip items with
+    bt_key after, which are the last ones of the previous chunk.
+    it sees the changes between the chunks, see _range_resume()
+    '''
+    root = btr.root
+    lo_inclusive, hi_inclusive = inclusive
+    start = 0 if lo is None else root.rank(lo, not lo_inclusive)
+    end = len(btr) if hi is None else root.rank(hi, hi_inclusive)
+    if reverse:
+        if after is not None:
+            end = min(end, max(root.rank(after, True) - skip,
+                               root.rank(after)))
+        start = max(start, end - n)
+    else:
+        if after is not None:
+            start = max(start, min(root.rank(after) + skip,
+                                   root.rank(after, True)))
+        end = min(end, start + n)
+    if start >= end:
+        return []
+    chunk = btr[start:end]
+    if reverse:
+        chunk.reverse()
+    return chunk
+
+
+def _range_resume(chunk: [btree_item], after, skip: int) -> (object, int):
+    # after and skip of the next chunk of _range_slice()
+    bt_key, n_same = chunk[-1].bt_key, 0
+    for item in reversed(chunk):
+        if item.bt_key != bt_key:
+            break
+        n_same += 1
+    if n_same == len(chunk) and after == bt_key:
+        return after, skip + n_same
+    return bt_key, n_same
+
+
+class btree_cache:
+    '''
+    bounded cache of btree.search() results by key, see btree.cache_search().
+    policy 'lru' evicts the least recently used key.
+    policy 'tinylfu' evicts in the same order, but a missed key is admitted
+    only if it's estimated more frequent than the victim by a count-min
+    sketch of the recent accesses, so a scan of cold keys doesn't flush
+    the hot ones. the counters are halved after SAMPLE_RATIO * size accesses.
+    it has its own lock, the readers of concurrent_btree share it
+    '''
+    POLICIES = ('lru', 'tinylfu')
+    SAMPLE_RATIO = 10
+    HALVES = bytes(i >> 1 for i in range(256))  # translate() table
+
+    def __init__(self, size: int, policy: str='lru'):
+        if policy not in self.POLICIES:
+            raise ValueError(f'btree_cache() with unknown policy {policy}')
+        self.size = size
+        self.policy = policy
+        self.entries = OrderedDict()  # key: [btree_item], the LRU is first
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+        if policy == 'tinylfu':
+            # 4 rows of 1-byte counters, at least 4 counters for a key
+            bits = min(max((size * 4 - 1).bit_length(), 4), 30)
+            self.mask = (1 << bits) - 1
+            self.sketch = bytearray(4 << bits)
+            self.n_access = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return (f'btree_cache({self.size}, {self.policy!r}): '
+                f'{len(self.entries)} keys, hits: {self.hits}, '
+                f'misses: {self.misses}')
+
+    def _indexes(self, key) -> (int, int, int, int):
+        # the counters of key in the 4 rows of the sketch, double hashing
+        # with the hash of key and of (key,), they're small ints after mask
+        mask = self.mask
+        h1, h2, width = hash(key) & mask, hash((key,)) & mask | 1, mask + 1
+        return (h1 & mask, (h1 + h2) & mask | width,
+                (h1 + 2 * h2) & mask | 2 * width,
+                (h1 + 3 * h2) & mask | 3 * width)
+
+    def _frequency(self, key) -> int:
+        sketch = self.sketch
+        return min(sketch[i] for i in self._indexes(key))
+
+    def _record(self, key):
+        sketch = self.sketch
+        for i in self._indexes(key):
+            if sketch[i] < 255:
+                sketch[i] += 1
+        self.n_access += 1
+        if self.n_access >= self.SAMPLE_RATIO * self.size:
+            self.sketch = sketch.translate(self.HALVES)
+            self.n_access = 0
+
+    def get(self, key) -> [btree_item]:
+        # the cached items, or None
+        with self.lock:
+            if self.policy == 'tinylfu':
+                self._record(key)
+            items = self.entries.get(key)
+            if items is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return items
+
+    def put(self, key, items: [btree_item]):
+        with self.lock:
+            entries = self.entries
+            if len(entries) >= self.size and key not in entries:
+                victim = next(iter(entries))
+                if self.policy == 'tinylfu' \
+                    and self._frequency(key) <= self._frequency(victim):
+                    return
+                del entries[victim]
+            entries[key] = items
+
+    def discard(self, keys):
+        # drop the results of the keys changed by a write operation
+        with self.lock:
+            pop = self.entries.pop
+            for key in keys:
+                pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def _btree_new(cls: type, min_degree: int, bare: bool, state: dict,
+               key=None, prefix: bool=False):
+    # an empty btree for pickle.loads(), see btree.__reduce__()
+    btr = cls.__new__(cls)
+    btree.__init__(btr, min_degree, bare, key, prefix)
+    btr.__dict__.update(state)
+    return btr
+
+
+class btree:
+    DUMP_INDENT = '    '
+    SAVE_MAGIC = b'BTREESV1'
+    SAVE_CHUNK = 4096  # items pickled at once by save()
+    cache = None  # btree_cache of search(), see cache_search()
+
+    def __init__(self, min_degree: int=None, bare: bool=False, key=None,
+                 prefix: bool=False):
+        '''
+        bare: keep keys and values without btree_kv objects, see btree_pairs
+        key: order items by key(bt_key) like sorted(key=), it's made once
+        when an item is put into a node, and kept in the keys of the node,
+        bt_key of search() and the others are passed through it too.
+        key=btree_encode_key for keys compared as bytes, not with bare
+        prefix: bare mode of str keys, each node keeps the common prefix of
+        its keys once, see btree_prefix_pairs
+        '''
+        if not isinstance(min_degree, int):
+            min_degree = BTREE_MIN_DEGREE_DEFAULT
+        elif min_degree < BTREE_MIN_DEGREE_MIN:
+            min_degree = BTREE_MIN_DEGREE_MIN
+        if key is None:
+            items_class = btree_prefix_pairs if prefix \
+                else btree_pairs if bare else btree_items
+        elif bare or prefix:
+            raise ValueError('btree(key=) with bare or prefix')
+        else:
+            items_class = _keyed_items(key)
+        self.conf = btree_conf(min_degree, items_class)
+        self.height = 0
+        self.root = self.conf.new_node()
+
+    @property
+    def min_degree(self) -> int:
+        return self.conf.min_degree
+
+    @property
+    def key(self):
+        return self.conf.sort_key
+
+    @property
+    def bare(self) -> bool:
+        return self.conf.items_class.kv_class is btree_pair
+
+    def _key(self, bt_key):
+        # the key in the nodes of bt_key, None is no limit of a range
+        sort_key = self.conf.sort_key
+        if sort_key is None or bt_key is None:
+            return bt_key
+        return sort_key(bt_key)
+
+    @classmethod
+    def from_sorted(cls, items:[btree_item], min_degree: int=None,
+                    fill_factor: float=1.0, bare: bool=False,
+                    key=None, prefix: bool=False) -> 'btree':
+        '''
+        build a btree from items already sorted by bt_key in linear time,
+        fill_factor (0, 1] is the ratio of items in each node,
+        1.0 builds a packed btree, smaller one leaves room for insert()
+        '''
+        btr = cls(min_degree, bare=bare, key=key, prefix=prefix)
+        items = list(items)
+        if not _is_sorted(items, btr.conf.items_class.item_key):
+            raise ValueError('btree.from_sorted() with unsorted items')
+        btr._build(items, fill_factor)
+        return btr
+
+    def _build(self, items:[btree_item], fill_factor: float=1.0):
+        '''
+        replace the whole tree with sorted items, bottom-up level by level
+        '''
+        conf = self._writable_conf()
+        t = conf.min_degree
+        max_slot = 2 * t
+        per_node = max(t, min(max_slot, round(max_slot * fill_factor)))
+
+        if len(items) < max_slot:
+            self.root, self.height = conf.new_node(items), 0
+            return
+
+        # leaf nodes: part size = #items + 1 separator,
+        # the last leaf node has no separator on its right side
+        nodes, separators, pos = [], [], 0
+        for size in _partition(len(items) + 1, t, per_node):
+            end = pos + size - 1
+            nodes.append(conf.new_node(items[pos:end]))
+            if end < len(items):
+                separators.append(items[end])
+            pos = end + 1
+
+        # internal nodes: part size = #children
+        height = 1
+        while len(nodes) > max_slot:
+            parents, parent_separators, pos = [], [], 0
+            for size in _partition(len(nodes), t, per_node):
+                end = pos + size
+                parents.append(conf.new_node(separators[pos:end - 1],
+                                             nodes[pos:end]))
+                if end <= len(separators):
+                    parent_separators.append(separators[end - 1])
+                pos = end
+            nodes, separators = parents, parent_separators
+            height += 1
+
+        self.root, self.height = conf.new_node(separators, nodes), height
+
+    # called by len(btree)
+    def __len__(self):
+        return self.root.__len__()
+
+    # like = sequence[index], get the item at index
+    def __getitem__(self, index):
+        return self.root.__getitem__(index)
+
+    # like del sequence[index], delete the item at index
+    def __delitem__(self, index) -> btree_item:
+        n_item = len(self)
+        if not -n_item <= index < n_item:
+            raise IndexError('btree index out of range')
+        removed = self._writable_root().delete_at(index % n_item)
+        self._lower_root()
+        self._invalidate((self._key(removed.bt_key),))
+        return removed
+
+    # like sequence += [items], in-place add/extend items into btree
+    def __iadd__(self, items:[btree_item]):
+        batch = []
+        for item in items:
+            if item is None:
+                pass  # skip None
+            elif isinstance(item, (btree_item, btree_pair)):
+                batch.append(item)
+            else:
+                raise RuntimeError(f'btree.__iadd__({item}) with invalid item')
+
+        self.insert_many(batch)
+        return self
+
+    extend = __iadd__
+
+    # support: for item in btree
+    def __iter__(self):
+        return self.root.__iter__()
+
+    # support: for item in reversed(btree)
+    def __reversed__(self):
+        return self.root.__reversed__()
+
+    # support: item in btree, or bt_key in btree
+    def __contains__(self, item) -> bool:
+        if isinstance(item, (btree_item, btree_pair)):
+            # only the items with the same bt_key
+            for it in self.range(item.bt_key, item.bt_key):
+                if it == item:
+                    return True
+            return False
+        return self.root.has_key(self._key(item))
+
+    def has_key(self, bt_key) -> bool:
+        return self.root.has_key(self._key(bt_key))
+
+    def n_node(self):
+        return self.root.get_n_node()
+
+    def dump(self):
+        pass
+
+    def traverse(self, callback=None, cb_data=None):
+        '''
+        callback should take three arguments:
+            def traverse_callback(path, item: btree_item, cb_data)
+        if something returned by traverse_callback, tests to be True,
+        then traverse will be terminated, and return with it.
+
+        if callback is None, dump the whole b-tree.
+        '''
+        if not callable(callback):
+
+            def callback(path: [int], item: btree_item, _cb_data):
+                # lead item marks with "*"
+                depth, lead = len(path) - 1, ' ' if path[-1] else '*'
+                print(self.DUMP_INDENT * depth + f'{lead}{item}')
+
+        return self.root.traverse([], callback, cb_data)
+
+    def search(self, bt_key) -> [btree_item]:
+        key = self._key(bt_key)
+        cache = self.cache
+        if cache is None:
+            items = []
+            self.root.search(items, key)
+            return items
+
+        items = cache.get(key)
+        if items is None:
+            items = []
+            self.root.search(items, key)
+            cache.put(key, items)
+        return items[:]  # the cached list is never given out
+
+    def cache_search(self, size: int=1024, policy: str='lru'):
+        '''
+        cache the results of search() for up to size keys, 0 turns it off.
+        policy is 'lru' or 'tinylfu', see btree_cache, bt_key must be
+        hashable. the keys changed by a write are dropped from the cache,
+        and all of them by delete_range(), split_at() and join().
+        the hit and miss counters are btree.cache.hits and misses
+        '''
+        self.cache = btree_cache(size, policy) if size > 0 else None
+
+    def _invalidate(self, keys=None):
+        # drop the cached search() results of keys, or all of them
+        cache = self.cache
+        if cache is not None:
+            if keys is None:
+                cache.clear()
+            else:
+                cache.discard(keys)
+
+    def search_many(self, bt_keys):
+        '''
+        generate (bt_key, [btree_item]) for each distinct bt_key in order,
+        the btree is walked once for all of them, it's much faster than
+        search() them one by one. dict(search_many(bt_keys)) for a lookup
+        '''
+        if self.conf.sort_key is None:
+            return self.root.search_many(_sorted_keys(bt_keys))
+        # the first bt_key of each key(bt_key) is given back
+        originals = {}
+        for bt_key in bt_keys:
+            originals.setdefault(self._key(bt_key), bt_key)
+        return ((originals[key], items) for key, items in
+                self.root.search_many(_sorted_keys(originals)))
+
+    def index_of(self, bt_key) -> int:
+        '''
+        return the number of items which bt_key is less than the given one,
+        it's the index of the first item with bt_key if there is any
+        '''
+        return self.root.rank(self._key(bt_key))
+
+    def count(self, bt_key) -> int:
+        '''
+        return the number of items with bt_key, without search() them out
+        '''
+        key = self._key(bt_key)
+        return self.root.rank(key, True) - self.root.rank(key)
+
+    def count_range(self, lo=None, hi=None, inclusive=(True, False)) -> int:
+        '''
+        return the number of items with lo <= bt_key < hi by default,
+        the arguments are the same as range()
+        '''
+        if isinstance(inclusive, bool):
+            inclusive = (inclusive, inclusive)
+        lo_inclusive, hi_inclusive = inclusive
+        lo, hi = self._key(lo), self._key(hi)
+
+        start = 0 if lo is None else self.root.rank(lo, not lo_inclusive)
+        end = len(self) if hi is None else self.root.rank(hi, hi_inclusive)
+        return max(end - start, 0)
+
+    def range(self, lo=None, hi=None, inclusive=(True, True),
+              reverse: bool=False):
+        '''
+        generate items with lo <= bt_key <= hi in order lazily,
+        inclusive may be a bool or a tuple of bool for (lo, hi),
+        lo or hi None means no limit at that side
+        '''
+        if isinstance(inclusive, bool):
+            inclusive = (inclusive, inclusive)
+        lo_inclusive, hi_inclusive = inclusive
+        if self.conf.sort_key is not None:
+            # counted instead of making keys of the items again
+            n = self.count_range(lo, hi, inclusive)
+            lo, hi = self._key(lo), self._key(hi)
+            if reverse:
+                path = self.root.seek(hi, hi is None or hi_inclusive)
+            else:
+                path = self.root.seek(lo, lo is not None and not lo_inclusive)
+            yield from islice(btree_node.walk(path, reverse), n)
+            return
+
+        if reverse:
+            path = self.root.seek(hi, hi is None or hi_inclusive)
+            for item in btree_node.walk(path, True):
+                if lo is not None and (
+                    item.bt_key < lo if lo_inclusive
+                    else not item.bt_key > lo):
+                    return
+                yield item
+        else:
+            path = self.root.seek(lo, lo is not None and not lo_inclusive)
+            for item in btree_node.walk(path):
+                if hi is not None and (
+                    item.bt_key > hi if hi_inclusive
+                    else not item.bt_key < hi):
+                    return
+                yield item
+
+    def prefix_scan(self, prefix):
+        '''
+        generate items which bt_key starts with prefix in order lazily,
+        it goes down to the first one like range(prefix), and stops at
+        the first bt_key out of the prefix. for str or bytes bt_key
+        '''
+        if self.conf.sort_key is not None:
+            raise ValueError('btree.prefix_scan() with key')
+        for item in btree_node.walk(self.root.seek(prefix)):
+            if not item.bt_key.startswith(prefix):
+                return
+            yield item
+
+    def insert(self, item:btree_item):
+        key = self.conf.items_class.item_key(item)
+        self._invalidate((key,))
+        if self._writable_root().insert(key, item):
+            middle, right = self.root.split()
+            self.root = self.conf.new_node([middle], [self.root, right])
+            self.height += 1
+
+    # like sequence.appends(item), add item into btree
+    append = insert
+
+    def insert_many(self, items:[btree_item]):
+        '''
+        insert a batch of items, each node on the way is visited once,
+        and split once after all of its items are inserted.
+        items not less than the btree are merged and rebuilt at once
+        '''
+        item_key = self.conf.items_class.item_key
+        items = sorted(items, key=item_key)  # stable, FIFO for the same key
+        self._invalidate(map(item_key, items))
+        self._writable_conf()
+        if len(items) >= len(self):
+            # existing items go first for the same bt_key (FIFO)
+            if len(self):
+                items = list(heapq.merge(self.root, items, key=item_key))
+            self._build(items)
+            return
+        if items and not item_key(items[0]) < item_key(self[-1]):
+            # appended to the end, build them and join at the right side
+            tail = self._subtree(self.conf.new_node(), 0)
+            tail._build(items[1:])
+            self.root, self.height = _join(self.conf, self.root, self.height,
+                                           items[0], tail.root, tail.height)
+            return
+
+        self._writable_root().insert_many(items)
+        while self.root.is_full():
+            splits = self.root.split_many()
+            self.root = self.conf.new_node(
+                [middle for middle, _right in splits],
+                [self.root] + [r for _m, r in splits])
+            self.height += 1
+
+    def insert_kv(self, bt_key, value) -> btree_kv:
+        kv = self.conf.items_class.kv_class(bt_key, value)
+        self.insert(kv)
+        return kv
+
+    def delete(self, bt_key, item:btree_item=None) -> None or btree_item:
+        if item is not None:
+            if isinstance(item, (btree_item, btree_pair)):
+                bt_key = item.bt_key  # avoid consistent issue
+
+            # the position of item among the items with its bt_key,
+            # it's found without changing the nodes, then deleted by it
+            key = self._key(bt_key)
+            start = self.root.rank(key)
+            n_same = self.root.rank(key, True) - start
+            for i, it in enumerate(islice(
+                    btree_node.walk(self.root.seek(key)), n_same)):
+                if it == item:
+                    removed = self._writable_root().delete_at(start + i)
+                    break
+            else:
+                return None
+        else:
+            key = self._key(bt_key)
+            removed = self._writable_root().delete(key)
+        if removed is not None:
+            self._invalidate((key,))
+
+        # tree may be changed even nothing's removed
+        self._lower_root()
+        return removed
+
+    def _lower_root(self):
+        # the root without items is replaced by its only child
+        if not self.root.items and self.root.children:
+            self.height -= 1
+            self.root = self.root.children[0]
+
+    def delete_all(self, bt_key) -> [btree_item]:
+        key = self._key(bt_key)
+        self._invalidate((key,))
+        return self._delete_spans([(self.root.rank(key),
+                                    self.root.rank(key, True))])
+
+    def delete_many(self, bt_keys) -> [btree_item]:
+        '''
+        delete all items with any of bt_keys, return them in order
+        '''
+        keys = _sorted_keys(map(self._key, bt_keys))
+        self._invalidate(keys)
+        return self._delete_spans(self.root.rank_many(keys))
+
+    def delete_range(self, lo=None, hi=None,
+                     inclusive=(True, False)) -> 'btree':
+        '''
+        delete items with lo <= bt_key < hi by default in O(log n),
+        return them as a btree, the arguments are the same as count_range()
+        '''
+        if isinstance(inclusive, bool):
+            inclusive = (inclusive, inclusive)
+        lo_inclusive, hi_inclusive = inclusive
+        lo, hi = self._key(lo), self._key(hi)
+
+        self._invalidate()
+        self._writable_conf()
+        removed = self._subtree(self.root, self.height)
+        upper = self._subtree(self.conf.new_node(), 0)
+        if lo is not None:
+            self.root, self.height, removed.root, removed.height = _split(
+                self.conf, self.root, self.height, lo, not lo_inclusive)
+        else:
+            self.root, self.height = self.conf.new_node(), 0
+        if hi is not None:
+            removed.root, removed.height, upper.root, upper.height = _split(
+                self.conf, removed.root, removed.height, hi, hi_inclusive)
+        self.join(upper)
+        return removed
+
+    def split_at(self, bt_key, right: bool=False) -> ('btree', 'btree'):
+        '''
+        split the btree into two btrees at bt_key in O(log n), the first one
+        has the items with bt_key less than (or not greater if right)
+        the given one, the second one has the rest.
+        nodes are moved to them, and this btree is left empty
+        '''
+        self._invalidate()
+        lower, h_lower, upper, h_upper = _split(
+            self._writable_conf(), self.root, self.height, self._key(bt_key),
+            right)
+        self.root, self.height = self.conf.new_node(), 0
+        return self._subtree(lower, h_lower), self._subtree(upper, h_upper)
+
+    def join(self, other: 'btree'):
+        '''
+        move all items of the other btree to the end of this one in O(log n),
+        its bt_key must not be less than the ones of this btree,
+        and the other btree is left empty
+        '''
+        if (other.min_degree, other.conf.items_class) \
+            != (self.min_degree, self.conf.items_class):
+            raise ValueError('btree.join() with different kind of btree')
+        if not len(other):
+            return
+        item_key = self.conf.items_class.item_key
+        if len(self) and item_key(self[-1]) > item_key(other[0]):
+            raise ValueError('btree.join() with overlapped bt_key')
+
+        # the first item of other btree goes between them
+        self._invalidate()
+        other._invalidate()
+        middle = other.delete(other[0].bt_key)
+        self.root, self.height = _join(self._writable_conf(), self.root,
+                                       self.height, middle,
+                                       other.root, other.height)
+        other.root, other.height = other.conf.new_node(), 0
+
+    def _writable_conf(self) -> btree_conf:
+        '''
+        called before a change, a conf frozen by snapshot() is replaced,
+        so that its nodes are copied before they are changed.
+        a conf may be shared by btrees from split_at(), they all do the same
+        '''
+        conf = self.conf
+        if conf.frozen:
+            self.conf = btree_conf(conf.min_degree, conf.items_class,
+                                   conf.pager)
+        self.conf.version += 1
+        return self.conf
+
+    def _writable_root(self) -> btree_node:
+        # copy-on-write of the root, see btree_node.writable()
+        conf = self._writable_conf()
+        if self.root.conf is not conf:
+            self.root = self.root.copy(conf)
+        return self.root
+
+    def cursor(self) -> 'btree_cursor':
+        '''
+        return a cursor before the first item, see btree_cursor
+        '''
+        return btree_cursor(self)
+
+    def snapshot(self) -> 'btree_view':
+        '''
+        return a read-only view of the btree at this time in O(1),
+        it shares all the nodes with the btree, which copies the nodes
+        on the path of each change from then on instead of changing them.
+        so a long scan of the view sees no change while the btree is written
+        '''
+        self.conf.frozen = True
+        return btree_view(self)
+
+    def _subtree(self, root: btree_node, height: int) -> 'btree':
+        # a btree of the same class and settings with root
+        btr = self.__class__.__new__(self.__class__)
+        btr.__dict__.update(self.__dict__)
+        btr.__dict__.pop('cache', None)  # the cache isn't shared
+        btr.root, btr.height = root, height
+        return btr
+
+    def save_snapshot(self, path: str):
+        '''
+        save the items into a file for open_snapshot(), see btree_snapshot
+        '''
+        if self.conf.sort_key is not None:
+            raise TypeError('btree.save_snapshot() is not supported with key'
+                            ', the snapshot is searched by bt_key itself')
+        btree_snapshot.save(path, self, self.bare)
+
+    @staticmethod
+    def open_snapshot(path: str) -> 'btree_snapshot':
+        return btree_snapshot(path)
+
+    def __reduce__(self):
+        '''
+        pickled as min_degree and a flat stream of items in order instead
+        of the nodes, pickle.loads() adds them back by extend() in batches
+        which are built and joined at the right side, see insert_many()
+        '''
+        state = {key: value for key, value in self.__dict__.items()
+                 if key not in ('conf', 'root', 'height', 'cache')}
+        return (_btree_new,
+                (self.__class__, self.min_degree, self.bare, state, self.key,
+                 self.conf.items_class is btree_prefix_pairs),
+                None, iter(self))
+
+    def save(self, file):
+        '''
+        write the btree into a binary file object for load(),
+        the items are pickled in chunks of SAVE_CHUNK, not copied at once,
+        key is pickled by reference, it must be a module level function
+        '''
+        header = (self.SAVE_MAGIC, self.min_degree, self.bare)
+        prefix = self.conf.items_class is btree_prefix_pairs
+        if self.key is not None or prefix:
+            header += (self.key, prefix)
+        pickle.dump(header, file)
+        items = iter(self)
+        while True:
+            chunk = list(islice(items, self.SAVE_CHUNK))
+            pickle.dump(chunk, file, pickle.HIGHEST_PROTOCOL)
+            if not chunk:
+                break  # an empty chunk at the end
+
+    @staticmethod
+    def load(file) -> 'btree':
+        '''
+        read a btree written by save(), chunk by chunk
+        '''
+        magic, min_degree, bare, *options = pickle.load(file)  # key, prefix
+        if magic == btree_multimap.SAVE_MAGIC:
+            btr = btree_multimap(min_degree)
+        elif magic != btree.SAVE_MAGIC:
+            raise ValueError('btree.load() from a file not written by save()')
+        else:
+            btr = btree(min_degree, bare, *options)
+        while True:
+            chunk = pickle.load(file)
+            if not chunk:
+                return btr
+            btr.insert_many(chunk)
+
+    def _delete_spans(self, spans: [(int, int)]) -> [btree_item]:
+        '''
+        delete items in sorted, disjoint spans [start, end) of positions
+        in one pass down the btree, see _remove_spans()
+        '''
+        spans = [(start, end) for start, end in spans if start < end]
+        removed = []
+        if spans:
+            self.root, self.height, _j = _remove_spans(
+                self._writable_conf(), self.root, self.height, spans, 0, 0,
+                removed)
+        return removed
+
+
+class btree_view(btree):
+    '''
+    read-only btree returned by btree.snapshot(), the nodes are shared with
+    the btree, they are never changed since they belong to the old conf
+    '''
+
+    def __init__(self, btr: btree):
+        self.conf, self.root, self.height = btr.conf, btr.root, btr.height
+
+    def _read_only(self, *_args, **_kwargs):
+        raise TypeError('btree_view is read-only, see btree.snapshot()')
+
+    insert = append = insert_many = delete = _delete_spans = delete_range \
+        = split_at = join = _writable_conf = _writable_root = _read_only
+
+    def snapshot(self) -> 'btree_view':
+        return self
+
+    def __reduce__(self):
+        # unpickled as a btree, the items are added back by extend()
+        return (_btree_new,
+                (btree, self.min_degree, self.bare, {}, self.key,
+                 self.conf.items_class is btree_prefix_pairs),
+                None, iter(self))
+
+
+class btree_cursor:
+    '''
+    a position between two items of a btree, kept as the path of
+    [node, index] from the root to a leaf like btree_node.seek().
+    seek() goes up the path only until the subtree has the new position,
+    so a key near the last one costs O(log d) instead of O(log n).
+    next() and prev() step over one item, a scan is resumed without
+    going down from the root again. insert_here() and delete_here() work
+    on the leaf of the path, only the nodes split or merged are changed.
+    a write of the btree by other than this cursor moves nodes, then all
+    but seek() raise RuntimeError
+    '''
+
+    def __init__(self, btr: btree, writable: bool=True):
+        self.btr = btr
+        self.writable = writable  # insert_here() and delete_here()
+        self.path = btr.root.seek(None)
+        self._sync()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> btree_item:
+        item = self.next()
+        if item is None:
+            raise StopIteration
+        return item
+
+    def _sync(self):
+        # the path is of this version of the btree
+        self.conf = self.btr.conf
+        self.version = self.conf.version
+
+    def _check(self):
+        conf = self.btr.conf
+        if conf is not self.conf or conf.version != self.version:
+            raise RuntimeError('btree is changed after the cursor moved, '
+                               'seek() it again')
+
+    def _climb(self, key, right: bool) -> int:
+        '''
+        the deepest level of the path whose subtree has the position of key,
+        the subtree is between the nearest items of its ancestors
+        '''
+        path = self.path
+        level = len(path) - 1
+        lower_ok = upper_ok = None  # unknown until an ancestor has the item
+        for m in range(level - 1, -1, -1):
+            node, index = path[m]
+            if lower_ok is None and index:
+                lower = node.items.key_at(index - 1)
+                lower_ok = not key < lower if right else lower < key
+            if upper_ok is None and index < len(node.items):
+                upper = node.items.key_at(index)
+                upper_ok = key < upper if right else not upper < key
+            if lower_ok is False or upper_ok is False:
+                # not in any subtree below this node
+                level, lower_ok, upper_ok = m, None, None
+            elif lower_ok and upper_ok:
+                break
+        return level
+
+    def seek(self, bt_key, right: bool=False) -> btree_item:
+        '''
+        move before the first item which bt_key <= item.bt_key,
+        or bt_key < item.bt_key if right is True, return the item or None.
+        bt_key None stands for the first item, or the end if right is True
+        '''
+        key = self.btr._key(bt_key)
+        conf = self.btr.conf
+        if key is None or conf is not self.conf \
+                or conf.version != self.version:
+            self.path = self.btr.root.seek(key, right)
+            self._sync()
+        else:
+            level = self._climb(key, right)
+            self.path[level:] = self.path[level][0].seek(key, right)
+        return self._item()
+
+    def _neighbor(self, after: bool) -> int:
+        # the level of the item after (or before) the cursor, or None
+        level = len(self.path)
+        for node, index in reversed(self.path):
+            level -= 1
+            if index < len(node.items) if after else index:
+                return level
+        return None
+
+    def _item(self) -> btree_item:
+        leaf, index = self.path[-1]
+        if index < len(leaf.items):
+            return leaf.items[index]
+        level = self._neighbor(True)
+        if level is None:
+            return None
+        node, index = self.path[level]
+        return node.items[index]
+
+    @property
+    def item(self) -> btree_item:
+        # the item after the cursor, which next() returns, or None
+        self._check()
+        return self._item()
+
+    def next(self) -> btree_item:
+        '''
+        move over the item after the cursor and return it, None at the end
+        '''
+        self._check()
+        top = self.path[-1]
+        leaf, index = top
+        if index < len(leaf.items):
+            top[1] = index + 1
+            return leaf.items[index]
+
+        level = self._neighbor(True)
+        if level is None:
+            return None
+        path = self.path
+        node, index = path[level]
+        path[level][1] = index + 1
+        # the first leaf of the next subtree
+        path[level + 1:] = node.children[index + 1].seek(None)
+        return node.items[index]
+
+    def prev(self) -> btree_item:
+        '''
+        move back over the item before the cursor and return it,
+        None at the first item
+        '''
+        self._check()
+        top = self.path[-1]
+        leaf, index = top
+        if index:
+            top[1] = index - 1
+            return leaf.items[index - 1]
+
+        level = self._neighbor(False)
+        if level is None:
+            return None
+        path = self.path
+        node, index = path[level]
+        path[level][1] = index - 1
+        # the end of the last leaf of the previous subtree
+        path[level + 1:] = node.children[index - 1].seek(None, True)
+        return node.items[index - 1]
+
+    def _position(self) -> int:
+        # number of items before the cursor
+        pos = 0
+        for node, index in self.path:
+            if not node.children:
+                pos += index
+            elif index:
+                pos += node.offsets()[index - 1]
+        return pos
+
+    def _seek_position(self, pos: int):
+        # the path to the position, an item of an internal node is at
+        # the end of the last leaf of its left subtree
+        path, node = [], self.btr.root
+        while node.children:
+            offsets = node.offsets()
+            i = bisect_right(offsets, pos)
+            if i:
+                pos -= offsets[i - 1]
+            path.append([node, i])
+            node = node.children[i]
+        path.append([node, pos])
+        self.path = path
+
+    def _writable(self):
+        # copy-on-write of the nodes on the path, see btree_node.writable()
+        if not self.writable:
+            raise TypeError(f'{type(self.btr).__name__}.cursor() is read-only'
+                            f', write the btree by its own methods')
+        path = self.path
+        conf = self.btr._writable_conf()
+        if path[-1][0].conf is conf:
+            return  # the nodes are copied from the root down
+        path[0][0] = node = self.btr._writable_root()
+        for level in range(1, len(path)):
+            node = path[level][0] = node.writable(path[level - 1][1])
+
+    def _between(self, key) -> bool:
+        # key is between the keys of the items around the cursor
+        path = self.path
+        for after in (False, True):
+            level = self._neighbor(after)
+            if level is not None:
+                node, index = path[level]
+                if after and node.items.key_at(index) < key \
+                        or not after and key < node.items.key_at(index - 1):
+                    return False
+        return True
+
+    def insert_here(self, item: btree_item):
+        '''
+        insert item at the cursor, the cursor is before it then,
+        its bt_key must be between the ones of the items around the cursor
+        '''
+        self._check()
+        btr, path = self.btr, self.path
+        key = btr.conf.items_class.item_key(item)
+        if not self._between(key):
+            raise ValueError(f'btree_cursor.insert_here({item}) out of order')
+
+        self._writable()
+        if btr.cache is not None:
+            btr._invalidate((key,))
+        leaf, index = path[-1]
+        leaf.items.insert(index, item, key)
+        for node, _index in path:
+            node.n_item += 1
+            node._offsets = None
+
+        # split the full nodes from the leaf up
+        level = len(path) - 1
+        while path[level][0].is_full():
+            node, index = path[level]
+            middle, right = node.split()
+            n_left = len(node.items)
+            if level:
+                parent, i = path[level - 1]
+                parent.items.insert(i, middle)
+                parent.children.insert(i + 1, right)
+                parent._offsets = None
+            else:
+                btr.root = btr.conf.new_node([middle], [node, right])
+                btr.height += 1
+                path.insert(0, [btr.root, 0])
+                level += 1
+            # an item of the node goes to the middle or to the right,
+            # at the middle the cursor is at the end of the left node
+            if index > n_left:
+                path[level] = [right, index - n_left - 1]
+                path[level - 1][1] += 1
+            level -= 1
+        self._sync()
+
+    def delete_here(self) -> btree_item:
+        '''
+        delete the item after the cursor and return it, None at the end,
+        the cursor is before the next item then
+        '''
+        self._check()
+        btr, path = self.btr, self.path
+        level = self._neighbor(True)
+        if level is None:
+            return None
+        leaf, index = path[-1]
+        if level == len(path) - 1 and (leaf.is_enough() or not level):
+            # a leaf has enough items, or it's the root
+            self._writable()
+            leaf = path[-1][0]
+            item = leaf.items.pop(index)
+            for node, _index in path:
+                node.n_item -= 1
+                node._offsets = None
+        else:
+            # the item of an internal node or a merge, by the position
+            self._writable()
+            pos = self._position()
+            item = btr.root.delete_at(pos)
+            btr._lower_root()
+            self._seek_position(pos)
+        btr._invalidate((btr.conf.items_class.item_key(item),))
+        self._sync()
+        return item
+
+
+class btree_multimap(btree):
+    '''
+    btree of one btree_bucket for each bt_key, which keeps all the values
+    of the key in FIFO order. a hot key with many values is one item
+    in one node, search() and count() go down to it in O(log n), a value is
+    added or deleted in O(log n) plus the deque operation. the nodes count
+    the values, len(), index_of(), count_range() and [] are of values,
+    the values are read out as btree_pair(bt_key, value).
+    split_at(), join() and delete_range() move the buckets, but they are
+    changed in place, so snapshot(), cursor() and cache_search() raise
+    TypeError
+    '''
+    SAVE_MAGIC = b'BTREEMM1'  # read back by btree.load() as btree_multimap
+
+    def __init__(self, min_degree: int=None):
+        super().__init__(min_degree)
+        self.conf = btree_conf(self.min_degree, btree_buckets)
+        self.root = self.conf.new_node()
+
+    def _unsupported(self, *_args, **_kwargs):
+        raise TypeError('btree_multimap changes its buckets in place, they '
+                        'can\'t be shared by snapshot(), cursor() or '
+                        'cache_search()')
+
+    snapshot = cache_search = cursor = _unsupported
+
+    def __reduce__(self):
+        return self.__class__, (self.min_degree,), None, iter(self)
+
+    def _find(self, bt_key) -> ([btree_node], btree_bucket):
+        # the nodes from the root down to the bucket of bt_key, and it
+        path, node = [], self.root
+        while True:
+            path.append(node)
+            i = node.items.key_range_start(bt_key)
+            if i < len(node.items) and not bt_key < node.items.keys[i]:
+                return path, node.items[i]
+            if not node.children:
+                return path, None
+            node = node.children[i]
+
+    @staticmethod
+    def _count(path: [btree_node], n: int):
+        # n values are added to a bucket of the last node of path
+        for node in path:
+            node.n_item += n
+            node._offsets = None
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self.root[index]
+        start, stop, step = index.indices(len(self))
+        count = len(range(start, stop, step))
+        if not count:
+            return []
+        if step > 4 or step < -4:
+            # far away from each other, get them one by one
+            return [self.root.getitem(i) for i in range(start, stop, step)]
+
+        # go down to the bucket at start once, then walk through the buckets
+        bt_key = self.root.getitem(start).bt_key
+        skip = start - self.root.rank(bt_key)
+        if step > 0:
+            pairs = self.range(bt_key)
+        else:
+            pairs = self.range(None, bt_key, reverse=True)
+            skip = self.count(bt_key) - 1 - skip
+            step = -step
+        return list(islice(pairs, skip, skip + (count - 1) * step + 1, step))
+
+    def __iter__(self):
+        for bucket in self.root:
+            for value in bucket.values:
+                yield btree_pair(bucket.bt_key, value)
+
+    def __reversed__(self):
+        for bucket in reversed(self.root):
+            for value in reversed(bucket.values):
+                yield btree_pair(bucket.bt_key, value)
+
+    def __contains__(self, item) -> bool:
+        if isinstance(item, (btree_item, btree_pair)):
+            _path, bucket = self._find(item.bt_key)
+            return bucket is not None and item.value in bucket.values
+        return self.root.has_key(item)
+
+    def search(self, bt_key) -> [btree_pair]:
+        _path, bucket = self._find(bt_key)
+        if bucket is None:
+            return []
+        return [btree_pair(bt_key, value) for value in bucket.values]
+
+    def search_many(self, bt_keys):
+        for bt_key, buckets in super().search_many(bt_keys):
+            yield bt_key, [btree_pair(bt_key, value)
+                           for bucket in buckets for value in bucket.values]
+
+    def values(self, bt_key) -> list:
+        '''
+        return the values of bt_key in FIFO order
+        '''
+        _path, bucket = self._find(bt_key)
+        return [] if bucket is None else list(bucket.values)
+
+    def count(self, bt_key) -> int:
+        _path, bucket = self._find(bt_key)
+        return 0 if bucket is None else len(bucket.values)
+
+    def range(self, lo=None, hi=None, inclusive=(True, True),
+              reverse: bool=False):
+        for bucket in super().range(lo, hi, inclusive, reverse):
+            values = reversed(bucket.values) if reverse else bucket.values
+            for value in values:
+                yield btree_pair(bucket.bt_key, value)
+
+    def prefix_scan(self, prefix):
+        for bucket in super().prefix_scan(prefix):
+            for value in bucket.values:
+                yield btree_pair(bucket.bt_key, value)
+
+    def insert(self, item: btree_item):
+        self.insert_kv(item.bt_key, item.value)
+
+    append = insert
+
+    def insert_kv(self, bt_key, value) -> btree_pair:
+        path, bucket = self._find(bt_key)
+        if bucket is None:
+            super().insert(btree_bucket(bt_key, (value,)))
+        else:
+            bucket.values.append(value)
+            self._count(path, 1)
+        return btree_pair(bt_key, value)
+
+    def insert_many(self, items: [btree_item]):
+        '''
+        values of the existing keys are appended to their buckets,
+        the buckets of new keys are inserted as a batch
+        '''
+        buckets = []
+        items = sorted(items, key=_bt_key)  # stable, FIFO for the same key
+        for bt_key, group in groupby(items, _bt_key):
+            path, bucket = self._find(bt_key)
+            values = [item.value for item in group]
+            if bucket is None:
+                buckets.append(btree_bucket(bt_key, values))
+            else:
+                bucket.values += values
+                self._count(path, len(values))
+        super().insert_many(buckets)
+
+    def delete(self, bt_key, item: btree_item=None) -> None or btree_pair:
+        '''
+        delete the first value of bt_key, or the value of item,
+        the bucket goes away with its last value
+        '''
+        if isinstance(item, (btree_item, btree_pair)):
+            bt_key = item.bt_key
+        path, bucket = self._find(bt_key)
+        if bucket is None:
+            return None
+        values = bucket.values
+        if item is None:
+            value = values[0]
+        elif item.value in values:
+            value = item.value
+        else:
+            return None
+        if len(values) == 1:
+            super().delete(bt_key)
+        else:
+            values.remove(value)  # the first one, FIFO
+            self._count(path, -1)
+        return btree_pair(bt_key, value)
+
+    def __delitem__(self, index) -> btree_pair:
+        n_item = len(self)
+        if not -n_item <= index < n_item:
+            raise IndexError('btree index out of range')
+        index %= n_item
+        pair = self.root.getitem(index)
+        path, bucket = self._find(pair.bt_key)
+        if len(bucket.values) == 1:
+            super().delete(pair.bt_key)
+        else:
+            del bucket.values[index - self.root.rank(pair.bt_key)]
+            self._count(path, -1)
+        return pair
+
+    def delete_all(self, bt_key) -> [btree_pair]:
+        bucket = super().delete(bt_key)
+        if bucket is None:
+            return []
+        return [btree_pair(bt_key, value) for value in bucket.values]
+
+    def delete_many(self, bt_keys) -> [btree_pair]:
+        removed = []
+        for bt_key in _sorted_keys(bt_keys):
+            removed += self.delete_all(bt_key)
+        return removed
+
+    def join(self, other: 'btree_multimap'):
+        '''
+        move all values of the other btree_multimap to the end of this one
+        in O(log n), the values of the same bt_key at the both ends go into
+        one bucket, and the other btree is left empty
+        '''
+        if not isinstance(other, btree_multimap) \
+            or other.min_degree != self.min_degree:
+            raise ValueError('btree.join() with different kind of btree')
+        if not len(other):
+            return
+        first = next(iter(other.root))
+        if len(self):
+            last = next(reversed(self.root))
+            if last.bt_key > first.bt_key:
+                raise ValueError('btree.join() with overlapped bt_key')
+            if not last.bt_key < first.bt_key:
+                path, _bucket = self._find(last.bt_key)
+                last.values += btree.delete(other, first.bt_key).values
+                self._count(path, len(first.values))
+                if not len(other):
+                    return
+                first = next(iter(other.root))
+
+        # the first bucket of other btree goes between them
+        middle = btree.delete(other, first.bt_key)
+        self.root, self.height = _join(self._writable_conf(), self.root,
+                                       self.height, middle,
+                                       other.root, other.height)
+        other.root, other.height = other.conf.new_node(), 0
+
+
+class btree_rwlock:
+    '''
+    readers-writer lock: many readers or one writer at the same time,
+    new readers wait for the waiting writers, so writers are not starved.
+    it's reentrant in a thread, and the writer may read, but a reader
+    can't write, it raises RuntimeError instead of deadlock
+    '''
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0  # threads reading
+        self.waiting = 0  # writers waiting
+        self.writer = None  # ident of the writer thread
+        self.writing = 0  # depth of the writer
+        self.local = threading.local()  # depth of the reader thread
+
+    def held(self) -> bool:
+        # held by this thread, for reading or writing
+        return bool(getattr(self.local, 'depth', 0)) \
+            or self.writer == threading.get_ident()
+
+    def acquire_read(self):
+        local = self.local
+        depth = getattr(local, 'depth', 0)
+        if not depth and self.writer != threading.get_ident():
+            with self.cond:
+                while self.writer is not None or self.waiting:
+                    self.cond.wait()
+                self.readers += 1
+        local.depth = depth + 1
+
+    def release_read(self):
+        local = self.local
+        local.depth -= 1
+        if not local.depth and self.writer != threading.get_ident():
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        if self.writer == me:
+            self.writing += 1
+            return
+        if getattr(self.local, 'depth', 0):
+            raise RuntimeError('btree_rwlock: write while reading')
+        with self.cond:
+            self.waiting += 1
+            while self.writer is not None or self.readers:
+                self.cond.wait()
+            self.waiting -= 1
+            self.writer, self.writing = me, 1
+
+    def release_write(self):
+        self.writing -= 1
+        if not self.writing:
+            with self.cond:
+                self.writer = None
+                self.cond.notify_all()
+
+
+class concurrent_btree(btree):
+    '''
+    thread-safe btree with the same API, see btree_rwlock.
+    search(), [], len() and the other reads run at the same time,
+    a write operation waits for them and runs alone.
+    range(), prefix_scan(), iteration, traverse() and search_many() are
+    lazy, they scan a snapshot() without holding the lock, so writers are
+    not blocked, and so does cursor(), it's read-only
+    '''
+
+    def __init__(self, min_degree: int=None, bare: bool=False, key=None,
+                 prefix: bool=False):
+        super().__init__(min_degree, bare, key, prefix)
+        self.lock = btree_rwlock()
+
+    def __reduce__(self):
+        view = self.snapshot()
+        return (self.__class__,
+                (self.min_degree, view.bare, view.key,
+                 view.conf.items_class is btree_prefix_pairs),
+                None, iter(view))
+
+    def _read(self, method, *args):
+        lock = self.lock
+        lock.acquire_read()
+        try:
+            return method(*args)
+        finally:
+            lock.release_read()
+
+    def _write(self, method, *args):
+        lock = self.lock
+        lock.acquire_write()
+        try:
+            return method(*args)
+        finally:
+            lock.release_write()
+
+    def _scan(self, method, *args):
+        # on the btree itself if it's called by a locked operation
+        if self.lock.held():
+            return method(self, *args)
+        return method(self.snapshot(), *args)
+
+    def _subtree(self, root: btree_node, height: int) -> 'btree':
+        btr = super()._subtree(root, height)
+        btr.lock = btree_rwlock()
+        return btr
+
+    def __len__(self):
+        return self._read(super().__len__)
+
+    def __getitem__(self, index):
+        return self._read(super().__getitem__, index)
+
+    def __contains__(self, item) -> bool:
+        return self._read(super().__contains__, item)
+
+    def has_key(self, bt_key) -> bool:
+        return self._read(super().has_key, bt_key)
+
+    def n_node(self):
+        return self._read(super().n_node)
+
+    def search(self, bt_key) -> [btree_item]:
+        return self._read(super().search, bt_key)
+
+    def cache_search(self, size: int=1024, policy: str='lru'):
+        self._write(super().cache_search, size, policy)
+
+    def index_of(self, bt_key) -> int:
+        return self._read(super().index_of, bt_key)
+
+    def count(self, bt_key) -> int:
+        return self._read(super().count, bt_key)
+
+    def count_range(self, lo=None, hi=None, inclusive=(True, False)) -> int:
+        return self._read(super().count_range, lo, hi, inclusive)
+
+    def snapshot(self) -> btree_view:
+        return self._read(super().snapshot)
+
+    def __iter__(self):
+        return self._scan(btree.__iter__)
+
+    def __reversed__(self):
+        return self._scan(btree.__reversed__)
+
+    def traverse(self, callback=None, cb_data=None):
+        return self._scan(btree.traverse, callback, cb_data)
+
+    def search_many(self, bt_keys):
+        return self._scan(btree.search_many, bt_keys)
+
+    def range(self, lo=None, hi=None, inclusive=(True, True),
+              reverse: bool=False):
+        return self._scan(btree.range, lo, hi, inclusive, reverse)
+
+    def prefix_scan(self, prefix):
+        return self._scan(btree.prefix_scan, prefix)
+
+    def cursor(self) -> btree_cursor:
+        return self._scan(btree.cursor)
+
+    def save(self, file):
+        self._scan(btree.save, file)
+
+    def save_snapshot(self, path: str):
+        self._scan(btree.save_snapshot, path)
+
+    def insert(self, item: btree_item):
+        self._write(super().insert, item)
+
+    append = insert
+
+    def insert_many(self, items: [btree_item]):
+        self._write(super().insert_many, items)
+
+    def delete(self, bt_key, item: btree_item=None) -> None or btree_item:
+        return self._write(super().delete, bt_key, item)
+
+    def __delitem__(self, index) -> btree_item:
+        return self._write(super().__delitem__, index)
+
+    def delete_all(self, bt_key) -> [btree_item]:
+        return self._write(super().delete_all, bt_key)
+
+    def delete_many(self, bt_keys) -> [btree_item]:
+        return self._write(super().delete_many, bt_keys)
+
+    def delete_range(self, lo=None, hi=None,
+                     inclusive=(True, False)) -> btree:
+        return self._write(super().delete_range, lo, hi, inclusive)
+
+    def split_at(self, bt_key, right: bool=False) -> (btree, btree):
+        return self._write(super().split_at, bt_key, right)
+
+    def join(self, other: btree):
+        if not isinstance(other, concurrent_btree):
+            self._write(super().join, other)
+            return
+        # other is emptied too, both write locks are taken in the order
+        # of id(), so that a.join(b) and b.join(a) don't deadlock
+        first, second = sorted((self, other), key=id)
+        first._write(second._write, super().join, other)
+
+
+class btree_pager:
+    '''
+    page file of btree_file and the LRU buffer pool of its nodes.
+    page 0 is the header, each node is saved in a page with the page_id
+    and n_item of its children, and its items pickled. a node larger than
+    the page goes on in a chain of overflow pages.
+    the nodes changed or used by a write operation are dirty, they are kept
+    in memory until flush(), the other nodes are dropped in LRU order
+    when there are more than cache_pages nodes loaded.
+    flush() is not atomic, a crash in the middle may break the file
+    '''
+    MAGIC = b'BTREEPG1'
+    HEADER = struct.Struct('<8sIIBQQQQQ')
+    # size of pickled items (0 for a free page), #children, and next free
+    # page, or the overflow page of a node. an overflow page has the size
+    # of its part of the node, no children, and the next overflow page
+    RECORD = struct.Struct('<IIQ')
+    REF = struct.Struct('<QQ')  # page_id and n_item of a child
+    PAGE_ALIGN = 4096
+
+    def __init__(self, path: str, min_degree: int, items_class: type,
+                 cache_pages: int=1024, item_size: int=64):
+        '''
+        page size is derived from min_degree, item_size bytes for each item,
+        a larger node is written into overflow pages.
+        min_degree and the item class of an existing file are read from it
+        '''
+        self.path = path
+        self.cache_pages = max(cache_pages, 1)
+        self.nodes = weakref.WeakValueDictionary()  # page_id: node
+        self.lru = OrderedDict()  # page_id: clean node loaded
+        self.dirty = set()
+        self.writing = 0  # depth of write operations, see btree_file
+
+        if os.path.exists(path) and os.path.getsize(path):
+            self.file = open(path, 'r+b')
+            (magic, self.page_size, min_degree, bare, self.root_id,
+             self.height, self.n_item, self.free_id, self.n_page) = \
+                self.HEADER.unpack(self.file.read(self.HEADER.size))
+            if magic != self.MAGIC:
+                self.file.close()
+                raise ValueError(f'{path} is not a btree file')
+            items_class = btree_pairs if bare else btree_items
+        else:
+            self.file = open(path, 'w+b')
+            page_size = (2 * min_degree) * (item_size + self.REF.size)
+            self.page_size = -(-page_size // self.PAGE_ALIGN) * self.PAGE_ALIGN
+            self.root_id = self.height = self.n_item = self.free_id = 0
+            self.n_page = 1  # the header
+        self.conf = btree_conf(min_degree, items_class, self)
+
+    def open(self) -> (btree_page_node, int):
+        # return the root and height of the btree in the file
+        if not self.root_id:
+            return self.conf.new_node(), 0
+        return self.stub(self.root_id, self.n_item), self.height
+
+    def close(self):
+        self.file.close()
+
+    def stub(self, page_id: int, n_item: int) -> btree_page_node:
+        # only one node for a page
+        node = self.nodes.get(page_id)
+        if node is None:
+            node = btree_page_node.stub(self.conf, page_id, n_item)
+            self.nodes[page_id] = node
+        return node
+
+    def touch(self, node: btree_page_node):
+        if node in self.dirty:
+            return
+        if self.writing:
+            self.mark_dirty(node)
+        elif node.is_loaded():
+            self.lru.move_to_end(node.page_id)
+        else:
+            self.load(node)
+
+    def mark_dirty(self, node: btree_page_node):
+        if node not in self.dirty:
+            if node.page_id is not None:
+                if not node.is_loaded():
+                    self.load(node)  # n_item may be changed before
+                del self.lru[node.page_id]
+            self.dirty.add(node)
+
+    def read(self, page_id: int) -> bytes:
+        self.file.seek(page_id * self.page_size)
+        return self.file.read(self.page_size)
+
+    def write(self, page_id: int, data: bytes):
+        self.file.seek(page_id * self.page_size)
+        self.file.write(data)
+
+    def read_node(self, page_id: int) -> bytes:
+        # the page of a node followed by the parts in its overflow pages
+        data = self.read(page_id)
+        next_id = self.RECORD.unpack_from(data)[2]
+        if not next_id:
+            return data
+        parts = [data]
+        while next_id:
+            data = self.read(next_id)
+            size, _n_child, next_id = self.RECORD.unpack_from(data)
+            parts.append(data[self.RECORD.size:self.RECORD.size + size])
+        return b''.join(parts)
+
+    def write_node(self, page_id: int, refs: bytes, n_child: int,
+                   data: bytes):
+        # the page of a node, and the overflow pages if it's too large
+        room = self.page_size - self.RECORD.size
+        body = refs + data
+        parts = [body[i:i + room] for i in range(room, len(body), room)]
+        next_ids = [self.allocate() for _part in parts] + [0]
+        self.write(page_id, self.RECORD.pack(len(data), n_child, next_ids[0])
+                   + body[:room])
+        for part, part_id, next_id in zip(parts, next_ids, next_ids[1:]):
+            self.write(part_id,
+                       self.RECORD.pack(len(part), 0, next_id) + part)
+
+    def free_overflow(self, page_id: int):
+        # put the overflow pages of the node at page_id into the free list
+        next_id = self.RECORD.unpack_from(self.read(page_id))[2]
+        while next_id:
+            page_id = next_id
+            next_id = self.RECORD.unpack_from(self.read(page_id))[2]
+            self.write(page_id, self.RECORD.pack(0, 0, self.free_id))
+            self.free_id = page_id
+
+    def read_refs(self, data: bytes) -> [(int, int)]:
+        _size, n_child, _next_id = self.RECORD.unpack_from(data)
+        return [self.REF.unpack_from(data, self.RECORD.size + i * self.REF.size)
+                for i in range(n_child)]
+
+    def load(self, node: btree_page_node):
+        data = self.read_node(node.page_id)
+        refs = self.read_refs(data)
+        start = self.RECORD.size + len(refs) * self.REF.size
+        size = self.RECORD.unpack_from(data)[0]
+        items = pickle.loads(data[start:start + size])
+        if self.conf.items_class is btree_pairs:
+            pairs = btree_pairs()
+            pairs.keys, pairs.values = items
+            items = pairs
+        else:
+            items = self.conf.items_class(items)
+
+        _items_slot.__set__(node, items)
+        _children_slot.__set__(node, [self.stub(page_id, n_item)
+                                      for page_id, n_item in refs])
+        node.page_refs = tuple(page_id for page_id, _n_item in refs)
+        self.lru[node.page_id] = node
+        self.evict()
+
+    def evict(self):
+        # drop clean nodes in LRU order, but the last one which is in use
+        while len(self.lru) > 1 \
+                and len(self.lru) + len(self.dirty) > self.cache_pages:
+            _page_id, node = self.lru.popitem(last=False)
+            node.unload()
+
+    def allocate(self) -> int:
+        if self.free_id:
+            page_id = self.free_id
+            self.free_id = self.RECORD.unpack_from(self.read(page_id))[2]
+            return page_id
+        self.n_page += 1
+        return self.n_page - 1
+
+    def free(self, page_id: int):
+        self.free_overflow(page_id)
+        self.write(page_id, self.RECORD.pack(0, 0, self.free_id))
+        self.free_id = page_id
+        node = self.nodes.pop(page_id, None)
+        if node is not None:
+            self.lru.pop(page_id, None)
+            node.page_id = None
+
+    def flush(self, root: btree_page_node, height: int):
+        '''
+        write the dirty nodes of the btree and the header into the file,
+        the pages which are dropped from the btree are freed
+        '''
+        # the parent of a dirty node is dirty, collect them from the root
+        nodes, stack = [], [root] if root in self.dirty else []
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack += (child for child in _children_slot.__get__(node)
+                      if child in self.dirty)
+
+        pickled = []
+        for node in nodes:
+            items = _items_slot.__get__(node)
+            if isinstance(items, btree_pairs):
+                data = pickle.dumps((items.keys, items.values),
+                                    pickle.HIGHEST_PROTOCOL)
+            else:
+                data = pickle.dumps(list(items), pickle.HIGHEST_PROTOCOL)
+            pickled.append(data)
+
+        # pages referred by the dirty nodes before, but not any more,
+        # and their children which are not moved to the other nodes
+        old_refs = {self.root_id}
+        new_refs = {root.page_id}
+        for node in nodes:
+            old_refs.update(node.page_refs)
+            new_refs.update(child.page_id
+                            for child in _children_slot.__get__(node))
+        freed = old_refs - new_refs - {0, None}
+        stack = list(freed)
+        while stack:
+            for page_id, _n_item in self.read_refs(self.read(stack.pop())):
+                if page_id not in new_refs and page_id not in freed:
+                    freed.add(page_id)
+                    stack.append(page_id)
+        for page_id in freed:
+            self.free(page_id)
+
+        for node in nodes:
+            if node.page_id is None:
+                node.page_id = self.allocate()
+                self.nodes[node.page_id] = node
+            else:
+                self.free_overflow(node.page_id)  # it's written again
+        for node, data in zip(nodes, pickled):
+            children = _children_slot.__get__(node)
+            node.page_refs = tuple(child.page_id for child in children)
+            self.write_node(node.page_id, b''.join(
+                self.REF.pack(child.page_id, child.n_item)
+                for child in children), len(children), data)
+            self.lru[node.page_id] = node
+        self.dirty.clear()  # the others are not in the btree
+        self.evict()
+
+        self.root_id, self.height, self.n_item = \
+            root.page_id, height, root.n_item
+        self.file.seek(0)
+        self.file.write(self.HEADER.pack(
+            self.MAGIC, self.page_size, self.conf.min_degree,
+            self.conf.items_class is btree_pairs, self.root_id, self.height,
+            self.n_item, self.free_id, self.n_page))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+
+class btree_file(btree):
+    '''
+    btree saved in a page file by btree_pager, with the same API as btree.
+    it opens the btree in the file, or a new empty one, its nodes are
+    loaded when they are visited. the changes are written to the file
+    by flush() and close(), or after a write operation which leaves
+    more dirty nodes than cache_pages.
+    split_at(), delete_range() return in-memory btrees
+    '''
+
+    def __init__(self, path: str, min_degree: int=None, bare: bool=False,
+                 cache_pages: int=1024, item_size: int=64):
+        if not isinstance(min_degree, int):
+            min_degree = BTREE_FILE_MIN_DEGREE_DEFAULT
+        super().__init__(min_degree, bare)
+        self.pager = btree_pager(path, self.min_degree, self.conf.items_class,
+                                 cache_pages, item_size)
+        self.conf = self.pager.conf
+        self.root, self.height = self.pager.open()
+        if not self.pager.root_id:
+            self.flush()
+
+    @classmethod
+    def from_sorted(cls, path: str, items:[btree_item], min_degree: int=None,
+                    fill_factor: float=1.0, bare: bool=False,
+                    **kwargs) -> 'btree_file':
+        '''
+        replace the btree in the file with the items sorted by bt_key,
+        the other arguments are the same as __init__() and btree.from_sorted()
+        '''
+        btr = cls(path, min_degree, bare, **kwargs)
+        items = list(items)
+        if not _is_sorted(items):
+            raise ValueError('btree.from_sorted() with unsorted items')
+        btr._write(btr._build, items, fill_factor)
+        btr.flush()
+        return btr
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+    def flush(self):
+        self.pager.flush(self.root, self.height)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.pager.close()
+
+    def _write(self, method, *args):
+        # nodes used by the write operation are kept until it's finished
+        pager = self.pager
+        pager.writing += 1
+        try:
+            return method(*args)
+        finally:
+            pager.writing -= 1
+            if not pager.writing and len(pager.dirty) > pager.cache_pages:
+                self.flush()
+
+    def snapshot(self) -> btree_view:
+        # pages are written in place by flush(), they can't be shared
+        raise TypeError('btree_file.snapshot() is not supported, its pages '
+                        'are written in place, use save_snapshot() instead')
+
+    def cursor(self) -> btree_cursor:
+        # the changed pages are known by the write operations, see _write()
+        return btree_cursor(self, writable=False)
+
+    def __reduce__(self):
+        # the pager holds the open file and its page cache
+        raise TypeError('btree_file is not picklable, its nodes are in the '
+                        'page file, pickle btree.from_sorted(btr) instead')
+
+    def _detach(self, btr: btree) -> btree:
+        # copy the items out before their pages are freed by flush()
+        return btree.from_sorted(btr, self.min_degree,
+                                 bare=self.conf.items_class is btree_pairs)
+
+    def insert(self, item:btree_item):
+        self._write(super().insert, item)
+
+    append = insert
+
+    def insert_many(self, items:[btree_item]):
+        self._write(super().insert_many, items)
+
+    def delete(self, bt_key, item:btree_item=None) -> None or btree_item:
+        return self._write(super().delete, bt_key, item)
+
+    def __delitem__(self, index) -> btree_item:
+        return self._write(super().__delitem__, index)
+
+    def delete_all(self, bt_key) -> [btree_item]:
+        return self._write(super().delete_all, bt_key)
+
+    def delete_many(self, bt_keys) -> [btree_item]:
+        return self._write(super().delete_many, bt_keys)
+
+    def delete_range(self, lo=None, hi=None,
+                     inclusive=(True, False)) -> btree:
+        return self._write(lambda: self._detach(
+            super(btree_file, self).delete_range(lo, hi, inclusive)))
+
+    def split_at(self, bt_key, right: bool=False) -> (btree, btree):
+        return self._write(lambda: tuple(map(self._detach, super(
+            btree_file, self).split_at(bt_key, right))))
+
+    def join(self, other: btree):
+
+        def join(other):
+            if other.conf.pager is not self.pager:
+                # copy the items of other btree into this file
+                if other.conf.items_class is not self.conf.items_class:
+                    raise ValueError('btree.join() with different kind of '
+                                     'btree')
+                if len(self) and len(other) \
+                    and self[-1].bt_key > other[0].bt_key:
+                    raise ValueError('btree.join() with overlapped bt_key')
+                copied = self._subtree(self.conf.new_node(), 0)
+                copied._build(list(other.delete_range()))
+                other = copied
+            btree.join(self, other)
+
+        self._write(join, other)
+
+
+def _fsync_dir(path: str):
+    # make a rename in the directory durable, not supported on Windows
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class btree_wal:
+    '''
+    append-only write-ahead log of btree_logged.
+    the header has the generation of the checkpoint which the log follows,
+    each record is (size, crc32) and an op code with its pickled arguments.
+    records are written and synced by group commit:
+        sync='always': write and fsync each record
+        sync='group': write and fsync once for group_size records, or
+            group_delay seconds after the first one is buffered by a flusher
+            thread, the buffered records are lost in a crash before commit()
+        sync='none': write the records as 'group', leave the sync to OS
+    '''
+    MAGIC = b'BTREEWL1'
+    HEADER = struct.Struct('<8sQ')
+    RECORD = struct.Struct('<II')
+    SYNC_POLICIES = ('always', 'group', 'none')
+
+    def __init__(self, path: str, generation: int, sync: str='group',
+                 group_size: int=64, group_delay: float=0.01):
+        if sync not in self.SYNC_POLICIES:
+            raise ValueError(f'btree_wal(sync={sync!r}) is not one of '
+                             f'{self.SYNC_POLICIES}')
+        self.path = path
+        self.sync = sync
+        self.group_size = max(group_size, 1)
+        self.group_delay = group_delay
+        self.buffer = []
+        self.buffered_at = 0.0
+        self.lock = threading.Lock()  # of the buffer and file
+        self.cond = threading.Condition(self.lock)
+        self.flusher = None
+        self.idle = False  # the flusher waits for a record
+
+        self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        header = self.file.read(self.HEADER.size)
+        if len(header) < self.HEADER.size \
+            or self.HEADER.unpack(header) != (self.MAGIC, generation):
+            self.reset(generation)  # the log before the checkpoint
+        self.generation = generation
+
+    def records(self):
+        '''
+        generate (op, args) of the records in the log,
+        a torn record at the end of it is truncated
+        '''
+        self.file.seek(self.HEADER.size)
+        data = self.file.read()
+        pos = 0
+        while pos + self.RECORD.size <= len(data):
+            size, crc = self.RECORD.unpack_from(data, pos)
+            body = data[pos + self.RECORD.size:pos + self.RECORD.size + size]
+            if len(body) < size or zlib.crc32(body) != crc:
+                break
+            yield body[:1], pickle.loads(body[1:])
+            pos += self.RECORD.size + size
+        self.file.truncate(self.HEADER.size + pos)
+        self.file.seek(0, os.SEEK_END)
+
+    def append(self, op: bytes, args: tuple):
+        body = op + pickle.dumps(args, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if not self.buffer:
+                self.buffered_at = time.monotonic()
+                if self.sync != 'always':
+                    self._wake_flusher()
+            self.buffer.append(self.RECORD.pack(len(body), zlib.crc32(body)))
+            self.buffer.append(body)
+            if self.sync == 'always' \
+                or len(self.buffer) >= 2 * self.group_size \
+                    or time.monotonic() - self.buffered_at >= self.group_delay:
+                self._commit(self.sync != 'none')
+
+    def _wake_flusher(self):
+        # the records buffered are committed after group_delay even if
+        # no more record is appended
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self._flush_delayed,
+                                            name=f'btree_wal {self.path}',
+                                            daemon=True)
+            self.flusher.start()
+        elif self.idle:
+            self.cond.notify()
+
+    def _flush_delayed(self):
+        with self.cond:
+            while not self.file.closed:
+                if not self.buffer:
+                    self.idle = True
+                    self.cond.wait()
+                    self.idle = False
+                    continue
+                delay = self.buffered_at + self.group_delay - time.monotonic()
+                if delay > 0:
+                    self.cond.wait(delay)
+                else:
+                    self._commit(self.sync != 'none')
+
+    def commit(self, sync: bool=True):
+        '''
+        write the buffered records, and fsync the log if sync
+        '''
+        with self.lock:
+            self._commit(sync)
+
+    def _commit(self, sync: bool):
+        if self.buffer:
+            self.file.write(b''.join(self.buffer))
+            self.buffer.clear()
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+
+    def size(self) -> int:
+        return self.file.tell()
+
+    def reset(self, generation: int):
+        # truncate the log after a checkpoint of the generation
+        with self.lock:
+            self.buffer.clear()
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.write(self.HEADER.pack(self.MAGIC, generation))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.generation = generation
+
+    def close(self):
+        with self.lock:
+            try:
+                self._commit(self.sync != 'none')
+            finally:
+                self.file.close()
+                self.cond.notify()  # the flusher exits
+        if self.flusher is not None:
+            self.flusher.join()
+
+
+class btree_logged(btree):
+    '''
+    in-memory btree whose changes are logged into path + '.wal' by btree_wal,
+    so that they are durable without saving the whole btree each time.
+    checkpoint() saves the btree into path + '.checkpoint' and truncates
+    the log, it's done when the log is larger than checkpoint_size bytes.
+    the btree is recovered at startup: the last checkpoint is loaded,
+    and the records in the log are replayed onto it.
+    min_degree and bare of the checkpoint are used if there is one.
+    split_at(), delete_range() return in-memory btrees
+    '''
+    # op codes of the records
+    OP_INSERT, OP_INSERT_MANY, OP_DELETE, OP_DELETE_ALL = b'i', b'm', b'd', b'a'
+    OP_DELETE_MANY, OP_DELETE_RANGE, OP_CLEAR = b'n', b'r', b'c'
+    OP_INSERT_KV = b'k'  # bt_key and value of btree_kv or btree_pair
+    CHECKPOINT_MAGIC = b'BTREECP1'
+
+    def __init__(self, path: str, min_degree: int=None, bare: bool=False,
+                 sync: str='group', group_size: int=64,
+                 group_delay: float=0.01, checkpoint_size: int=None):
+        super().__init__(min_degree, bare)
+        self.path = path
+        self.checkpoint_size = checkpoint_size
+        self.depth = 1  # nothing is logged, see _logged()
+
+        generation = 0
+        if os.path.exists(path + '.checkpoint'):
+            with open(path + '.checkpoint', 'rb') as f:
+                magic, generation = pickle.load(f)
+                if magic != self.CHECKPOINT_MAGIC:
+                    raise ValueError(f'{path}.checkpoint is not a btree '
+                                     f'checkpoint')
+                loaded = btree.load(f)
+            self.conf, self.root, self.height = \
+                loaded.conf, loaded.root, loaded.height
+
+        self.wal = btree_wal(path + '.wal', generation, sync, group_size,
+                             group_delay)
+        for op, args in self.wal.records():
+            self._replay(op, args)
+        self.depth = 0
+        if not os.path.exists(path + '.checkpoint'):
+            self.checkpoint()  # save min_degree and bare
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+    def commit(self):
+        '''
+        write and fsync the records buffered by group commit
+        '''
+        self.wal.commit()
+
+    def close(self):
+        self.wal.close()
+
+    def cursor(self) -> btree_cursor:
+        # the changes must be logged as the write operations
+        return btree_cursor(self, writable=False)
+
+    def __reduce__(self):
+        # the log file and its flusher thread can't be copied
+        raise TypeError('btree_logged is not picklable, its changes are '
+                        'logged into its files, pickle its snapshot() instead')
+
+    def _subtree(self, root: btree_node, height: int) -> btree:
+        # split_at() and delete_range() return in-memory btrees,
+        # they don't share the log and checkpoint of this one
+        btr = btree.__new__(btree)
+        btr.conf, btr.root, btr.height = self.conf, root, height
+        return btr
+
+    def checkpoint(self):
+        '''
+        save the btree into a new checkpoint file, then truncate the log.
+        the log is ignored by the generation if it's not truncated in a crash
+        '''
+        self.wal.commit()
+        generation = self.wal.generation + 1
+        path = self.path + '.checkpoint'
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump((self.CHECKPOINT_MAGIC, generation), f)
+            self.save(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        _fsync_dir(path)
+        self.wal.reset(generation)
+
+    def _logged(self, op: bytes, method, *args):
+        # only the outermost write operation is logged, after it's done
+        self.depth += 1
+        try:
+            result = method(*args)
+        finally:
+            self.depth -= 1
+        if not self.depth:
+            self._log(op, args)
+        return result
+
+    def _log(self, op: bytes, args: tuple):
+        self.wal.append(op, args)
+        if self.checkpoint_size and self.wal.size() > self.checkpoint_size:
+            self.checkpoint()
+
+    def _replay(self, op: bytes, args: tuple):
+        if op == self.OP_INSERT_KV:
+            btree.insert(self, self.conf.items_class.kv_class(*args))
+        elif op == self.OP_INSERT:
+            btree.insert(self, *args)
+        elif op == self.OP_INSERT_MANY:
+            btree.insert_many(self, *args)
+        elif op == self.OP_DELETE:
+            pos, = args
+            btree.__delitem__(self, pos)
+        elif op == self.OP_DELETE_ALL:
+            btree.delete_all(self, *args)
+        elif op == self.OP_DELETE_MANY:
+            btree.delete_many(self, *args)
+        elif op == self.OP_DELETE_RANGE:
+            btree.delete_range(self, *args)
+        elif op == self.OP_CLEAR:
+            self.root, self.height = self.conf.new_node(), 0
+        else:
+            raise ValueError(f'{self.wal.path} with unknown op code {op}')
+
+    def insert(self, item:btree_item):
+        if self.depth or type(item) is not self.conf.items_class.kv_class:
+            self._logged(self.OP_INSERT, super().insert, item)
+        else:
+            # a tuple is pickled much faster than btree_kv
+            super().insert(item)
+            self._log(self.OP_INSERT_KV, (item.bt_key, item.value))
+
+    append = insert
+
+    def insert_many(self, items:[btree_item]):
+        self._logged(self.OP_INSERT_MANY, super().insert_many, list(items))
+
+    def delete(self, bt_key, item:btree_item=None) -> None or btree_item:
+        if self.depth:
+            return super().delete(bt_key, item)
+
+        # it's logged by position, the item itself may not be pickled
+        # into the same one
+        if isinstance(item, (btree_item, btree_pair)):
+            bt_key = item.bt_key
+        pos = self.root.rank(bt_key)
+        for it in self.range(bt_key, bt_key):
+            if item is None or it == item:
+                break
+            pos += 1
+        else:
+            return None
+        removed = super().delete(bt_key, item)
+        self._log(self.OP_DELETE, (pos,))
+        return removed
+
+    def __delitem__(self, index) -> btree_item:
+        pos = index + len(self) if index < 0 else index
+        return self._logged(self.OP_DELETE, super().__delitem__, pos)
+
+    def delete_all(self, bt_key) -> [btree_item]:
+        return self._logged(self.OP_DELETE_ALL, super().delete_all, bt_key)
+
+    def delete_many(self, bt_keys) -> [btree_item]:
+        return self._logged(self.OP_DELETE_MANY, super().delete_many,
+                            list(bt_keys))
+
+    def delete_range(self, lo=None, hi=None,
+                     inclusive=(True, False)) -> btree:
+        return self._logged(self.OP_DELETE_RANGE, super().delete_range,
+                            lo, hi, inclusive)
+
+    def split_at(self, bt_key, right: bool=False) -> (btree, btree):
+        return self._logged(self.OP_CLEAR, super().split_at, bt_key, right)
+
+    def join(self, other: btree):
+        # logged as insert_many() of the items moved to the end
+        items = list(other) if not self.depth else None
+        self.depth += 1
+        try:
+            super().join(other)
+        finally:
+            self.depth -= 1
+        if not self.depth:
+            self._log(self.OP_INSERT_MANY, (items,))
+
+
+class btree_snapshot:
+    '''
+    read-only btree memory-mapped from a file saved by btree.save_snapshot().
+    the items are flattened in order: an array of fixed-width keys,
+    the pickled values and an array of their offsets. search(), range(),
+    [] and len() work on the mapped file with binary search, no node
+    is built, so the processes opening it share one copy in page cache.
+    keys must be of one type: int (64 bits), float, str or bytes
+    '''
+    MAGIC = b'BTREESN1'
+    # byteorder, key type, item type, key width, #item, offsets position
+    HEADER = struct.Struct('<8s8sccIQQ')
+    KEY_TYPES = {int: b'q', float: b'd', str: b's', bytes: b'b'}
+    ITEM_PICKLED, ITEM_KV, ITEM_PAIR = b'i', b'k', b'p'
+
+    @classmethod
+    def save(cls, path: str, items:[btree_item], bare: bool=False):
+        '''
+        save items sorted by bt_key, it's written into a temporary file
+        and renamed, so that the file being opened is never changed
+        '''
+        items = list(items)
+        keys = list(map(_bt_key, items))
+        key_types = set(map(type, keys)) or {int}
+        key_type = cls.KEY_TYPES.get(key_types.pop()) \
+            if len(key_types) == 1 else None
+        if key_type is None:
+            raise TypeError('btree snapshot with keys of more than one type, '
+                            'or not int, float, str or bytes')
+        if key_type in b'qd':
+            keys = array(key_type.decode(), keys).tobytes()
+            width = struct.calcsize(key_type.decode())
+        else:
+            if key_type == b's':
+                keys = [key.encode() for key in keys]
+            width = max(map(len, keys), default=0)
+            key_struct = struct.Struct(f'<I{width}s')
+            keys = b''.join(key_struct.pack(len(key), key) for key in keys)
+            width = key_struct.size
+
+        if bare:
+            item_type = cls.ITEM_PAIR
+        elif all(type(item) is btree_kv for item in items):
+            item_type = cls.ITEM_KV
+        else:
+            item_type = cls.ITEM_PICKLED
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(bytes(cls.HEADER.size))
+            f.write(keys)
+            offsets, offset = array('Q', [f.tell()]), f.tell()
+            for item in items:
+                value = item if item_type == cls.ITEM_PICKLED else item.value
+                offset += f.write(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+                offsets.append(offset)
+            f.write(offsets.tobytes())
+            f.seek(0)
+            f.write(cls.HEADER.pack(cls.MAGIC, sys.byteorder.encode(),
+                                    key_type, item_type, width, len(items),
+                                    offset))
+        os.replace(tmp_path, path)
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, byteorder, self.key_type, self.item_type, width, n_item,
+         offsets_pos) = self.HEADER.unpack_from(self.mmap)
+        if magic != self.MAGIC:
+            self.mmap.close()
+            raise ValueError(f'{path} is not a btree snapshot')
+        if byteorder.rstrip(b'\0') != sys.byteorder.encode():
+            self.mmap.close()
+            raise ValueError(f'{path} is saved in {byteorder} byte order')
+
+        view = memoryview(self.mmap)
+        start = self.HEADER.size
+        if self.key_type in b'qd':
+            self.keys = view[start:start + width * n_item].cast(
+                self.key_type.decode())
+        else:
+            self.keys = _snapshot_keys(view[start:start + width * n_item],
+                                       width, n_item, self.key_type == b's')
+        self.offsets = view[offsets_pos:offsets_pos + 8 * (n_item + 1)] \
+            .cast('Q')
+        self.view = view
+
+    def close(self):
+        # views must be released before the mmap is closed
+        for view in (self.keys, self.offsets, self.view):
+            view.release()
+        self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def item(self, i: int) -> btree_item or btree_pair:
+        value = pickle.loads(self.view[self.offsets[i]:self.offsets[i + 1]])
+        if self.item_type == self.ITEM_KV:
+            return btree_kv(self.keys[i], value)
+        if self.item_type == self.ITEM_PAIR:
+            return btree_pair(self.keys[i], value)
+        return value
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(map(self.item, range(len(self))[index]))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('btree snapshot index out of range')
+        return self.item(index)
+
+    def __iter__(self):
+        return map(self.item, range(len(self)))
+
+    def __reversed__(self):
+        return map(self.item, reversed(range(len(self))))
+
+    def __contains__(self, bt_key) -> bool:
+        return self.has_key(bt_key)
+
+    def has_key(self, bt_key) -> bool:
+        i = bisect_left(self.keys, bt_key)
+        return i < len(self) and self.keys[i] == bt_key
+
+    def index_of(self, bt_key) -> int:
+        return bisect_left(self.keys, bt_key)
+
+    def count(self, bt_key) -> int:
+        return bisect_right(self.keys, bt_key) - bisect_left(self.keys, bt_key)
+
+    def search(self, bt_key) -> [btree_item]:
+        return list(map(self.item, range(bisect_left(self.keys, bt_key),
+                                          bisect_right(self.keys, bt_key))))
+
+    def _positions(self, lo, hi, inclusive) -> range:
+        if isinstance(inclusive, bool):
+            inclusive = (inclusive, inclusive)
+        lo_inclusive, hi_inclusive = inclusive
+
+        start = 0 if lo is None else (bisect_left if lo_inclusive
+                                      else bisect_right)(self.keys, lo)
+        end = len(self) if hi is None else (bisect_right if hi_inclusive
+                                            else bisect_left)(self.keys, hi)
+        return range(start, max(start, end))
+
+    def count_range(self, lo=None, hi=None, inclusive=(True, False)) -> int:
+        return len(self._positions(lo, hi, inclusive))
+
+    def range(self, lo=None, hi=None, inclusive=(True, True),
+              reverse: bool=False):
+        '''
+        generate items with lo <= bt_key <= hi in order lazily,
+        the arguments are the same as btree.range()
+        '''
+        positions = self._positions(lo, hi, inclusive)
+        return map(self.item, reversed(positions) if reverse else positions)
+
+
+class _snapshot_keys:
+    '''
+    str or bytes keys of btree_snapshot, a sequence for bisect
+    '''
+    __slots__ = ('view', 'key_struct', 'n_item', 'is_str')
+
+    def __init__(self, view: memoryview, width: int, n_item: int,
+                 is_str: bool):
+        self.view = view
+        self.key_struct = struct.Struct(f'<I{width - 4}s')
+        self.n_item = n_item
+        self.is_str = is_str
+
+    def __len__(self):
+        return self.n_item
+
+    def __getitem__(self, i: int):
+        size, key = self.key_struct.unpack_from(self.view,
+                                                i * self.key_struct.size)
+        return key[:size].decode() if self.is_str else key[:size]
+
+    def release(self):
+        self.view.release()
 
-        left.n_item += right.n_item + 1  # + right's items and 1 item of self
 
-    def _get_child(self, index:int) -> 'btree_node':
+class async_btree:
+    '''
+    asyncio facade of btree, btree_file, btree_logged or btree_snapshot.
+    the operations which may block are run one by one in order by a worker
+    thread, so the event loop goes on with the other coroutines:
+        * all of them on btree_file and btree_snapshot, nodes are on disk
+        * writes on the other btrees, and reads after the pending writes
+    reads of an in-memory btree without pending writes are done at once.
+    range() and "async for" scan a snapshot() of an in-memory btree,
+    and yield to the other coroutines every SCAN_CHUNK items.
+    btree_file is scanned by the worker in chunks, each chunk is sliced
+    by position after the last item of the previous one, it sees the
+    writes done before it
+    '''
+    SCAN_CHUNK = 512  # items scanned at once
+
+    def __init__(self, btr, offload: bool=None):
         '''
-        if child has not enough items (< minimum degree),
-        and delete() remove one more item from it,
-        then its items will be less than minimum degree.
-        therefore, borrow an item and child from left/right sibling,
-        or merge it with left/right sibling, make sure the items are enough.
+        offload: run the reads in the worker too,
+        default for btree_file and btree_snapshot
         '''
-        child = self.children[index]
-        if child.is_enough():
-            return child
+        self.btr = btr
+        self.offload = isinstance(btr, (btree_file, btree_snapshot)) \
+            if offload is None else offload
+        self.executor = ThreadPoolExecutor(1, 'async_btree')
+        self.n_write = 0  # writes submitted and not finished
 
-        left_index = index - 1  # first child has no left sibling
-        if index > 0 and self.children[left_index].is_enough():
-            # borrow from left sibling
-            left = self.children[left_index]
-            child.items.insert(0, self.items[left_index])
-            self.items[left_index] = left.items.pop(-1)
-            if left.children:
-                subtree = left.children.pop(-1)
-                child.children.insert(0, subtree)
-                left.n_item -= subtree.n_item
-                child.n_item += subtree.n_item
-            left.n_item -= 1
-            child.n_item += 1
-        elif index < len(self.items):  # last child has no right sibling
-            right = self.children[index + 1]
-            if right.is_enough():
-                # borrow from the right sibling
-                child.items.append(self.items[index])
-                self.items[index] = right.items.pop(0)
-                if right.children:
-                    subtree = right.children.pop(0)
-                    child.children.append(subtree)
-                    right.n_item -= subtree.n_item
-                    child.n_item += subtree.n_item
-                right.n_item -= 1
-                child.n_item += 1
-            else:
-                # merge the right sibling into current child
-                self._merge(index)
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_exc_info):
+        await self.close()
+
+    async def close(self):
+        '''
+        wait for the pending writes, close the btree if it can be
+        '''
+        close = getattr(self.btr, 'close', None)
+        if callable(close):
+            await self._write(close)
         else:
-            # if no right sibling, it must have a left sibling
-            # because minimum degree >= 2.
-            # merge current child into left sibling
-            self._merge(left_index)
-            return self.children[left_index]
-        return child
+            await self._write(int)  # nothing but wait
+        self.executor.shutdown()
+
+    def _written(self):
+        self.n_write -= 1
+
+    def _write(self, method, *args) -> asyncio.Future:
+        # n_write is decreased after the write is done in the worker,
+        # even if the waiting coroutine is cancelled
+        loop = asyncio.get_running_loop()
+        self.n_write += 1
+        future = self.executor.submit(method, *args)
+        future.add_done_callback(
+            lambda _future: loop.call_soon_threadsafe(self._written))
+        return asyncio.wrap_future(future)
+
+    async def _read(self, method, *args):
+        if self.offload or self.n_write:
+            return await asyncio.wrap_future(
+                self.executor.submit(method, *args))
+        return method(*args)
+
+    async def run(self, method, *args):
+        '''
+        run any other method of the btree in the worker as a write,
+        e.g. await abtr.run(btr.checkpoint)
+        '''
+        return await self._write(method, *args)
 
-    def delete(self, bt_key, item:btree_item=None) -> None or btree_item:
-        start, end = self.items.key_range(bt_key)
+    async def get(self, bt_key) -> [btree_item]:
+        return await self._read(self.btr.search, bt_key)
 
-        # leaf node
-        if not self.children:
-            if start < end:
-                if item is None:
-                    self.n_item -= 1
-                    return self.items.pop(start)
+    search = get
 
-                while start < end:
-                    if self.items[start] == item:
-                        self.n_item -= 1
-                        return self.items.pop(start)
-                    start += 1
-            return
+    async def getitem(self, index):
+        return await self._read(self.btr.__getitem__, index)
 
-        for index in range(start, end):
-            # found it in left child?
-            found = self._get_child(index).delete(bt_key, item)
-            if found:
-                self.n_item -= 1  # every node lost 1 item on the path
-                return found
+    async def len(self) -> int:
+        return await self._read(self.btr.__len__)
 
-            # found it in items?
-            it = self.items[index]
-            if not item or it == item:
+    async def has_key(self, bt_key) -> bool:
+        return await self._read(self.btr.has_key, bt_key)
 
-                def move_out_item(subtree, which):
-                    '''
-                    which = -1, ask for the predecessor item
-                    which = 0, ask for the successor item
-                    '''
-                    node = subtree
-                    while node.children:
-                        node = node.children[which]
-                    neigh = node.items[which]
-                    return subtree.delete(neigh.bt_key, neigh)
-
-                left = self.children[index]
-                if left.is_enough():
-                    # replace it with predecessor item
-                    self.items[index] = move_out_item(left, -1)
-                else:
-                    right = self.children[index + 1]
-                    if right.is_enough():
-                        # replace it with successor item
-                        self.items[index] = move_out_item(right, 0)
-                    else:
-                        # merge it, then delete it
-                        self._merge(index)
-                        left.delete(bt_key, it)
-                self.n_item -= 1
-                return it
+    async def index_of(self, bt_key) -> int:
+        return await self._read(self.btr.index_of, bt_key)
 
-        # try next child
-        found = self._get_child(end).delete(bt_key, item)
-        if found:
-            self.n_item -= 1  # every node lost 1 item on the path
-            return found
+    async def count(self, bt_key) -> int:
+        return await self._read(self.btr.count, bt_key)
 
+    async def count_range(self, lo=None, hi=None,
+                          inclusive=(True, False)) -> int:
+        return await self._read(self.btr.count_range, lo, hi, inclusive)
 
-class btree:
-    DUMP_INDENT = '    '
+    async def insert(self, item: btree_item):
+        await self._write(self.btr.insert, item)
 
-    def __init__(self, min_degree: int=None):
-        if not isinstance(min_degree, int):
-            min_degree = BTREE_MIN_DEGREE_DEFAULT
-        elif min_degree < BTREE_MIN_DEGREE_MIN:
-            min_degree = BTREE_MIN_DEGREE_MIN
-        self.height = 0
-        self.root = btree_node(min_degree)
+    async def insert_kv(self, bt_key, value) -> btree_kv:
+        return await self._write(self.btr.insert_kv, bt_key, value)
 
-    # called by len(btree)
-    def __len__(self):
-        return self.root.__len__()
+    async def insert_many(self, items: [btree_item]):
+        await self._write(self.btr.insert_many, list(items))
 
-    # like = sequence[index], get the item at index
-    def __getitem__(self, index):
-        return self.root.__getitem__(index)
+    async def delete(self, bt_key,
+                     item: btree_item=None) -> None or btree_item:
+        return await self._write(self.btr.delete, bt_key, item)
 
-    # like del sequence[index], delete the item at index
-    def __delitem__(self, index) -> btree_item:
-        self.delete(None, self[index])
+    async def delete_all(self, bt_key) -> [btree_item]:
+        return await self._write(self.btr.delete_all, bt_key)
 
-    # like sequence += [items], in-place add/extend items into btree
-    def __iadd__(self, items:[btree_item]):
-        for item in items:
-            if item is None:
-                pass  # skip None
-            elif isinstance(item, btree_item):
-                self.insert(item)
+    async def delete_many(self, bt_keys) -> [btree_item]:
+        return await self._write(self.btr.delete_many, list(bt_keys))
+
+    async def delete_range(self, lo=None, hi=None,
+                           inclusive=(True, False)) -> btree:
+        return await self._write(self.btr.delete_range, lo, hi, inclusive)
+
+    def __aiter__(self):
+        return self.range()
+
+    async def range(self, lo=None, hi=None, inclusive=(True, True),
+                    reverse: bool=False):
+        '''
+        generate items with lo <= bt_key <= hi in order lazily,
+        the arguments are the same as btree.range()
+        '''
+        if isinstance(inclusive, bool):
+            inclusive = (inclusive, inclusive)
+        n = self.SCAN_CHUNK
+
+        if isinstance(self.btr, btree_file):
+            after, skip = None, 0  # resume after skip items with bt_key after
+            while True:
+                chunk = await self._read(_range_slice, self.btr, lo, hi,
+                                         inclusive, reverse, after, skip, n)
+                for item in chunk:
+                    yield item
+                if len(chunk) < n:
+                    return
+                after, skip = _range_resume(chunk, after, skip)
+
+        btr = self.btr
+        if not isinstance(btr, btree_snapshot):
+            btr = await self._read(btr.snapshot)
+        items = btr.range(lo, hi, inclusive, reverse)
+        while True:
+            if self.offload:
+                chunk = await asyncio.wrap_future(
+                    self.executor.submit(list, islice(items, n)))
             else:
-                RuntimeError(f'btree.__iadd__({item}) with invalid item')
-        return self
+                chunk = list(islice(items, n))
+            for item in chunk:
+                yield item
+            if len(chunk) < n:
+                return
+            if not self.offload:
+                await asyncio.sleep(0)  # let the others run
 
-    extend = __iadd__
 
-    # support: for item in btree
-    def __iter__(self):
-        return self.root.__iter__()
+def _shard_main(conn, min_degree: int, bare: bool):
+    '''
+    worker process of sharded_btree, it owns a btree of a shard,
+    receives (method name, args) and sends back (result, len, exception)
+    '''
+    btr = btree(min_degree, bare=bare)
+    while True:
+        try:
+            name, args = conn.recv()
+        except EOFError:
+            return
+        result = error = None
+        try:
+            if name == 'close':
+                conn.send((None, len(btr), None))
+                return
+            elif name == 'cut':
+                # move about n items at the upper or lower end out,
+                # all items with the same bt_key are on one side
+                n, upper = args
+                bt_key = btr[len(btr) - n if upper else n].bt_key
+                lower, higher = btr.split_at(bt_key)
+                if upper:
+                    btr, result = lower, (bt_key, higher)
+                else:
+                    btr, result = higher, (bt_key, lower)
+                if not len(btr) or not len(result[1]):
+                    btr.join(result[1])  # nothing moved
+                    result = None
+            elif name == 'attach':
+                other, upper = args
+                if upper:
+                    btr.join(other)
+                else:
+                    other.join(btr)
+                    btr = other
+            elif name == 'range':
+                result = _range_slice(btr, *args)
+            else:
+                result = getattr(btr, name)(*args)
+                if hasattr(result, '__next__'):
+                    result = list(result)  # search_many()
+        except Exception as e:
+            error = e
+        conn.send((result, len(btr), error))
 
-    def n_node(self):
-        return self.root.get_n_node()
 
-    def dump(self):
-        pass
+class sharded_btree:
+    '''
+    btree range-partitioned across worker processes, each one owns an
+    ordinary btree of a shard. shards[i] has the items with
+    bounds[i - 1] <= bt_key < bounds[i], so the items with the same bt_key
+    are in one shard, and the shards in order are the items in order.
+    a request is sent to the shard of its bt_key, insert_many() and the other
+    batches are split by bounds and sent to all of their shards at once,
+    so they run in parallel. len() and [] are answered by the number of
+    items in each shard, kept with each reply.
+    it starts with one shard, a shard with more than split_size items is
+    split into an idle worker. once all of them are in use, a shard with
+    more than REBALANCE_RATIO times of the average moves items to the
+    smaller neighbor. items are copied to and from the workers, so they
+    are matched by == in delete(bt_key, item), not by identity
+    '''
+    REBALANCE_RATIO = 2
+    SCAN_CHUNK = 4096  # items read from a shard at once by range()
 
-    def traverse(self, callback=None, cb_data=None):
+    def __init__(self, n_shard: int=None, min_degree: int=None,
+                 bare: bool=False, split_size: int=65536,
+                 mp_context: str=None):
         '''
-        callback should take three arguments:
-            def traverse_callback(path, item: btree_item, cb_data)
-        if something returned by traverse_callback, tests to be True,
-        then traverse will be terminated, and return with it.
+        n_shard: number of worker processes, default os.cpu_count()
+        mp_context: start method of multiprocessing, e.g. 'spawn'
+        '''
+        context = multiprocessing.get_context(mp_context)
+        self.split_size = split_size
+        self.processes, self.idle = [], []
+        for _i in range(max(n_shard or os.cpu_count() or 1, 1)):
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=_shard_main,
+                                      args=(child_conn, min_degree, bare),
+                                      daemon=True)
+            process.start()
+            child_conn.close()
+            self.processes.append(process)
+            self.idle.append(conn)
+        self.shards = [self.idle.pop(0)]  # connections in key order
+        self.counts = [0]  # number of items in each shard
+        self.bounds = []  # the lowest bt_key of shards[1:]
+
+    def __enter__(self):
+        return self
 
-        if callback is None, dump the whole b-tree.
+    def __exit__(self, *_exc_info):
+        self.close()
+
+    def close(self):
+        for conn in self.shards + self.idle:
+            try:
+                conn.send(('close', ()))
+                conn.recv()
+            except (EOFError, OSError):
+                pass
+            conn.close()
+        for process in self.processes:
+            process.join()
+        self.shards, self.counts, self.bounds, self.idle = [], [], [], []
+
+    def _shard_of(self, bt_key) -> int:
+        return bisect_right(self.bounds, bt_key)
+
+    def _call_all(self, calls: [(int, str, tuple)]) -> list:
+        # send all of the requests before the replies, the shards run them
+        # in parallel, the first exception is raised after all replies
+        for i, name, args in calls:
+            self.shards[i].send((name, args))
+        results, error = [], None
+        for i, _name, _args in calls:
+            result, self.counts[i], e = self.shards[i].recv()
+            results.append(result)
+            error = error or e
+        if error:
+            raise error
+        return results
+
+    def _call(self, i: int, name: str, *args):
+        return self._call_all([(i, name, args)])[0]
+
+    def _split_keys(self, bt_keys: list) -> [(int, int, int)]:
+        # (shard, start, end) of sorted bt_keys for each shard
+        parts, start = [], 0
+        for i, bound in enumerate(self.bounds + [None]):
+            end = len(bt_keys) if bound is None \
+                else bisect_left(bt_keys, bound, start)
+            if start < end:
+                parts.append((i, start, end))
+            start = end
+        return parts
+
+    def _rebalance(self, i: int):
         '''
-        if not callable(callback):
+        split shard i into an idle worker if it's larger than split_size,
+        or move items to the smaller neighbor if it's much larger than
+        the average when all workers are in use
+        '''
+        n_item = self.counts[i]
+        if n_item <= self.split_size:
+            return
+        if self.idle:
+            moved = self._call(i, 'cut', n_item // 2, True)
+            if moved:
+                self.shards.insert(i + 1, self.idle.pop(0))
+                self.counts.insert(i + 1, 0)
+                self.bounds.insert(i, moved[0])
+                self._call(i + 1, 'attach', moved[1], True)
+                self._rebalance(i + 1)  # both halves may be still too large
+                self._rebalance(i)
+            return
+        average = sum(self.counts) / len(self.shards)
+        if n_item <= self.REBALANCE_RATIO * average:
+            return
+        neighbors = [j for j in (i - 1, i + 1) if 0 <= j < len(self.shards)]
+        j = min(neighbors, key=self.counts.__getitem__)
+        moved = self._call(i, 'cut', (n_item - self.counts[j]) // 2, j > i)
+        if moved:
+            self.bounds[min(i, j)] = moved[0]
+            self._call(j, 'attach', moved[1], j < i)
 
-            def callback(path: [int], item: btree_item, _cb_data):
-                # lead item marks with "*"
-                depth, lead = len(path) - 1, ' ' if path[-1] else '*'
-                print(self.DUMP_INDENT * depth + f'{lead}{item}')
+    def __len__(self):
+        return sum(self.counts)
 
-        return self.root.traverse([], callback, cb_data)
+    def _offsets(self) -> [int]:
+        return [0] + list(accumulate(self.counts))
 
-    def search(self, bt_key) -> [btree_item]:
+    def __getitem__(self, index):
+        offsets = self._offsets()
+        n_item = offsets[-1]
+        if isinstance(index, int):
+            if index < 0:
+                index += n_item
+            if not 0 <= index < n_item:
+                raise IndexError(f'{index} out of range [0, {n_item})')
+            i = bisect_right(offsets, index) - 1
+            return self._call(i, '__getitem__', index - offsets[i])
+
+        # positions of the slice in each shard, as local slices
+        positions = range(*index.indices(n_item))
+        backward = positions.step < 0
+        if backward:
+            positions = positions[::-1]
+        calls = []
+        for i, count in enumerate(self.counts):
+            start = bisect_left(positions, offsets[i])
+            end = bisect_left(positions, offsets[i] + count)
+            if start < end:
+                local = positions[start:end]
+                calls.append((i, '__getitem__',
+                              (slice(local.start - offsets[i],
+                                     local.stop - offsets[i], local.step),)))
         items = []
-        self.root.search(items, bt_key)
-        return items
+        for part in self._call_all(calls):
+            items += part
+        return items[::-1] if backward else items
 
-    def insert(self, item:btree_item):
-        if self.root.insert(item.bt_key, item):
-            middle, right = self.root.split()
-            self.root = btree_node(right.min_degree,
-                                   [middle], [self.root, right])
-            self.height += 1
+    def __delitem__(self, index) -> btree_item:
+        offsets = self._offsets()
+        if index < 0:
+            index += offsets[-1]
+        if not 0 <= index < offsets[-1]:
+            raise IndexError(f'{index} out of range [0, {offsets[-1]})')
+        i = bisect_right(offsets, index) - 1
+        return self._call(i, '__delitem__', index - offsets[i])
+
+    def __iter__(self):
+        return self.range()
+
+    def __reversed__(self):
+        return self.range(reverse=True)
+
+    def __contains__(self, item) -> bool:
+        if isinstance(item, (btree_item, btree_pair)):
+            return item in self.search(item.bt_key)
+        return self.has_key(item)
+
+    def has_key(self, bt_key) -> bool:
+        return self._call(self._shard_of(bt_key), 'has_key', bt_key)
+
+    def search(self, bt_key) -> [btree_item]:
+        return self._call(self._shard_of(bt_key), 'search', bt_key)
+
+    def search_many(self, bt_keys):
+        '''
+        generate (bt_key, [btree_item]) for each distinct bt_key in order,
+        the shards search their part of bt_keys in parallel
+        '''
+        bt_keys = _sorted_keys(bt_keys)
+        for part in self._call_all([
+                (i, 'search_many', (bt_keys[start:end],))
+                for i, start, end in self._split_keys(bt_keys)]):
+            yield from part
+
+    def index_of(self, bt_key) -> int:
+        i = self._shard_of(bt_key)
+        return sum(self.counts[:i]) + self._call(i, 'index_of', bt_key)
+
+    def count(self, bt_key) -> int:
+        return self._call(self._shard_of(bt_key), 'count', bt_key)
+
+    def count_range(self, lo=None, hi=None, inclusive=(True, False)) -> int:
+        first = 0 if lo is None else self._shard_of(lo)
+        last = len(self.shards) - 1 if hi is None else self._shard_of(hi)
+        return sum(self._call_all([
+            (i, 'count_range', (lo, hi, inclusive))
+            for i in range(first, last + 1)]))
+
+    def range(self, lo=None, hi=None, inclusive=(True, True),
+              reverse: bool=False):
+        '''
+        generate items with lo <= bt_key <= hi in order lazily, shard by
+        shard in chunks of SCAN_CHUNK, the arguments are the same as
+        btree.range(). each chunk resumes by bt_key after the last one,
+        so it's not broken by the changes and rebalance between them
+        '''
+        if isinstance(inclusive, bool):
+            inclusive = (inclusive, inclusive)
+        n = self.SCAN_CHUNK
+        after, skip = None, 0
+        while True:
+            bound = (hi if reverse else lo) if after is None else after
+            if bound is None:
+                i = len(self.shards) - 1 if reverse else 0
+            elif reverse and after is None and not inclusive[1]:
+                i = bisect_left(self.bounds, bound)  # bt_key < hi
+            else:
+                i = self._shard_of(bound)
+            chunk = self._call(i, 'range', lo, hi, inclusive, reverse,
+                               after, skip, n)
+            yield from chunk
+            if len(chunk) == n:
+                after, skip = _range_resume(chunk, after, skip)
+                continue
+
+            # the rest of this shard is done, go on with the next one
+            if reverse:
+                if not i or (lo is not None and lo >= self.bounds[i - 1]):
+                    return
+                hi, inclusive = self.bounds[i - 1], (inclusive[0], False)
+            else:
+                if i == len(self.bounds) \
+                        or (hi is not None and hi < self.bounds[i]):
+                    return
+                lo, inclusive = self.bounds[i], (True, inclusive[1])
+            after, skip = None, 0
+
+    def insert(self, item: btree_item):
+        i = self._shard_of(item.bt_key)
+        self._call(i, 'insert', item)
+        self._rebalance(i)
 
-    # like sequence.appends(item), add item into btree
     append = insert
 
     def insert_kv(self, bt_key, value) -> btree_kv:
-        kv = btree_kv(bt_key, value)
-        self.insert(kv)
+        i = self._shard_of(bt_key)
+        kv = self._call(i, 'insert_kv', bt_key, value)
+        self._rebalance(i)
         return kv
 
-    def delete(self, bt_key, item:btree_item=None) -> None or btree_item:
-        if isinstance(item, btree_item):
-            bt_key = item.bt_key  # avoid consistent issue
-
-        removed = self.root.delete(bt_key, item)
+    def insert_many(self, items: [btree_item]):
+        '''
+        split the items by bounds, the shards insert their parts in parallel
+        '''
+        items = sorted(items, key=_bt_key)  # stable, FIFO for the same key
+        parts = self._split_keys([item.bt_key for item in items])
+        self._call_all([(i, 'insert_many', (items[start:end],))
+                        for i, start, end in parts])
+        for i, _start, _end in reversed(parts):
+            self._rebalance(i)  # from the right, indices are kept
+
+    def __iadd__(self, items: [btree_item]):
+        self.insert_many([item for item in items if item is not None])
+        return self
 
-        # tree may be changed even nothing's removed
-        if not self.root.items and self.root.children:
-            self.height -= 1
-            self.root = self.root.children[0]
+    extend = __iadd__
 
-        return removed
+    def delete(self, bt_key, item: btree_item=None) -> None or btree_item:
+        if isinstance(item, (btree_item, btree_pair)):
+            bt_key = item.bt_key
+        return self._call(self._shard_of(bt_key), 'delete', bt_key, item)
 
     def delete_all(self, bt_key) -> [btree_item]:
-        items = []
-        while True:
-            # item = None, remove the first item by bt_key
-            removed = self.delete(bt_key)
-            if removed is None:
-                break  # no more item with bt_key
+        return self._call(self._shard_of(bt_key), 'delete_all', bt_key)
+
+    def delete_many(self, bt_keys) -> [btree_item]:
+        bt_keys = _sorted_keys(bt_keys)
+        removed = []
+        for part in self._call_all([
+                (i, 'delete_many', (bt_keys[start:end],))
+                for i, start, end in self._split_keys(bt_keys)]):
+            removed += part
+        return removed
 
-            items.append(removed)
-        return items
+    def delete_range(self, lo=None, hi=None,
+                     inclusive=(True, False)) -> btree:
+        '''
+        delete items with lo <= bt_key < hi by default, the shards cut their
+        parts out in parallel, return them joined into one btree
+        '''
+        first = 0 if lo is None else self._shard_of(lo)
+        last = len(self.shards) - 1 if hi is None else self._shard_of(hi)
+        parts = self._call_all([(i, 'delete_range', (lo, hi, inclusive))
+                                for i in range(first, last + 1)])
+        removed = parts[0]
+        for part in parts[1:]:
+            removed.join(part)
+        return removed
 
 
 if "__main__" == __name__:
@@ -639,8 +4656,9 @@ if "__main__" == __name__:
         DEBUG_DELETE = 8
         DEBUG_ALL = 15
 
-        def __init__(self, min_degree: int, dbg_flags=DEBUG_ALL):
-            super().__init__(min_degree)
+        def __init__(self, min_degree: int, dbg_flags=DEBUG_ALL,
+                     bare: bool=False, key=None, prefix: bool=False):
+            super().__init__(min_degree, bare, key, prefix)
             self.dbg_flags = dbg_flags
             self.dump()
 
@@ -680,17 +4698,22 @@ if "__main__" == __name__:
 
             stats = btree_stats()
             height = self.root.check(stats, [])
-            if stats.errors \
-                or height != self.height or stats.size != len(self):
+            # the items found by iteration, and len() counted by them,
+            # the values of the buckets in btree_multimap
+            n_item = sum(1 for _item in self.root)
+            size = sum(map(self.root._weight, self.root))
+            if stats.errors or height != self.height \
+                    or stats.size != n_item or len(self) != size:
                 logger.error(f'height: {height}/{self.height} '
-                             f'size: {stats.size}/{len(self)} '
+                             f'size: {stats.size}/{n_item} '
+                             f'len: {len(self)}/{size} '
                              f'errors: {stats.errors} '
                              f'bt_key range: {stats.min} - {stats.max}')
                 self.dump()
 
         def dump(self):
             if self.dbg_flags & self.DEBUG_DUMP:
-                t = self.root.min_degree
+                t = self.min_degree
                 logger.info(f'B-Tree Order: {2 * t}, '
                             f'minimum degree: {t}, '
                             f'#items/node: {t-1} - {2 * t - 1}, '
@@ -899,4 +4922,1301 @@ if "__main__" == __name__:
     logger.info('remainder items must be primary numbers')
     btr.dump()
 
+    #
+    # test case for bulk loading from sorted items
+    #
+    logger.info('=== from_sorted() and extend() test ===')
+    for min_degree in (2, 3, 5):
+        for fill_factor in (1.0, 0.75, 0.5, 0.1):
+            for size in (0, 1, 3, 4, 9, 10, 11, 50, 333, 1000):
+                items = [btree_kv(i // 3, i) for i in range(size)]
+                btr = btree_debug.from_sorted(items, min_degree, fill_factor)
+                btr.check()
+                if list(btr) != items:
+                    logger.error(f'from_sorted({size}, {min_degree}, '
+                                 f'{fill_factor}) items error')
+    btr = btree_debug.from_sorted([btree_item(i) for i in range(20)], 2)
+    btr.dbg_flags = btree_debug.DEBUG_DUMP
+    btr.dump()
+
+    logger.info('extend() with sorted items merges and rebuilds btree')
+    btr += [btree_kv(i, '+') for i in range(0, 40, 2)]
+    btr.check()
+    btr.dump()
+    btr.extend([btree_kv(i, '-') for i in range(30, 0, -3)])
+    btr.check()
+    btr.dump()
+
+    #
+    # test case for range scan
+    #
+    logger.info('=== range() test ===')
+    items = list(btr)
+    logger.info(f'range(10, 20): {list(btr.range(10, 20))}')
+    logger.info(f'range(10, 20, (False, False), reverse=True): '
+                f'{list(btr.range(10, 20, (False, False), reverse=True))}')
+    for lo in (None, -1, 0, 3, 10, 10.5, 38, 39):
+        for hi in (None, -1, 0, 3, 12, 21, 38, 39):
+            for inclusive in ((True, True), (True, False),
+                              (False, True), (False, False)):
+                expected = [it for it in items
+                            if (lo is None or lo < it.bt_key
+                                or (inclusive[0] and lo == it.bt_key))
+                            and (hi is None or it.bt_key < hi
+                                 or (inclusive[1] and hi == it.bt_key))]
+                if list(btr.range(lo, hi, inclusive)) != expected \
+                    or list(btr.range(lo, hi, inclusive, True)) \
+                        != expected[::-1]:
+                    logger.error(f'range({lo}, {hi}, {inclusive}) error')
+
+    #
+    # test case for positional index and slice
+    #
+    logger.info('=== index and slice test ===')
+    for bt_key in range(0, 40, 5):
+        btr.delete(bt_key)  # offsets of nodes on the path are changed
+    items = list(btr)
+    logger.info(f'btree[-1]: {btr[-1]}, btree[::-7]: {btr[::-7]}')
+    for i in range(-len(items), len(items)):
+        if btr[i] is not items[i]:
+            logger.error(f'btree[{i}] error: {btr[i]} vs. {items[i]}')
+    bounds = (None, -100, -len(items), -7, -1, 0, 1, 7, len(items) - 1,
+              len(items), 100)
+    for start in bounds:
+        for stop in bounds:
+            for step in (None, 1, 2, 5, -1, -3, -6):
+                index = slice(start, stop, step)
+                if btr[index] != items[index]:
+                    logger.error(f'btree[{start}:{stop}:{step}] error')
+
+    logger.info(f'"btree[3] in btr" is {btr[3] in btr}, '
+                f'"btree_item(12) in btr" is {btree_item(12) in btr}, '
+                f'"12 in btr" is {12 in btr}, "13.5 in btr" is {13.5 in btr}')
+    for bt_key in range(-1, 42):
+        if btr.has_key(bt_key) != any(it.bt_key == bt_key for it in items) \
+            or (bt_key in btr) != btr.has_key(bt_key):
+            logger.error(f'has_key({bt_key}) error')
+    for it in items:
+        if it not in btr:
+            logger.error(f'{it} in btree error')
+
+    logger.info(f'search_many([40, 12, -1, 12, 3]): '
+                f'{list(btr.search_many([40, 12, -1, 12, 3]))}')
+    for step in (1, 3, 7):
+        bt_keys = list(range(-1, 42, step)) + [12, 13.5, 26]
+        results = list(btr.search_many(bt_keys))
+        if results != [(bt_key, btr.search(bt_key))
+                       for bt_key in sorted(set(bt_keys))]:
+            logger.error(f'search_many({bt_keys}) error')
+
+    #
+    # test case for rank queries
+    #
+    logger.info('=== index_of(), count() and count_range() test ===')
+    logger.info(f'index_of(12): {btr.index_of(12)}, count(12): {btr.count(12)}'
+                f', count_range(10, 20): {btr.count_range(10, 20)}')
+    for bt_key in range(-1, 42):
+        if btr.index_of(bt_key) != len([it for it in items
+                                        if it.bt_key < bt_key]) \
+            or btr.count(bt_key) != len(btr.search(bt_key)):
+            logger.error(f'index_of/count({bt_key}) error')
+        for hi in (None, bt_key, bt_key + 7):
+            for inclusive in ((True, True), (True, False),
+                              (False, True), (False, False)):
+                count = btr.count_range(bt_key, hi, inclusive)
+                if count != len(list(btr.range(bt_key, hi, inclusive))):
+                    logger.error(f'count_range({bt_key}, {hi}, {inclusive})'
+                                 f' error: {count}')
+
+    #
+    # test case for batched insert and delete
+    #
+    logger.info('=== insert_many(), delete_many() and delete_range() test ===')
+    for min_degree in (2, 3, 5):
+        btr = new_btree(min_degree, btree_debug.DEBUG_NONE)
+        expected = []
+        for n, step in ((40, 7), (15, 11), (120, 13), (3, 1), (400, 37)):
+            batch = [btree_kv((i * step) % 50, (n, i)) for i in range(n)]
+            btr.insert_many(batch)
+            expected = sorted(expected + batch, key=_bt_key)  # stable
+            btr.check()
+            if list(btr) != expected:
+                logger.error(f'insert_many({n}, {step}) error')
+
+        bt_keys = [45, 3, 17, 3, 100, -1, 28]
+        removed = btr.delete_many(bt_keys)
+        if removed != [it for it in expected if it.bt_key in bt_keys]:
+            logger.error(f'delete_many({bt_keys}) error')
+        expected = [it for it in expected if it.bt_key not in bt_keys]
+        for lo, hi, inclusive in ((10, 12, (True, False)),
+                                  (30, 33, (False, True)),
+                                  (48, None, (True, True)),
+                                  (None, 1, (True, True))):
+            ranged = btree_debug.from_sorted(expected, min_degree).range(
+                lo, hi, inclusive)
+            removed = btr.delete_range(lo, hi, inclusive)
+            removed.check()
+            removed = list(removed)
+            if removed != list(ranged):
+                logger.error(f'delete_range({lo}, {hi}, {inclusive}) error')
+            expected = [it for it in expected if it not in removed]
+        btr.check()
+        if list(btr) != expected:
+            logger.error('delete_many() and delete_range() error')
+        btr.delete_many([20])
+        btr.check()
+        if list(btr) != [it for it in expected if it.bt_key != 20]:
+            logger.error('delete_many([20]) error')
+    logger.info(f'{len(btr)} items left: {btr[::40]}')
+
+    # the nodes left by delete_many() are joined again, a snapshot keeps
+    # the old ones
+    from random import Random
+    rand = Random(10)
+    for min_degree in (2, 3, 5):
+        for n in (10, 100, 1000):
+            items = [btree_kv(rand.randrange(n // 2), i) for i in range(n)]
+            items.sort(key=_bt_key)
+            for fill_factor in (0.5, 1.0):
+                btr = btree_debug.from_sorted(items, min_degree, fill_factor)
+                btr.dbg_flags = btree_debug.DEBUG_NONE
+                view = btr.snapshot()
+                bt_keys = set(rand.sample(range(n // 2),
+                                          rand.randrange(n // 2)))
+                if rand.random() < 0.5:
+                    bt_keys |= set(range(rand.randrange(n // 2), n // 2))
+                removed = btr.delete_many(bt_keys)
+                btr.check()
+                if removed != [it for it in items if it.bt_key in bt_keys] \
+                        or list(btr) != [it for it in items
+                                         if it.bt_key not in bt_keys] \
+                        or list(view) != items:
+                    logger.error(f'delete_many() of {len(bt_keys)} keys '
+                                 f'from {n} items error')
+
+    #
+    # test case for split and join
+    #
+    logger.info('=== split_at(), join() and delete_range() test ===')
+    for min_degree in (2, 3, 5):
+        items = [btree_kv(i // 4, i) for i in range(500)]
+        for bt_key in (-1, 0, 3, 17, 60, 124, 125):
+            for right in (False, True):
+                btr = btree_debug.from_sorted(items, min_degree, 0.5)
+                lower, upper = btr.split_at(bt_key, right)
+                lower.check()
+                upper.check()
+                n = (bt_key + right) * 4 if bt_key >= 0 else 0
+                if list(lower) != items[:n] or list(upper) != items[n:] \
+                    or len(btr):
+                    logger.error(f'split_at({bt_key}, {right}) error')
+                lower.join(upper)
+                lower.check()
+                if list(lower) != items or len(upper):
+                    logger.error(f'join() after split_at({bt_key}) error')
+
+        # short btree joins a tall one at both sides
+        for n in (0, 1, 5, 40):
+            btr = btree_debug.from_sorted(items[:n], min_degree)
+            tall = btree_debug.from_sorted(items[n:], min_degree)
+            btr.join(tall)
+            btr.check()
+            tall = btree_debug.from_sorted(items[:-n or None], min_degree)
+            short = btree_debug.from_sorted(items[-n or len(items):],
+                                            min_degree)
+            tall.join(short)
+            tall.check()
+            if list(btr) != items or list(tall) != items:
+                logger.error(f'join() of {n} items error')
+
+    btr = btree_debug.from_sorted(items[:20], 2)
+    btr.dbg_flags = btree_debug.DEBUG_DUMP
+    removed = btr.delete_range(1, 3)
+    logger.info(f'delete_range(1, 3): {list(removed)}')
+    btr.dump()
+    try:
+        btr.join(btree_debug.from_sorted(items[:8], 2))
+        logger.error('join() with overlapped bt_key error')
+    except ValueError as e:
+        logger.info(f'join() with overlapped bt_key: {e}')
+
+    #
+    # test case for btree in a page file
+    #
+    logger.info('=== btree_file test ===')
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'btree.db')
+        for bare in (False, True):
+            for cache_pages in (1, 4, 100):
+                btr = btree_file(path, 2, bare, cache_pages)
+                btr.dbg_flags = btree_debug.DEBUG_NONE
+                expected = []
+                for i in range(300):
+                    bt_key = (i * 37) % 101
+                    btr.insert_kv(bt_key, i)
+                    expected.append((bt_key, i))
+                    if i % 100 == 99:
+                        btr.close()
+                        btr = btree_file(path, cache_pages=cache_pages)
+                        btr.dbg_flags = btree_debug.DEBUG_NONE
+                    if len(btr.pager.lru) > cache_pages:
+                        logger.error(f'btree_file cache {len(btr.pager.lru)}'
+                                     f' > {cache_pages}')
+                for bt_key in range(0, 101, 3):
+                    btr.delete_all(bt_key)
+                removed = btr.delete_range(20, 30)
+                last = btr[-3]
+                del btr[-3]
+                btree_debug.check(btr)
+                btr.close()
+
+                btr = btree_file(path, cache_pages=cache_pages)
+                btr.dbg_flags = btree_debug.DEBUG_NONE
+                btree_debug.check(btr)
+                expected = [kv for kv in sorted(expected) if kv[0] % 3
+                            and kv != (last.bt_key, last.value)]
+                in_range = [kv for kv in expected if 20 <= kv[0] < 30]
+                if [(it.bt_key, it.value) for it in removed] != in_range \
+                    or [(it.bt_key, it.value) for it in btr] \
+                        != [kv for kv in expected if kv not in in_range] \
+                        or btr.conf.items_class \
+                        != (btree_pairs if bare else btree_items):
+                    logger.error(f'btree_file({bare}, {cache_pages}) error')
+                btr.close()
+                os.remove(path)
+
+        btr = btree_file.from_sorted(path, [btree_kv(i, i) for i in range(10)],
+                                     2, cache_pages=2)
+        lower, upper = btr.split_at(5)
+        btr.join(upper)
+        btr.join(btree.from_sorted([btree_kv(20, 20)], 2))
+        logger.info(f'btree_file: {list(btr)}, page size: '
+                    f'{btr.pager.page_size}, pages: {btr.pager.n_page}')
+        for bad in (btr.snapshot, lambda: btr.cursor().delete_here(),
+                    lambda: pickle.dumps(btr)):
+            try:
+                bad()
+                logger.error('btree_file.snapshot(), cursor() or pickle error')
+            except TypeError as e:
+                logger.info(f'btree_file: {e}')
+        btr.close()
+        os.remove(path)
+
+        # a node larger than its page goes on in overflow pages
+        btr = btree_file(path, 2, item_size=16)
+        btr.dbg_flags = btree_debug.DEBUG_NONE
+        for i in range(20):
+            btr.insert_kv(i, str(i) * (i % 4 * 3000))
+        btr.close()
+        n_page = btr.pager.n_page
+        for _ in range(5):
+            btr = btree_file(path)
+            btr.dbg_flags = btree_debug.DEBUG_NONE
+            if [(it.bt_key, it.value) for it in btr] \
+                    != [(i, str(i) * (i % 4 * 3000)) for i in range(20)]:
+                logger.error('btree_file overflow pages error')
+            btr.delete(7)
+            btr.insert_kv(7, '7' * 9000)
+            btr.close()
+        if btr.pager.n_page > n_page:
+            logger.error(f'btree_file overflow pages are not reused: '
+                         f'{n_page} -> {btr.pager.n_page}')
+        btr = btree_file(path)
+        btr.insert_kv(20, lambda: None)
+        try:
+            btr.close()
+            logger.error('btree_file close() with unpicklable item error')
+        except (pickle.PicklingError, AttributeError, TypeError):
+            if not btr.pager.file.closed:
+                logger.error('btree_file close() leaks the file')
+        logger.info(f'btree_file overflow: page size {btr.pager.page_size}'
+                    f', pages: {n_page} -> {btr.pager.n_page}')
+
+    #
+    # test case for memory-mapped snapshot
+    #
+    logger.info('=== save_snapshot() and open_snapshot() test ===')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'btree.snapshot')
+        for items in ([btree_kv(i // 3, i) for i in range(-30, 100)],
+                      [btree_pair(f'{i // 2:03}', i) for i in range(50)],
+                      [btree_item(i / 4) for i in range(20)],
+                      [btree_kv(bytes([i % 7]) * (i % 5), i)
+                       for i in range(35)],
+                      []):
+            btr = btree.from_sorted(sorted(items, key=_bt_key), 3,
+                                    bare=any(isinstance(it, btree_pair)
+                                             for it in items))
+            btr.save_snapshot(path)
+            with btree.open_snapshot(path) as snapshot:
+                rows = [(it.bt_key, getattr(it, 'value', None))
+                        for it in btr]
+                if [(it.bt_key, getattr(it, 'value', None))
+                        for it in snapshot] != rows \
+                    or len(snapshot) != len(btr) \
+                        or [it.bt_key for it in snapshot[::-3]] \
+                        != [it.bt_key for it in btr[::-3]]:
+                    logger.error(f'snapshot of {items[:3]} error')
+                for it in items:
+                    if snapshot.count(it.bt_key) != btr.count(it.bt_key) \
+                        or [r.bt_key for r in snapshot.range(
+                            it.bt_key, None, (False, True), True)] \
+                            != [r.bt_key for r in btr.range(
+                                it.bt_key, None, (False, True), True)]:
+                        logger.error(f'snapshot search({it.bt_key}) error')
+        btr = btree.from_sorted([btree_kv(i, f'#{i}') for i in range(10)])
+        btr.save_snapshot(path)
+        with btree.open_snapshot(path) as snapshot:
+            logger.info(f'snapshot[-2]: {snapshot[-2]}, search(5): '
+                        f'{snapshot.search(5)}, range(3, 6): '
+                        f'{list(snapshot.range(3, 6))}')
+        try:
+            btree.from_sorted([btree_item(1), btree_item(1.5)]) \
+                .save_snapshot(path)
+            logger.error('snapshot with int and float keys error')
+        except TypeError as e:
+            logger.info(f'snapshot with int and float keys: {e}')
+        try:
+            btree(key=abs).save_snapshot(path)
+            logger.error('snapshot with key error')
+        except TypeError as e:
+            logger.info(f'snapshot with key: {e}')
+
+    #
+    # test case for write-ahead log and recovery
+    #
+    logger.info('=== btree_logged test ===')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'btree')
+        for sync in btree_wal.SYNC_POLICIES:
+            btr = btree_logged(path, 3, sync=sync, group_size=4)
+            expected = btree_debug(3, btree_debug.DEBUG_NONE)
+            for i in range(200):
+                bt_key = (i * 37) % 101
+                btr.insert_kv(bt_key, i)
+                expected.insert_kv(bt_key, i)
+                if i % 50 == 49:
+                    btr.checkpoint()
+            for bt_key in range(0, 101, 3):
+                btr.delete(bt_key)
+                expected.delete(bt_key)
+            btr.delete(None, btr[5])
+            del expected[5]
+            del btr[-7]
+            del expected[-7]
+            btr.delete_all(50)
+            btr.delete_range(20, 30)
+            btr += [btree_kv(i, 'x') for i in range(-5, 5)]
+            expected.delete_all(50)
+            expected.delete_range(20, 30)
+            expected += [btree_kv(i, 'x') for i in range(-5, 5)]
+            btr.commit()
+
+            # recover from the checkpoint and log, without close()
+            recovered = btree_logged(path)
+            rows = [(it.bt_key, it.value) for it in expected]
+            if [(it.bt_key, it.value) for it in recovered] != rows \
+                or recovered.min_degree != 3:
+                logger.error(f'btree_logged(sync={sync!r}) recovery error')
+            recovered.close()
+            btr.close()
+
+            # a torn record at the end of log is dropped
+            with open(path + '.wal', 'ab') as f:
+                f.write(btree_wal.RECORD.pack(100, 0) + b'torn')
+            recovered = btree_logged(path)
+            recovered.insert_kv(1000, 'last')
+            recovered.close()
+            recovered = btree_logged(path)
+            if [(it.bt_key, it.value) for it in recovered] \
+                    != rows + [(1000, 'last')]:
+                logger.error(f'btree_logged(sync={sync!r}) torn log error')
+            logger.info(f'btree_logged(sync={sync!r}): {len(recovered)} items'
+                        f', {os.path.getsize(path + ".wal")} bytes of log')
+            recovered.close()
+            for ext in ('.wal', '.checkpoint'):
+                os.remove(path + ext)
+
+        # the btrees split off are not logged, and leave the files alone
+        btr = btree_logged(path, 3)
+        btr += [btree_kv(i, i) for i in range(30)]
+        removed = btr.delete_range(5, 10)
+        lower, upper = btr.split_at(20)
+        removed.insert_kv(100, 'removed')
+        upper.delete(25)
+        btr.join(lower)
+        for subtree in (removed, lower, upper):
+            if type(subtree) is not btree:
+                logger.error(f'btree_logged split off {type(subtree)}')
+        for bad in (lambda: btr.cursor().delete_here(),
+                    lambda: pickle.dumps(btr)):
+            try:
+                bad()
+                logger.error('btree_logged.cursor() write or pickle error')
+            except TypeError as e:
+                logger.info(f'btree_logged: {e}')
+        copied = pickle.loads(pickle.dumps(btr.snapshot()))
+        copied.insert_kv(100, 'copied')
+        if type(copied) is not btree or 100 in btr \
+                or [(it.bt_key, it.value) for it in copied][:-1] \
+                != [(it.bt_key, it.value) for it in btr]:
+            logger.error('pickle of btree_logged.snapshot() error')
+        btr.checkpoint()
+        btr.insert_kv(40, 'last')
+        btr.close()
+        with btree_logged(path) as recovered:
+            if [(it.bt_key, it.value) for it in recovered] \
+                    != [(i, i) for i in range(20) if not 5 <= i < 10] \
+                    + [(40, 'last')]:
+                logger.error('btree_logged with split off btrees error')
+        for ext in ('.wal', '.checkpoint'):
+            os.remove(path + ext)
+
+        # a lone record is written by the flusher after group_delay
+        btr = btree_logged(path, 3, group_size=1000, group_delay=0.05)
+        size = os.path.getsize(path + '.wal')
+        btr.insert_kv(1, 'lone')
+        time.sleep(0.2)
+        with btree_logged(path) as recovered:
+            if os.path.getsize(path + '.wal') <= size \
+                or [(it.bt_key, it.value) for it in recovered] \
+                    != [(1, 'lone')]:
+                logger.error('btree_logged(group_delay) lone record error')
+        btr.close()
+        for ext in ('.wal', '.checkpoint'):
+            os.remove(path + ext)
+
+    #
+    # test case for pickle, save() and load()
+    #
+    logger.info('=== pickle, save() and load() test ===')
+    import copy
+    import io
+    for min_degree, bare in ((2, False), (3, True), (64, False)):
+        btr = btree_debug(min_degree, btree_debug.DEBUG_NONE, bare=bare)
+        for i in range(3000):
+            btr.insert_kv((i * 37) % 1009, i)
+        rows = [(it.bt_key, it.value) for it in btr]
+        for name, loaded in (
+                ('pickle', pickle.loads(pickle.dumps(btr))),
+                ('copy.copy()', copy.copy(btr)),
+                ('copy.deepcopy()', copy.deepcopy(btr))):
+            loaded.check()
+            if type(loaded) is not btree_debug \
+                    or [(it.bt_key, it.value) for it in loaded] != rows \
+                    or loaded.min_degree != btr.min_degree:
+                logger.error(f'{name} of {min_degree}, {bare} error')
+        f = io.BytesIO()
+        btr.save(f)
+        btr.save(f)
+        f.seek(0)
+        for _ in range(2):
+            loaded = btree.load(f)
+            if [(it.bt_key, it.value) for it in loaded] != rows or loaded.min_degree != btr.min_degree:
+                logger.error(f'save() and load() of {min_degree}, {bare} '
+                             f'error')
+        logger.info(f'pickle of {len(btr)} items, min_degree {min_degree}, '
+                    f'bare {bare}: {len(pickle.dumps(btr))} bytes, '
+                    f'save(): {f.tell() // 2} bytes')
+    try:
+        btree.load(io.BytesIO(pickle.dumps((b'NOTDUMP', 2, False))))
+        logger.error('load() from a bad file error')
+    except ValueError as e:
+        logger.info(f'load() from a bad file: {e}')
+
+    #
+    # test case for snapshot() and copy-on-write
+    #
+    logger.info('=== snapshot() test ===')
+    import threading
+    for min_degree, bare in ((2, False), (3, True)):
+        btr = btree_debug(min_degree, btree_debug.DEBUG_NONE, bare=bare)
+        views = []
+        for i in range(600):
+            btr.insert_kv((i * 37) % 101, i)
+            if i % 7 == 0:
+                btr.delete(None, btr[i % len(btr)])
+            if i % 100 == 99:
+                btr.delete_range(i % 50, i % 50 + 5)
+                lower, upper = btr.split_at(50)
+                views.append((lower.snapshot(), list(lower)))
+                lower.join(upper)
+                btr = lower
+            if i % 50 == 0:
+                views.append((btr.snapshot(), list(btr)))
+        btr.check()
+        for view, items in views:
+            if list(view) != items or len(view) != len(items) \
+                    or list(view.range(30, 60)) \
+                    != [it for it in items if 30 <= it.bt_key <= 60]:
+                logger.error(f'snapshot() of {min_degree}, {bare} is changed')
+
+        # a long scan of the view while the btree is written
+        view, items, scanned = btr.snapshot(), list(btr), []
+        reader = threading.Thread(
+            target=lambda: scanned.extend(it for it in view if it))
+        reader.start()
+        for i in range(1000):
+            btr.insert_kv(i % 97, -i)
+            btr.delete(i % 89)
+        reader.join()
+        btr.check()
+        if scanned != items or list(view) != items:
+            logger.error(f'snapshot() scan of {min_degree}, {bare} error')
+    logger.info(f'{len(views)} snapshots, {len(btr)} items')
+    try:
+        view.insert_kv(1, 1)
+        logger.error('btree_view.insert_kv() error')
+    except TypeError as e:
+        logger.info(f'btree_view.insert_kv(): {e}')
+
+    #
+    # test case for concurrent_btree with threads
+    #
+    logger.info('=== concurrent_btree test ===')
+    for min_degree, bare in ((2, False), (4, True)):
+        btr = concurrent_btree(min_degree, bare=bare)
+        btr += [btree_kv(i, i) for i in range(0, 1000, 2)]
+        errors, n_read = [], [0]
+        n_writer, n_reader, rounds = 3, 4, 300
+
+        def writer(w):
+            # odd keys of its own, inserted then the half deleted
+            for i in range(rounds):
+                bt_key = 2 * (i * n_writer + w) + 1
+                btr.insert_kv(bt_key, w)
+                if i % 2:
+                    btr.delete(bt_key - 2 * n_writer)
+                if i % 50 == 49:
+                    btr.delete_range(bt_key + 10000, bt_key + 10001)
+
+        def reader(r):
+            for i in range(rounds):
+                bt_key = (i * 7 + r) % 1000
+                found = btr.search(bt_key)
+                if any(it.bt_key != bt_key for it in found) \
+                        or (bt_key % 2 == 0 and len(found) != 1):
+                    errors.append(f'search({bt_key}): {found}')
+                keys = [it.bt_key for it in btr.range(bt_key, bt_key + 30)]
+                if keys != sorted(keys) or len(keys) != len(set(keys)):
+                    errors.append(f'range({bt_key}): {keys}')
+                if btr[btr.index_of(bt_key)].bt_key < bt_key:
+                    errors.append(f'index_of({bt_key}) error')
+                n_read[0] += 1
+
+        threads = [threading.Thread(target=writer, args=(w,))
+                   for w in range(n_writer)]
+        threads += [threading.Thread(target=reader, args=(r,))
+                    for r in range(n_reader)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # the keys of even rounds are deleted by the next round
+        expected = list(range(0, 1000, 2)) + [
+            2 * (i * n_writer + w) + 1
+            for w in range(n_writer) for i in range(1, rounds, 2)]
+        checked = btree_debug(min_degree, btree_debug.DEBUG_NONE, bare=bare)
+        checked.conf, checked.root, checked.height = \
+            btr.conf, btr.root, btr.height
+        checked.check()
+        if errors or [it.bt_key for it in btr] != sorted(expected):
+            logger.error(f'concurrent_btree of {min_degree}, {bare} error: '
+                         f'{errors[:3]}')
+        logger.info(f'concurrent_btree of {min_degree}, {bare}: {len(btr)} '
+                    f'items, {n_read[0]} reads')
+    copied = pickle.loads(pickle.dumps(btr))
+    if type(copied) is not concurrent_btree or list(copied) != list(btr):
+        logger.error('pickle of concurrent_btree error')
+
+    # the items are moved back and forth by join() in both directions
+    left, right = concurrent_btree(3), concurrent_btree(3)
+    left += [btree_kv(i, i) for i in range(100)]
+    right += [btree_kv(i, i) for i in range(100, 200)]
+
+    def join(btr, other):
+        for _ in range(300):
+            try:
+                btr.join(other)
+            except ValueError:
+                pass  # overlapped, the other thread moved them first
+
+    threads = [threading.Thread(target=join, args=args, daemon=True)
+               for args in ((left, right), (right, left))]
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads in the middle of join()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+    sys.setswitchinterval(interval)
+    if any(thread.is_alive() for thread in threads) \
+        or sorted(it.bt_key for it in list(left) + list(right)) \
+            != list(range(200)):
+        logger.error('concurrent_btree.join() in two threads error')
+    logger.info(f'concurrent_btree.join() in two threads: {len(left)}, '
+                f'{len(right)} items')
+    try:
+        btr._read(btr.insert_kv, 1, 1)
+        logger.error('concurrent_btree write while reading error')
+    except RuntimeError as e:
+        logger.info(f'concurrent_btree write while reading: {e}')
+
+    #
+    # test case for async_btree
+    #
+    logger.info('=== async_btree test ===')
+
+    async def async_test(btr, snapshot_path):
+        expected = sorted(btr, key=_bt_key)
+        abtr = async_btree(btr)
+        abtr.SCAN_CHUNK = 7
+        for lo, hi, inclusive, reverse in ((None, None, True, False),
+                                           (10, 40, (False, True), False),
+                                           (10, 40, (True, False), True),
+                                           (None, 25, True, True)):
+            items = [it async for it in abtr.range(lo, hi, inclusive, reverse)]
+            if items != list(btr.range(lo, hi, inclusive, reverse)):
+                logger.error(f'async_btree.range({lo}, {hi}, {inclusive}, '
+                             f'{reverse}) of {type(btr).__name__} error')
+
+        # reads wait for the pending writes, a scan sees none of them
+        scan = abtr.__aiter__()
+        first = await scan.__anext__()
+        writes = [asyncio.ensure_future(abtr.insert_kv(bt_key, -1))
+                  for bt_key in range(50, 60)]
+        await asyncio.sleep(0)  # the writes are submitted
+        found = await abtr.get(59)
+        rest = [it async for it in scan]
+        await asyncio.gather(*writes)
+        if [first] + rest != expected and not isinstance(btr, btree_file) \
+                or not any(it.value == -1 for it in found):
+            logger.error(f'async_btree of {type(btr).__name__} '
+                         f'consistency error')
+        removed = await abtr.delete_range(50, 60)
+        if len(removed) != len(expected) - await abtr.count_range(None, 50) \
+                + 10 - await abtr.count_range(60):
+            logger.error(f'async_btree.delete_range() error')
+        await abtr.insert_many(removed)
+        logger.info(f'async_btree of {type(btr).__name__}: '
+                    f'{await abtr.len()} items, get(20): {await abtr.get(20)}')
+        btr.save_snapshot(snapshot_path)
+        await abtr.close()
+
+        async with async_btree(btree.open_snapshot(snapshot_path)) as abtr:
+            abtr.SCAN_CHUNK = 7
+            if [(it.bt_key, it.value)
+                    async for it in abtr.range(10, 40, reverse=True)] \
+                    != [(it.bt_key, it.value)
+                        for it in btr.range(10, 40, reverse=True)] \
+                    or await abtr.count(20) != btr.count(20):
+                logger.error('async_btree of btree_snapshot error')
+
+    async def ticker(stop, gaps):
+        # lateness of a coroutine waking up every millisecond
+        loop = asyncio.get_running_loop()
+        while not stop:
+            start = loop.time()
+            await asyncio.sleep(0.001)
+            gaps.append(loop.time() - start - 0.001)
+
+    async def latency_test(btr):
+        stop, gaps = [], []
+        tick = asyncio.ensure_future(ticker(stop, gaps))
+        async with async_btree(btr) as abtr:
+            await asyncio.sleep(0.01)
+            n = 0
+            async for _item in abtr:
+                n += 1
+        stop.append(True)
+        await tick
+        gaps.sort()
+        logger.info(f'async_btree scan of {n} items: {len(gaps)} ticks, '
+                    f'max lateness {gaps[-1] * 1000:.1f} ms')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for btr in (btree(3),
+                    btree_logged(os.path.join(tmp_dir, 'logged'), 3),
+                    btree_file(os.path.join(tmp_dir, 'file'), 3)):
+            for i in range(300):
+                btr.insert_kv((i * 37) % 101, i)
+            asyncio.run(async_test(btr, os.path.join(tmp_dir, 'snapshot')))
+        asyncio.run(latency_test(btree.from_sorted(
+            btree_kv(i, i) for i in range(200000))))
+
+    #
+    # test case for sharded_btree
+    #
+    logger.info('=== sharded_btree test ===')
+
+    def kv_of(items):
+        return [(it.bt_key, it.value) for it in items]
+
+    for mp_context in (None, 'spawn'):
+        btr = btree(3)
+        with sharded_btree(4, 3, split_size=60,
+                           mp_context=mp_context) as sharded:
+            sharded.SCAN_CHUNK = 5
+            for r in range(20):
+                batch = [btree_kv((i * 37 + r * 11) % 200, r * 100 + i)
+                         for i in range(40)]
+                sharded.insert_many(batch)
+                btr.insert_many(batch)
+                sharded.insert_kv(r * 7, -r)
+                btr.insert_kv(r * 7, -r)
+            logger.info(f'sharded_btree: {sharded.counts} items in shards, '
+                        f'bounds {sharded.bounds}')
+            if len(sharded.shards) != 4 or len(sharded) != len(btr) \
+                    or kv_of(sharded) != kv_of(btr) \
+                    or kv_of(reversed(sharded)) != kv_of(reversed(btr)):
+                logger.error('sharded_btree insert error')
+            lo, hi = sharded.bounds[0], sharded.bounds[2]
+            for inclusive in (True, False, (True, False)):
+                for reverse in (False, True):
+                    if kv_of(sharded.range(lo, hi, inclusive, reverse)) \
+                            != kv_of(btr.range(lo, hi, inclusive, reverse)) \
+                            or sharded.count_range(lo, hi, inclusive) \
+                            != btr.count_range(lo, hi, inclusive):
+                        logger.error(f'sharded_btree.range({lo}, {hi}, '
+                                     f'{inclusive}, {reverse}) error')
+            for index in (0, 300, -1, slice(10, 700, 3), slice(700, 10, -7)):
+                if kv_of(sharded[index] if isinstance(index, slice)
+                         else [sharded[index]]) \
+                        != kv_of(btr[index] if isinstance(index, slice)
+                                 else [btr[index]]):
+                    logger.error(f'sharded_btree[{index}] error')
+            for bt_key in range(0, 200, 7):
+                if kv_of(sharded.search(bt_key)) != kv_of(btr.search(bt_key)) \
+                        or sharded.index_of(bt_key) != btr.index_of(bt_key):
+                    logger.error(f'sharded_btree.search({bt_key}) error')
+            if kv_of(sharded.delete_range(30, 120)) \
+                    != kv_of(btr.delete_range(30, 120)) \
+                    or kv_of(sharded.delete_many([1, 150, 2])) \
+                    != kv_of(btr.delete_many([1, 150, 2])) \
+                    or kv_of(sharded) != kv_of(btr):
+                logger.error('sharded_btree delete error')
+
+    #
+    # test case for btree(key=)
+    #
+    logger.info('=== btree(key=) test ===')
+    samples = [None, -(1 << 70), -257, -256, -255, -1, 0, 1, 255, 256,
+               1 << 70]
+    samples.sort(key=lambda k: (k is not None, k or 0))
+    floats = [float('-inf'), -1e300, -2.5, -0.0, 1e-300, 2.5, float('inf')]
+    strings = ['', 'a', 'a\0', 'a\0\0', 'a\1', 'ab', 'b', '\u4e2d']
+    tuples = [(), (0,), (0, ''), (0, 'a'), (0, 'a', 1), (1,), (1, (2,))]
+    for group in (samples, floats, strings, tuples,
+                  [s.encode() for s in strings]):
+        encoded = list(map(btree_encode_key, group))
+        if encoded != sorted(encoded):
+            logger.error(f'btree_encode_key() order of {group} error')
+    try:
+        btree_encode_key([1])
+        logger.error('btree_encode_key() of list error')
+    except TypeError as e:
+        logger.info(f'btree_encode_key() of list: {e}')
+
+    words = ['apple', 'Banana', 'cherry', 'APPLE', 'banana', 'Cherry',
+             'date', 'Apple', 'DATE', 'elder']
+    for key, bt_keys in ((str.casefold,
+                          [words[(i * 7) % len(words)] for i in range(300)]),
+                         (btree_encode_key,
+                          [((i * 37) % 101 - 50, f'x{i % 7}')
+                           for i in range(300)])):
+        btr = btree_debug(3, btree_debug.DEBUG_NONE, key=key)
+        items = [btree_kv(bt_key, i) for i, bt_key in enumerate(bt_keys)]
+        for item in items[:100]:
+            btr.insert(item)
+        btr.insert_many(items[100:150])
+        btr.insert_many(items[150:])
+        btr.check()
+        expected = sorted(items, key=lambda it: key(it.bt_key))
+        probe = bt_keys[5]
+        same = [it for it in expected if key(it.bt_key) == key(probe)]
+        if list(btr) != expected or btr.key is not key \
+                or btr.search(probe) != same \
+                or btr.count(probe) != len(same) \
+                or btr.index_of(probe) != expected.index(same[0]) \
+                or probe not in btr or not btr.has_key(probe) \
+                or dict(btr.search_many([probe, bt_keys[9], probe])) \
+                != {probe: same, bt_keys[9]: btr.search(bt_keys[9])}:
+            logger.error(f'btree(key={key.__name__}) search error')
+        lo, hi = bt_keys[3], bt_keys[8]
+        if key(lo) > key(hi):
+            lo, hi = hi, lo
+        for inclusive in (True, False, (True, False)):
+            _inc = (inclusive, inclusive) if isinstance(inclusive, bool) \
+                else inclusive
+            ranged = [it for it in expected
+                      if (key(lo) <= key(it.bt_key) if _inc[0]
+                          else key(lo) < key(it.bt_key))
+                      and (key(it.bt_key) <= key(hi) if _inc[1]
+                           else key(it.bt_key) < key(hi))]
+            if list(btr.range(lo, hi, inclusive)) != ranged \
+                    or list(btr.range(lo, hi, inclusive, True)) \
+                    != ranged[::-1] \
+                    or btr.count_range(lo, hi, inclusive) != len(ranged):
+                logger.error(f'btree(key={key.__name__}).range({lo}, {hi}, '
+                             f'{inclusive}) error')
+        loaded = pickle.loads(pickle.dumps(btr))
+        loaded.check()
+        f = io.BytesIO()
+        btr.save(f)
+        f.seek(0)
+        if list(map(_bt_key, loaded)) != list(map(_bt_key, btr)) \
+                or list(map(_bt_key, btree.load(f))) \
+                != list(map(_bt_key, btr)) or loaded.key is not key:
+            logger.error(f'btree(key={key.__name__}) pickle error')
+        rebuilt = btree_debug.from_sorted(expected, 3, key=key)
+        rebuilt.check()
+        if list(rebuilt) != expected:
+            logger.error(f'btree.from_sorted(key={key.__name__}) error')
+        lower, upper = btr.split_at(hi)
+        lower.check()
+        upper.check()
+        if list(lower) + list(upper) != expected \
+                or any(key(it.bt_key) >= key(hi) for it in lower):
+            logger.error(f'btree(key={key.__name__}).split_at() error')
+        lower.join(upper)
+        removed = lower.delete_range(lo, hi)
+        deleted = lower.delete_many([probe, bt_keys[9]])
+        lower.delete_all(bt_keys[2])
+        del lower[3]
+        lower.check()
+        rest = [it for it in expected
+                if not key(lo) <= key(it.bt_key) < key(hi)]
+        gone = (key(probe), key(bt_keys[9]))
+        if list(removed) != [it for it in expected if it not in rest] \
+                or deleted != [it for it in rest if key(it.bt_key) in gone]:
+            logger.error(f'btree(key={key.__name__}) delete error')
+        rest = [it for it in rest if key(it.bt_key) not in gone
+                and key(it.bt_key) != key(bt_keys[2])]
+        del rest[3]
+        if list(lower) != rest:
+            logger.error(f'btree(key={key.__name__}) delete error')
+        logger.info(f'btree(key={key.__name__}): {len(expected)} items, '
+                    f'range({lo!r}, {hi!r}): {len(ranged)} items, '
+                    f'{len(lower)} left')
+    cbtr = concurrent_btree(3, key=str.casefold)
+    cbtr.insert_many(btree_kv(word, i) for i, word in enumerate(words))
+    cbtr = pickle.loads(pickle.dumps(cbtr))
+    if [it.value for it in cbtr.search('APPLE')] != [0, 3, 7] \
+            or cbtr.key is not str.casefold:
+        logger.error('concurrent_btree(key=) error')
+    try:
+        btree(bare=True, key=str.casefold)
+        logger.error('btree(bare=True, key=) error')
+    except ValueError as e:
+        logger.info(f'btree(bare=True, key=): {e}')
+    import gc
+    n_class = len(_keyed_classes)
+    for i in range(10):
+        btr = btree(3, key=lambda bt_key, i=i: bt_key * i)
+        btr.insert_kv(1, i)
+    del btr
+    gc.collect()
+    if len(_keyed_classes) != n_class:
+        logger.error(f'btree(key=) classes leaked: {n_class} -> '
+                     f'{len(_keyed_classes)}')
+
+    #
+    # test case for btree(prefix=True) and prefix_scan()
+    #
+    logger.info('=== btree(prefix=True) and prefix_scan() test ===')
+    paths = ['/usr/lib/', '/usr/lib/python3/', '/usr/local/bin/', '/var/']
+    for min_degree in (2, 3, 16):
+        btr = btree_debug(min_degree, btree_debug.DEBUG_NONE, prefix=True)
+        bare = btree_debug(min_degree, btree_debug.DEBUG_NONE, bare=True)
+        for i in range(600):
+            bt_key = f'{paths[i % len(paths)]}{(i * 37) % 211:03d}'
+            btr.insert_kv(bt_key, i)
+            bare.insert_kv(bt_key, i)
+        batch = [btree_pair(f'/usr/lib/{i:04d}', -i) for i in range(0, 99, 7)]
+        btr.insert_many(batch + [btree_pair('/a', 0), btree_pair('/z', 0)])
+        bare.insert_many(batch + [btree_pair('/a', 0), btree_pair('/z', 0)])
+        for bt_key in ('/usr/lib/005', '/var/100', '/a', '/usr/lib/0007'):
+            btr.delete(bt_key)
+            bare.delete(bt_key)
+        btr.delete_many(['/usr/local/bin/012', '/var/003'])
+        bare.delete_many(['/usr/local/bin/012', '/var/003'])
+        del btr[100]
+        del bare[100]
+        btr.check()
+        if list(btr) != list(bare):
+            logger.error(f'btree(prefix=True) of min_degree {min_degree} '
+                         f'items error')
+        for bt_key in ('/usr/lib/python3/010', '/usr/lib/0014', '/', '/zz'):
+            if btr.search(bt_key) != bare.search(bt_key) \
+                    or btr.index_of(bt_key) != bare.index_of(bt_key):
+                logger.error(f'btree(prefix=True).search({bt_key}) error')
+        for prefix in ('/usr/lib/', '/usr/lib/python3/01', '/usr/l', '/var/',
+                       '/usr/lib/1', '/x', ''):
+            expected = [it for it in bare if it.bt_key.startswith(prefix)]
+            if list(btr.prefix_scan(prefix)) != expected \
+                    or list(bare.prefix_scan(prefix)) != expected:
+                logger.error(f'prefix_scan({prefix}) error')
+        loaded = pickle.loads(pickle.dumps(btr))
+        lower, upper = btr.split_at('/usr/lib/python3/')
+        if list(lower) + list(upper) != list(bare) \
+                or list(loaded) != list(bare):
+            logger.error('btree(prefix=True) split_at() or pickle error')
+        logger.info(f'btree(prefix=True) of min_degree {min_degree}: '
+                    f'{len(bare)} items, root prefix '
+                    f'{loaded.root.items.prefix!r}, '
+                    f'prefix_scan(/usr/lib/python3/01): '
+                    f'{len(list(bare.prefix_scan("/usr/lib/python3/01")))}')
+    try:
+        btr.insert_kv(1, 1)
+        logger.error('btree(prefix=True) with int key error')
+    except TypeError as e:
+        logger.info(f'btree(prefix=True) with int key: {e}')
+    cbtr = concurrent_btree(3, prefix=True)
+    cbtr.insert_many(btree_kv(word, i) for i, word in enumerate(words))
+    if [it.value for it in cbtr.prefix_scan('b')] != [4] \
+            or [it.value for it in btree.from_sorted(
+                sorted(cbtr), prefix=True).prefix_scan('')] \
+            != [it.value for it in cbtr]:
+        logger.error('concurrent_btree(prefix=True) error')
+
+    #
+    # test case for btree_multimap
+    #
+    logger.info('=== btree_multimap test ===')
+
+    class multimap_debug(btree_multimap):
+        dbg_flags = btree_debug.DEBUG_NONE
+        check = btree_debug.check
+        dump = btree_debug.dump
+
+    for min_degree in (2, 3, 8):
+        mm = multimap_debug(min_degree)
+        bare = btree_debug(min_degree, btree_debug.DEBUG_NONE, bare=True)
+        for i in range(2000):
+            # key 7 is hot, and the others have a few values
+            bt_key = 7 if i % 3 == 0 else (i * 37) % 211
+            mm.insert_kv(bt_key, i)
+            bare.insert_kv(bt_key, i)
+        batch = [btree_kv((i * 13) % 300, -i) for i in range(500)]
+        mm.insert_many(batch)
+        bare.insert_many(batch)
+        mm += [btree_kv(7, -1), btree_kv(500, -2)]
+        bare += [btree_kv(7, -1), btree_kv(500, -2)]
+        mm.check()
+        if list(mm) != list(bare) or list(reversed(mm)) != list(
+                reversed(bare)) or len(mm) != len(bare):
+            logger.error(f'btree_multimap of min_degree {min_degree} error')
+        for bt_key in (7, 0, 13, 210, 211, 500, 501):
+            if mm.search(bt_key) != bare.search(bt_key) \
+                    or mm.count(bt_key) != bare.count(bt_key) \
+                    or mm.index_of(bt_key) != bare.index_of(bt_key) \
+                    or mm.values(bt_key) != [it.value for it in
+                                             bare.search(bt_key)]:
+                logger.error(f'btree_multimap.search({bt_key}) error')
+        for index in (0, 1, 700, -1, slice(5, 900, 7), slice(900, 5, -3),
+                      slice(None), slice(None, None, -1), slice(3, 1500, 2),
+                      slice(1500, 3, -2), slice(10, 20)):
+            if mm[index] != bare[index]:
+                logger.error(f'btree_multimap[{index}] error')
+        if list(mm.range(5, 8)) != list(bare.range(5, 8)) \
+                or list(mm.range(5, 8, reverse=True)) \
+                != list(bare.range(5, 8, reverse=True)) \
+                or mm.count_range(5, 100) != bare.count_range(5, 100) \
+                or dict(mm.search_many([7, 8, 9])) \
+                != dict(bare.search_many([7, 8, 9])):
+            logger.error('btree_multimap.range() error')
+
+        # FIFO, a specific value, the whole bucket
+        for bt_key, item in ((7, None), (7, btree_pair(7, 300)), (7, None),
+                             (0, None), (0, btree_pair(0, 123456)),
+                             (210, None), (500, btree_pair(500, -2))):
+            if mm.delete(bt_key, item) != bare.delete(bt_key, item):
+                logger.error(f'btree_multimap.delete({bt_key}, {item}) '
+                             f'error')
+        if mm.delete_all(13) != bare.delete_all(13) \
+                or mm.delete_many([7, 1, 1000]) \
+                != bare.delete_many([7, 1, 1000]):
+            logger.error('btree_multimap.delete_all() error')
+        del mm[100]
+        del bare[100]
+        mm.check()
+        loaded = pickle.loads(pickle.dumps(mm))
+        if list(mm) != list(bare) or len(mm) != len(bare) \
+                or mm.has_key(7) or bare[500] not in mm \
+                or list(loaded) != list(bare):
+            logger.error(f'btree_multimap of min_degree {min_degree} '
+                         f'delete error')
+
+        # the buckets are moved, and the ones of a key at the ends are merged
+        lower, upper = mm.split_at(150)
+        b_lower, b_upper = bare.split_at(150)
+        lower.check()
+        upper.check()
+        if list(lower) != list(b_lower) or list(upper) != list(b_upper) \
+                or len(mm) or type(upper) is not multimap_debug:
+            logger.error('btree_multimap.split_at() error')
+        last = lower[-1].bt_key
+        tail = multimap_debug(min_degree)
+        tail += [btree_kv(last + i % 2, -i) for i in range(20)]
+        lower.join(tail)
+        b_lower += [btree_kv(last + i % 2, -i) for i in range(20)]
+        removed = lower.delete_range(20, 100)
+        b_removed = b_lower.delete_range(20, 100)
+        lower.check()
+        removed.check()
+        upper.insert_kv(500, -3)
+        b_upper.insert_kv(500, -3)
+        upper.delete(500)
+        b_upper.delete(500)
+        upper.join(multimap_debug(min_degree))
+        lower.join(upper)
+        b_lower.join(b_upper)
+        lower.check()
+        f = io.BytesIO()
+        lower.save(f)
+        f.seek(0)
+        loaded = btree.load(f)
+        if list(lower) != list(b_lower) or len(lower) != len(b_lower) \
+            or list(removed) != list(b_removed) or len(tail) or len(upper) \
+                or lower.count(last) != b_lower.count(last) \
+                or type(loaded) is not btree_multimap \
+                or list(loaded) != list(lower):
+            logger.error('btree_multimap.join() and delete_range() error')
+        logger.info(f'btree_multimap of min_degree {min_degree}: '
+                    f'{len(lower)} values, {sum(1 for _ in lower.root)} '
+                    f'buckets, height {lower.height}')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'btree.snapshot')
+        lower.save_snapshot(path)
+        with btree.open_snapshot(path) as snapshot:
+            if list(snapshot) != list(lower) \
+                    or snapshot.search(7) != lower.search(7):
+                logger.error('btree_multimap.save_snapshot() error')
+    for bad in (mm.snapshot, mm.cursor, lambda: mm.cache_search(8),
+                lambda: mm.join(btree())):
+        try:
+            bad()
+            logger.error('btree_multimap error not raised')
+        except (TypeError, ValueError) as e:
+            logger.info(f'btree_multimap: {e}')
+
+    #
+    # test case for btree.cache_search()
+    #
+    logger.info('=== btree.cache_search() test ===')
+
+    def same_search(btr1: btree, btr2: btree, bt_keys) -> bool:
+        # btree_kv of insert_kv() are different objects in the btrees
+        return all(repr(btr1.search(k)) == repr(btr2.search(k))
+                   for k in bt_keys)
+
+    for policy in btree_cache.POLICIES:
+        cached = btree_debug(3, btree_debug.DEBUG_NONE)
+        plain = btree_debug(3, btree_debug.DEBUG_NONE)
+        cached.cache_search(16, policy)
+        for i in range(3000):
+            # keys below 8 get most of the lookups, the writes are spread
+            bt_key = (i * 7) % 8 if i % 5 else (i * 37) % 101
+            op = (i * 13) % 20
+            if op < 12:
+                if not same_search(cached, plain, [bt_key]):
+                    logger.error(f'btree.cache_search({policy}) '
+                                 f'search({bt_key}) error')
+            elif op < 15:
+                kv = btree_kv((i * 37) % 101, i)  # the same item in both
+                cached.insert(kv)
+                plain.insert(kv)
+            elif op == 15:
+                if repr(cached.delete(bt_key)) != repr(plain.delete(bt_key)):
+                    logger.error(f'btree.cache_search({policy}) '
+                                 f'delete({bt_key}) error')
+            elif op == 16 and plain.has_key(bt_key):
+                cached.delete(None, cached.search(bt_key)[-1])
+                plain.delete(None, plain.search(bt_key)[-1])
+            elif op == 17:
+                if repr(cached.delete_all(bt_key)) \
+                        != repr(plain.delete_all(bt_key)):
+                    logger.error(f'btree.cache_search({policy}) '
+                                 f'delete_all({bt_key}) error')
+            elif op == 18 and len(plain):
+                index = i % len(plain)
+                del cached[index]
+                del plain[index]
+            else:
+                cached.insert_kv(bt_key, -i)
+                plain.insert_kv(bt_key, -i)
+        batch = [btree_kv(i % 7, i) for i in range(50)]
+        cached.insert_many(batch)
+        plain.insert_many(batch)
+        cached.delete_many([1, 2, 200])
+        plain.delete_many([1, 2, 200])
+        if not same_search(cached, plain, range(101)):
+            logger.error(f'btree.cache_search({policy}) batch error')
+        cached.delete_range(5, 50)
+        plain.delete_range(5, 50)
+        lower, upper = cached.split_at(70)
+        cached.join(lower)
+        cached.join(upper)
+        cached.check()
+        if not same_search(cached, plain, range(101)) \
+            or lower.cache is not None \
+                or pickle.loads(pickle.dumps(cached)).cache is not None:
+            logger.error(f'btree.cache_search({policy}) range error')
+        cache = cached.cache
+        if len(cache) > cache.size or not cache.hits or not cache.misses:
+            logger.error(f'btree.cache_search({policy}) error: {cache}')
+        logger.info(f'btree.cache_search({policy}): {cache}')
+
+    # the readers of concurrent_btree share the cache
+    cbtr = concurrent_btree(3)
+    cbtr.cache_search(8, 'tinylfu')
+    cbtr.insert_many([btree_kv(i % 20, i) for i in range(200)])
+
+    def cache_reader():
+        for i in range(1000):
+            if len(cbtr.search(i % 10)) != 10:
+                logger.error('concurrent_btree.cache_search() error')
+
+    readers = [threading.Thread(target=cache_reader) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    if cbtr.cache.hits + cbtr.cache.misses != 4000:
+        logger.error(f'concurrent_btree.cache_search() error: {cbtr.cache}')
+
+    cached = btree_debug(2, btree_debug.DEBUG_NONE, key=str.casefold)
+    cached.cache_search(4)
+    cached.insert_kv('Apple', 1)
+    cached.search('APPLE')
+    cached.insert_kv('aPPLE', 2)
+    if [it.value for it in cached.search('apple')] != [1, 2]:
+        logger.error('btree(key=).cache_search() error')
+    cached.cache_search(0)
+    if cached.cache is not None:
+        logger.error('btree.cache_search(0) error')
+
+    #
+    # test case for btree.cursor()
+    #
+    logger.info('=== btree.cursor() test ===')
+    for min_degree in (2, 3, 8):
+        btr = btree_debug(min_degree, btree_debug.DEBUG_NONE)
+        for i in range(600):
+            btr.insert_kv((i * 37) % 211, i)
+        items = list(btr)  # the model of the writes by the cursor
+        cursor = btr.cursor()
+        if list(cursor) != items \
+            or [cursor.prev() for _ in items] != items[::-1] \
+                or cursor.prev() is not None:
+            logger.error(f'btree_cursor.next() of min_degree {min_degree} '
+                         f'error')
+
+        pos = 0
+        for i in range(4000):
+            op = (i * 7) % 10
+            if op < 3:
+                # the near keys and the far ones, to both sides
+                bt_key = i // 15 if i % 4 else (i * 89) % 230 - 10
+                right = bool(i % 3)
+                cursor.seek(bt_key, right)
+                pos = btr.index_of(bt_key)
+                if right:
+                    pos += btr.count(bt_key)
+            elif op < 6:
+                # the same bt_key as the item before or after the cursor
+                near = items[pos - 1] if pos and (i % 2 or pos == len(items)) \
+                    else items[pos] if items else btree_kv(0, None)
+                kv = btree_kv(near.bt_key, -i)
+                cursor.insert_here(kv)
+                items.insert(pos, kv)
+            elif op < 9:
+                item = cursor.delete_here()
+                if item is not (items.pop(pos) if pos < len(items) else None):
+                    logger.error(f'btree_cursor.delete_here() error: {item}')
+            elif cursor.next() is not None:
+                pos += 1
+            if cursor._position() != pos \
+                or cursor.item is not (items[pos] if pos < len(items)
+                                       else None):
+                logger.error(f'btree_cursor of min_degree {min_degree} '
+                             f'error at {i}: {cursor._position()} != {pos}')
+                break
+        btr.check()
+        if list(btr) != items:
+            logger.error(f'btree_cursor of min_degree {min_degree} '
+                         f'write error')
+        logger.info(f'btree_cursor of min_degree {min_degree}: '
+                    f'{len(btr)} items, height {btr.height}')
+
+    btr = btree_debug(2, btree_debug.DEBUG_NONE, key=str.casefold)
+    for word in ('b', 'D', 'a', 'C', 'e'):
+        btr.insert_kv(word, None)
+    btr.cache_search(8)
+    cursor = btr.cursor()
+    if cursor.seek('c').bt_key != 'C' or cursor.next().bt_key != 'C' \
+            or btr.search('cc'):
+        logger.error('btree(key=).cursor() error')
+    cursor.insert_here(btree_kv('cC', 1))
+    if [it.value for it in btr.search('CC')] != [1]:
+        logger.error('btree_cursor.insert_here() with cache_search() error')
+    for bad in (lambda: cursor.insert_here(btree_kv('Z', 2)),
+                lambda: (btr.insert_kv('x', 3), cursor.next()),
+                lambda: btr.snapshot().cursor().delete_here(),
+                lambda: concurrent_btree().cursor().insert_here(
+                    btree_kv(1, 1))):
+        try:
+            bad()
+            logger.error('btree_cursor error not raised')
+        except (ValueError, RuntimeError, TypeError) as e:
+            logger.info(f'btree_cursor: {e}')
+    if cursor.seek('x', True) is not None or cursor.prev().bt_key != 'x':
+        logger.error('btree_cursor.seek() after a change error')
+
+    #
+    # test case for bare key/value mode
+    #
+    logger.info('=== bare key/value mode test ===')
+    btr = new_btree(3, btree_debug.DEBUG_NONE)
+    bare = btree_debug(3, btree_debug.DEBUG_NONE, bare=True)
+    for i in range(300):
+        bt_key = (i * 37) % 101
+        btr.insert_kv(bt_key, i)
+        bare.insert_kv(bt_key, i)
+    for bt_key in range(0, 101, 3):
+        btr.delete(bt_key)
+        bare.delete(bt_key)
+    bare.delete(None, bare[7])
+    del btr[7]
+    bare.check()
+    # del by position among the equal pairs of a duplicated bt_key
+    dup = btree_debug(2, btree_debug.DEBUG_NONE, bare=True)
+    dup.cache_search(16)
+    for value in (1, 2, 1, 2, 1):
+        dup.insert_kv(5, value)
+    dup.insert_kv(3, 0)
+    dup.search(5)
+    model = list(dup)
+    for index in (3, -1, 1, 0):
+        if dup.__delitem__(index) != model.pop(index) or list(dup) != model \
+                or dup.search(5) != [it for it in model if it.bt_key == 5]:
+            logger.error(f'bare del [{index}] error: {list(dup)} != {model}')
+        dup.check()
+    try:
+        del dup[len(dup)]
+        logger.error('bare del out of range error')
+    except IndexError as e:
+        logger.info(f'bare del out of range: {e}')
+    logger.info(f'bare[5:10]: {bare[5:10]}, search(50): {bare.search(50)}')
+    if [(it.bt_key, it.value) for it in btr] != list(bare) \
+        or list(bare.range(20, 30, reverse=True)) \
+            != [(it.bt_key, it.value) for it in btr.range(20, 30)][::-1]:
+        logger.error('bare key/value mode error')
+    bare = btree_debug.from_sorted(bare, 2, bare=True)
+    bare.check()
+    if list(bare) != [(it.bt_key, it.value) for it in btr]:
+        logger.error('bare key/value mode from_sorted() error')
+
     logger.info('test finished')
@@ -0,0 +1,645 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks of btree, run with the names of benchmarks, or all of them:
+    python btree_bench.py [-n SIZE] [memory scan batch wal pickle snapshot
+                                      concurrent async sharded key prefix
+                                      multimap cache cursor ...]
+'''
+
+import argparse
+import asyncio
+import gc
+import io
+import os
+import pickle
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from itertools import islice
+
+from btree import (async_btree, btree, btree_encode_key, btree_file,
+                   btree_kv, btree_logged, btree_multimap, btree_pair,
+                   concurrent_btree, sharded_btree)
+
+__author__ = 'Forrest Zhang <forrest@263.net>'
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+
+def timeit(func, *args):
+    gc.collect()
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def memory_of(func, *args) -> int:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func(*args)  # keep it alive until it's measured
+        size, _peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def report(title, rows):
+    print(f'--- {title}')
+    for name, value in rows:
+        print(f'{name:>40}: {value}')
+
+
+class dict_kv(btree_kv):
+    '''
+    btree_kv with __dict__, as it was before __slots__
+    '''
+
+
+@benchmark
+def bench_memory(size):
+
+    def build(kv_class, bare=False):
+        btr = btree(bare=bare)
+        btr += [kv_class(i, i) for i in range(size)]
+        return btr
+
+    rows = []
+    for name, args in (('btree_kv with __dict__', (dict_kv,)),
+                       ('btree_kv with __slots__', (btree_kv,)),
+                       ('bare key/value', (btree_kv, True))):
+        n_byte = memory_of(build, *args)
+        rows.append((name, f'{n_byte / size:7.1f} bytes/item'))
+    report(f'memory of {size} items', rows)
+
+
+def recursive_iter(node):
+    '''
+    btree_node.__iter__() as it was, one generator per level
+    '''
+    if node.children:
+        yield from recursive_iter(node.children[0])
+    for i, item in enumerate(node.items, 1):
+        yield item
+        if node.children:
+            yield from recursive_iter(node.children[i])
+
+
+def recursive_traverse(node, path, callback, cb_data=None):
+    '''
+    btree_node.traverse() as it was, one new path list per item
+    '''
+    if node.children:
+        for i, child in enumerate(node.children):
+            ret = recursive_traverse(child, path + [i], callback, cb_data)
+            if ret:
+                return ret
+            if i < len(node.items):
+                ret = callback(path + [i], node.items[i], cb_data)
+                if ret:
+                    return ret
+    else:
+        for i, item in enumerate(node.items):
+            ret = callback(path + [i], item, cb_data)
+            if ret:
+                return ret
+
+
+@benchmark
+def bench_scan(size):
+
+    def count(items):
+        n = 0
+        for _item in items:
+            n += 1
+        return n
+
+    def callback(_path, _item, _cb_data):
+        pass
+
+    for min_degree in (2, 32, None):
+        btr = btree.from_sorted((btree_kv(i, i) for i in range(size)),
+                                min_degree)
+        rows = []
+        for name, func, args in (
+                ('recursive __iter__', count, (recursive_iter(btr.root),)),
+                ('__iter__', count, (iter(btr),)),
+                ('reversed()', count, (reversed(btr),)),
+                ('range()', count, (btr.range(),)),
+                ('recursive traverse()', recursive_traverse,
+                 (btr.root, [], callback)),
+                ('traverse()', btr.traverse, (callback,))):
+            seconds, _result = timeit(func, *args)
+            rows.append((name, f'{size / seconds / 1e6:6.2f} M items/s'))
+        report(f'full scan of {size} items, min_degree {btr.min_degree}',
+               rows)
+
+
+@benchmark
+def bench_batch(size):
+    items = [btree_kv(i, i) for i in range(size)]
+    for n in (size // 1000, size // 100, size // 10, size // 2):
+        batch = [btree_kv(random.randrange(size), -i) for i in range(n)]
+        bt_keys = random.sample(range(size), n)
+
+        def insert_each(btr):
+            for item in batch:
+                btr.insert(item)
+
+        def delete_each(btr):
+            for bt_key in bt_keys:
+                btr.delete_all(bt_key)
+
+        def rebuild(btr):
+            deleted = set(bt_keys)
+            return btree.from_sorted(it for it in btr
+                                     if it.bt_key not in deleted)
+
+        rows = []
+        for name, func in (('insert()', insert_each),
+                           ('insert_many()',
+                            lambda btr: btr.insert_many(batch)),
+                           ('delete_all()', delete_each),
+                           ('delete_many()',
+                            lambda btr: btr.delete_many(bt_keys)),
+                           ('from_sorted() of the rest', rebuild)):
+            seconds, _result = timeit(func, btree.from_sorted(items))
+            rows.append((name, f'{seconds:8.3f} s'))
+        report(f'batch of {n} items into {size} items', rows)
+
+
+@benchmark
+def bench_wal(size):
+    size = min(size, 100000)  # fsync of each record is slow
+    keys = [random.randrange(size) for _ in range(size)]
+
+    def insert(btr, keys):
+        for i, bt_key in enumerate(keys):
+            btr.insert_kv(bt_key, i)
+        return btr
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        seconds, _result = timeit(insert, btree(), keys)
+        rows.append(('in-memory btree', f'{size / seconds:10.0f} inserts/s'))
+        for sync, n in (('none', size), ('group', size), ('always', 1000)):
+            path = os.path.join(tmp_dir, sync)
+            btr = btree_logged(path, sync=sync)
+            seconds, _result = timeit(insert, btr, keys[:n])
+            btr.close()
+            rows.append((f'btree_logged(sync={sync!r})',
+                         f'{n / seconds:10.0f} inserts/s'))
+        seconds, btr = timeit(btree_logged, os.path.join(tmp_dir, 'group'))
+        rows.append((f'recovery of {size} inserts', f'{seconds:8.3f} s'))
+        seconds, _result = timeit(btr.checkpoint)
+        rows.append((f'checkpoint() of {len(btr)} items', f'{seconds:8.3f} s'))
+        btr.close()
+    report(f'write-ahead log of {size} inserts', rows)
+
+
+@benchmark
+def bench_pickle(size):
+
+    def save_load(btr):
+        f = io.BytesIO()
+        btr.save(f)
+        f.seek(0)
+        return btree.load(f)
+
+    for min_degree in (2, None):
+        btr = btree.from_sorted((btree_kv(i, i) for i in range(size)),
+                                min_degree)
+        rows = []
+        try:
+            # the nodes as they were pickled before btree.__reduce__()
+            seconds, data = timeit(pickle.dumps, btr.root)
+            rows.append(('pickle.dumps() of nodes',
+                         f'{seconds:8.3f} s, {len(data)} bytes'))
+            seconds, _result = timeit(pickle.loads, data)
+            rows.append(('pickle.loads() of nodes', f'{seconds:8.3f} s'))
+        except RecursionError:
+            rows.append(('pickle of nodes', 'RecursionError'))
+        seconds, data = timeit(pickle.dumps, btr)
+        rows.append(('pickle.dumps()', f'{seconds:8.3f} s, {len(data)} bytes'))
+        seconds, _result = timeit(pickle.loads, data)
+        rows.append(('pickle.loads()', f'{seconds:8.3f} s'))
+        seconds, _result = timeit(save_load, btr)
+        rows.append(('save() and load()', f'{seconds:8.3f} s'))
+        report(f'pickle of {size} items, min_degree {btr.min_degree}', rows)
+
+
+@benchmark
+def bench_snapshot(size):
+    keys = [random.randrange(size) for _ in range(size)]
+
+    def insert(btr, every):
+        views = []
+        for i, bt_key in enumerate(keys):
+            if not i % every:
+                views = [btr.snapshot()]  # the last view is kept alive
+            btr.insert_kv(bt_key, i)
+        return views
+
+    rows = []
+    seconds, _result = timeit(insert, btree(), size + 1)
+    rows.append(('no snapshot()', f'{size / seconds:10.0f} inserts/s'))
+    for every in (100000, 1000, 10):
+        seconds, _result = timeit(insert, btree(), every)
+        rows.append((f'snapshot() every {every} inserts',
+                     f'{size / seconds:10.0f} inserts/s'))
+    report(f'copy-on-write of {size} inserts', rows)
+
+
+@benchmark
+def bench_concurrent(size):
+    size = min(size, 200000)
+    n_op = size // 10
+    keys = [random.randrange(size) for _ in range(size)]
+
+    def run(btr, n_thread, write_every):
+        # each thread searches its part of keys, and writes every n ops
+
+        def worker(part):
+            search, insert_kv = btr.search, btr.insert_kv
+            for i in range(part, n_op, n_thread):
+                if write_every and not i % write_every:
+                    insert_kv(keys[i], i)
+                else:
+                    search(keys[i])
+
+        threads = [threading.Thread(target=worker, args=(part,))
+                   for part in range(n_thread)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    items = sorted((btree_kv(bt_key, i) for i, bt_key in enumerate(keys)),
+                   key=lambda item: item.bt_key)
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)
+    for write_every in (0, 100, 10):
+        rows = []
+        for name, cls, n_thread in (('btree, 1 thread', btree, 1),
+                                    ('concurrent_btree, 1 thread',
+                                     concurrent_btree, 1),
+                                    ('concurrent_btree, 4 threads',
+                                     concurrent_btree, 4),
+                                    ('concurrent_btree, 8 threads',
+                                     concurrent_btree, 8)):
+            seconds, _result = timeit(run, cls.from_sorted(items),
+                                      n_thread, write_every)
+            rows.append((name, f'{n_op / seconds:10.0f} ops/s'))
+        writes = f'1/{write_every} writes' if write_every else 'no writes'
+        report(f'{n_op} searches of {size} items, {writes}, '
+               f'GIL {"enabled" if is_gil_enabled() else "disabled"}', rows)
+
+
+@benchmark
+def bench_async(size):
+
+    async def ticker(stop, gaps):
+        # lateness of a coroutine waking up every millisecond
+        loop = asyncio.get_running_loop()
+        while not stop:
+            start = loop.time()
+            await asyncio.sleep(0.001)
+            gaps.append(loop.time() - start - 0.001)
+
+    async def blocking_scan(btr):
+        for _item in btr.range():
+            pass
+
+    async def async_scan(btr):
+        async with async_btree(btr) as abtr:
+            async for _item in abtr.range():
+                pass
+
+    async def run(scan, btr):
+        stop, gaps = [], []
+        tick = asyncio.ensure_future(ticker(stop, gaps))
+        await asyncio.sleep(0.01)
+        start = time.perf_counter()
+        await scan(btr)
+        seconds = time.perf_counter() - start
+        stop.append(True)
+        await tick
+        gaps.sort()
+        return (f'{seconds:7.3f} s, {len(gaps):5} ticks, lateness p99 '
+                f'{gaps[len(gaps) * 99 // 100] * 1000:6.1f} ms, '
+                f'max {gaps[-1] * 1000:6.1f} ms')
+
+    items = [btree_kv(i, i) for i in range(size)]
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, btr in (
+                ('btree', btree.from_sorted(items)),
+                ('btree_file', btree_file.from_sorted(
+                    os.path.join(tmp_dir, 'file'), items))):
+            gc.collect()
+            # async_btree closes the btree at last
+            for scan in (blocking_scan, async_scan):
+                rows.append((f'{name}, {scan.__name__}',
+                             asyncio.run(run(scan, btr))))
+    report(f'event loop lateness during a scan of {size} items', rows)
+
+
+@benchmark
+def bench_sharded(size):
+    batch_size = 10000
+    batches = [[btree_kv(random.randrange(size), i)
+                for i in range(start, min(start + batch_size, size))]
+               for start in range(0, size, batch_size)]
+
+    def insert(btr):
+        for batch in batches:
+            btr.insert_many(batch)
+        return btr
+
+    rows = []
+    seconds, _result = timeit(insert, btree())
+    rows.append(('btree', f'{size / seconds:10.0f} inserts/s'))
+    for n_shard in sorted({1, 2, 4, os.cpu_count() or 1}):
+        with sharded_btree(n_shard, split_size=size // n_shard // 2) as btr:
+            seconds, _result = timeit(insert, btr)
+            rows.append((f'sharded_btree of {n_shard} shards',
+                         f'{size / seconds:10.0f} inserts/s'))
+    report(f'insert_many() of {size} items in batches of {batch_size}',
+           rows)
+
+
+class folded_key:
+    '''
+    a case-folded str key wrapped for btree without key=
+    '''
+    __slots__ = ('bt_key',)
+
+    def __init__(self, bt_key):
+        self.bt_key = bt_key
+
+    def __lt__(self, other):
+        return self.bt_key.casefold() < other.bt_key.casefold()
+
+    def __gt__(self, other):
+        return other.__lt__(self)
+
+
+class record_key:
+    '''
+    a (tenant, timestamp, id) key wrapped for btree without key=
+    '''
+    __slots__ = ('tenant', 'timestamp', 'id')
+
+    def __init__(self, tenant, timestamp, id):
+        self.tenant = tenant
+        self.timestamp = timestamp
+        self.id = id
+
+    def __eq__(self, other):
+        return ((self.tenant, self.timestamp, self.id) ==
+                (other.tenant, other.timestamp, other.id))
+
+    def __lt__(self, other):
+        return ((self.tenant, self.timestamp, self.id) <
+                (other.tenant, other.timestamp, other.id))
+
+    def __gt__(self, other):
+        return other.__lt__(self)
+
+
+@benchmark
+def bench_key(size):
+    size = min(size, 200000)  # rich comparisons are slow
+    words = [f'Key{random.randrange(size):08d}' for _ in range(size)]
+    tuples = [(random.randrange(100), random.randrange(size),
+               f'id{i}') for i in range(size)]
+    for title, bt_keys, wrap, key in (
+            ('case-folded str', words, folded_key, str.casefold),
+            ('(tenant, timestamp, id) tuple', tuples,
+             lambda bt_key: record_key(*bt_key), btree_encode_key)):
+        rows = []
+        for name, make, wrapped in (
+                ('wrapper with __lt__', btree, wrap),
+                ('plain bt_key', btree, lambda bt_key: bt_key),
+                (f'key={key.__name__}', lambda: btree(key=key),
+                 lambda bt_key: bt_key)):
+            items = [btree_kv(wrapped(bt_key), i)
+                     for i, bt_key in enumerate(bt_keys)]
+            probes = [item.bt_key for item in random.sample(items, size // 10)]
+
+            def insert_each(btr):
+                for item in items:
+                    btr.insert(item)
+                return btr
+
+            def search_each(btr):
+                for bt_key in probes:
+                    btr.search(bt_key)
+
+            seconds, btr = timeit(insert_each, make())
+            rows.append((f'{name} insert()', f'{seconds:8.3f} s'))
+            seconds, _result = timeit(search_each, btr)
+            rows.append((f'{name} search()',
+                         f'{len(probes) / seconds / 1e3:8.1f} K/s'))
+        report(f'{size} items of {title} keys', rows)
+
+
+@benchmark
+def bench_prefix(size):
+    paths = ['api/v1/users', 'api/v1/orders', 'api/v2/users', 'static/img']
+
+    def url(i):
+        return (f'https://www.example.com/{paths[i % len(paths)]}/'
+                f'{i * 7919 % size:09d}')
+
+    def build(prefix):
+        btr = btree(bare=True, prefix=prefix)
+        btr += [btree_kv(url(i), i) for i in range(size)]
+        return btr
+
+    rows = []
+    for name, prefix in (('bare key/value', False),
+                         ('prefix-compressed', True)):
+        n_byte = memory_of(build, prefix)
+        btr = build(prefix)
+        seconds, _result = timeit(lambda: [btr.search(url(i))
+                                           for i in range(0, size, 10)])
+        rows.append((f'{name} memory', f'{n_byte / size:7.1f} bytes/item'))
+        rows.append((f'{name} search()',
+                     f'{size / 10 / seconds / 1e3:8.1f} K/s'))
+    query = 'https://www.example.com/api/v2/users/0001'
+    for name, func in (
+            ('range() and filter', lambda: [
+                item for item in btr.range(query)
+                if item.bt_key.startswith(query)]),
+            ('prefix_scan()', lambda: list(btr.prefix_scan(query)))):
+        seconds, _result = timeit(func)
+        rows.append((name, f'{seconds * 1e3:8.3f} ms'))
+    report(f'{size} URL keys', rows)
+
+
+@benchmark
+def bench_multimap(size):
+    # half of the values are of one hot key, the others spread on the keys
+    n_key = max(size // 100, 1)
+
+    def key_of(i):
+        return 0 if i % 2 else i % n_key
+
+    def build(cls):
+        btr = cls() if cls is btree_multimap else cls(bare=True)
+        for i in range(size):
+            btr.insert_kv(key_of(i), i)
+        return btr
+
+    rows = []
+    for name, cls in (('bare key/value', btree),
+                      ('btree_multimap', btree_multimap)):
+        n_byte = memory_of(build, cls)
+        seconds, btr = timeit(build, cls)
+        rows.append((f'{name} memory', f'{n_byte / size:7.1f} bytes/value'))
+        rows.append((f'{name} insert_kv()',
+                     f'{size / seconds / 1e3:8.1f} K/s'))
+        seconds, _result = timeit(lambda: [btr.count(key_of(i))
+                                           for i in range(0, size, 100)])
+        rows.append((f'{name} count()',
+                     f'{size / 100 / seconds / 1e3:8.1f} K/s'))
+        seconds, _result = timeit(lambda: btr[size // 4:size // 2])
+        rows.append((f'{name} [] of a quarter',
+                     f'{size / 4 / seconds / 1e6:8.2f} M/s'))
+        # the hot key values from the middle, they're all behind one key
+        victims = [btree_pair(0, i) for i in range(size // 2 | 1, size, 2)]
+        victims = victims[:max(len(victims) // 100, 1)]
+        seconds, _result = timeit(lambda: [btr.delete(None, item)
+                                           for item in victims])
+        rows.append((f'{name} delete(item) of hot key',
+                     f'{seconds / len(victims) * 1e6:8.1f} us'))
+    report(f'{size} values, {n_key} keys', rows)
+
+
+@benchmark
+def bench_cache(size):
+    # 1% of the keys get 80% of the lookups, a cache of 1% of the keys
+    rand = random.Random(size)
+    hot = [rand.randrange(size) for _ in range(max(size // 100, 1))]
+    lookups = [rand.choice(hot) if rand.random() < 0.8
+               else rand.randrange(size) for _ in range(size)]
+    items = [btree_kv(i, i) for i in range(size)]
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # a miss of btree_file may load the pages on the way
+        for name, btr in (
+                ('btree', btree.from_sorted(items)),
+                ('btree_file', btree_file.from_sorted(
+                    os.path.join(tmp_dir, 'file'), items, cache_pages=64))):
+            for policy, cache_size in (('no cache', 0), ('lru', len(hot)),
+                                       ('tinylfu', len(hot))):
+                btr.cache_search(cache_size, policy)
+                for bt_key in lookups[:size // 10]:
+                    btr.search(bt_key)  # warm up
+                seconds, _result = timeit(lambda: [btr.search(bt_key)
+                                                   for bt_key in lookups])
+                cache, hit_ratio = btr.cache, ''
+                if cache is not None:
+                    ratio = cache.hits / (cache.hits + cache.misses)
+                    hit_ratio = f', {ratio:6.1%} hits'
+                rows.append((f'{name} search(), {policy}',
+                             f'{size / seconds / 1e3:8.1f} K/s{hit_ratio}'))
+            if name == 'btree_file':
+                btr.close()
+    report(f'{size} items, {len(hot)} hot keys', rows)
+
+
+@benchmark
+def bench_cursor(size):
+    # each key is near the last one, like sequential ids and events
+    rand = random.Random(size)
+    walk, bt_key = [], size // 2
+    for _ in range(size):
+        bt_key = min(max(bt_key + rand.randrange(-8, 9), 0), size - 1)
+        walk.append(bt_key)
+
+    def seek(btr):
+        cursor = btr.cursor()
+        for bt_key in walk:
+            cursor.seek(bt_key)
+
+    def search(btr):
+        for bt_key in walk:
+            btr.search(bt_key)
+
+    def append(btr):
+        # events in time order, 0.1% of them come late
+        for i in range(size):
+            btr.insert_kv(i - 100 if i % 1000 == 999 else i, i)
+
+    def append_here(btr):
+        cursor = btr.cursor()
+        for i in range(size):
+            if i % 1000 == 999:
+                cursor.seek(i - 100, True)
+                cursor.insert_here(btree_kv(i - 100, i))
+                cursor.seek(None, True)
+            else:
+                cursor.insert_here(btree_kv(i, i))
+                cursor.next()
+
+    def scan(btr):
+        # a page of 100 items at a time, from the last key on
+        last, pages = None, 0
+        while pages * 100 < len(btr):
+            page = list(islice(btr.range(last, None, (False, True)), 100))
+            last, pages = page[-1].bt_key, pages + 1
+
+    def scan_here(btr):
+        cursor, pages = btr.cursor(), 0
+        while pages * 100 < len(btr):
+            list(islice(cursor, 100))
+            pages += 1
+
+    rows = []
+    for min_degree in (1023, 16):
+        btr = btree.from_sorted((btree_kv(i, i) for i in range(size)),
+                                min_degree)
+        for name, func in (('search()', search), ('cursor.seek()', seek),
+                           ('range() of pages', scan),
+                           ('cursor of pages', scan_here)):
+            seconds, _result = timeit(func, btr)
+            rows.append((f'min_degree {min_degree}, {name}',
+                         f'{size / seconds / 1e3:8.1f} K/s'))
+        for name, func in (('insert_kv()', append),
+                           ('cursor.insert_here()', append_here)):
+            seconds, _result = timeit(func, btree(min_degree))
+            rows.append((f'min_degree {min_degree}, {name}',
+                         f'{size / seconds / 1e3:8.1f} K/s'))
+    report(f'{size} keys in a walk of steps up to 8', rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='btree benchmarks')
+    parser.add_argument('-n', '--size', type=int, default=1000000,
+                        help='number of items')
+    parser.add_argument('names', nargs='*',
+                        help=f'benchmarks to run: {", ".join(BENCHMARKS)}, '
+                             'default: all')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark: {name}')
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name](args.size)
+
+
+if '__main__' == __name__:
+    main()